@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Admission control of job submissions
+
+Jobs are only queued while the queues of their model are not too deep,
+the input of its queued jobs is not too big and the primary has enough
+free disk space (see AdmissionControl)
+
+The input bytes of queued jobs are tracked by model (see pend_input and
+unpend_input) along with the number of jobs that left the queues of each
+model (to estimate how fast the queues drain)
+"""
+import collections
+import math
+import threading
+import time
+import psutil
+from .redis_utils import lua_script
+from .settings import (
+    redis_connection,
+    pending_input_name,
+    dequeued_count_name
+)
+
+# remove the pending input of a job (if it was not already) and count the
+# job as dequeued
+# KEYS:  pending input of model, total pending input, dequeued counts
+# ARGV:  job uuid, model
+_UNPEND_INPUT = lua_script("""
+local size = redis.call('HGET', KEYS[1], ARGV[1])
+if not size then
+    return 0
+end
+redis.call('HDEL', KEYS[1], ARGV[1])
+redis.call('HINCRBY', KEYS[2], ARGV[2], -tonumber(size))
+redis.call('HINCRBY', KEYS[3], ARGV[2], 1)
+return 1
+""")
+
+
+def pend_input(redis_conn, job):
+    """
+    Count the input of a job being queued as pending
+
+    redis_conn:  connection (or pipeline) to count via
+    """
+    redis_conn.hset(pending_input_name(job.model), job.uuid, job.input_size)
+    redis_conn.hincrby(pending_input_name(), job.model, job.input_size)
+
+
+def unpend_input(redis_conn, job):
+    """
+    Stop counting the input of a job that left its queue (e.g. it started
+    running or was killed) as pending
+
+    Returns:
+        whether its input was counted as pending
+    """
+    return bool(_UNPEND_INPUT(
+        keys=[pending_input_name(job.model),
+              pending_input_name(),
+              dequeued_count_name()],
+        args=[job.uuid, job.model],
+        client=redis_conn))
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised when jobs are not admitted
+
+    Attributes:
+        status_code (int):  http status to respond with (429 when the
+            model's queues are full, 503 when the primary is out of disk)
+        retry_after (int):  seconds after which the jobs may be admitted
+    """
+
+    def __init__(self, message, status_code, retry_after):
+        super(AdmissionRejected, self).__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class AdmissionControl(object):
+    """
+    Checks whether jobs of a model may be queued given limits on
+
+    - max_queue_depth:  number of queued jobs of the model
+    - max_pending_mb:  MB of input of the queued jobs of the model
+    - min_free_mb:  MB of disk space to keep free in data_dir
+
+    (0 for no limit).  The queue limits may be set per model via
+    model_limits, e.g. {"model_a": {"max_queue_depth": 100}}
+
+    Queued jobs are the ones whose input is pending (see pend_input), so
+    killed jobs whose commands are left in the queues are not counted
+
+    Rejections come with the seconds after which to retry, estimated from
+    how fast the model's queues drained within the last drain_window
+    seconds (default_retry_after if unknown)
+    """
+
+    def __init__(
+            self,
+            data_dir,
+            max_queue_depth=0,
+            max_pending_mb=0,
+            min_free_mb=0,
+            model_limits=None,
+            default_retry_after=60,
+            max_retry_after=3600,
+            drain_window=300):
+        self.data_dir = data_dir
+        self.max_queue_depth = max_queue_depth
+        self.max_pending_mb = max_pending_mb
+        self.min_free_mb = min_free_mb
+        self.model_limits = model_limits or {}
+        self.default_retry_after = default_retry_after
+        self.max_retry_after = max_retry_after
+        self.drain_window = drain_window
+
+        # (time, dequeued count) samples by model
+        self._samples = collections.defaultdict(collections.deque)
+        self._lock = threading.Lock()
+
+    def check(self, model, jobs=1, input_bytes=0):
+        """
+        Check whether jobs more jobs of model with input_bytes of input (in
+        total, 0 if not known yet) may be queued
+
+        Raises:
+            AdmissionRejected if not
+        """
+        redis_conn = redis_connection()
+        limits = self.model_limits.get(model, {})
+        max_queue_depth = limits.get('max_queue_depth', self.max_queue_depth)
+        max_pending_mb = limits.get('max_pending_mb', self.max_pending_mb)
+
+        if self.min_free_mb > 0:
+            free_bytes = psutil.disk_usage(self.data_dir).free
+            if free_bytes - input_bytes < self.min_free_mb * 2**20:
+                raise AdmissionRejected(
+                    "Not enough disk space for jobs",
+                    503,
+                    self.default_retry_after)
+
+        depth = redis_conn.hlen(pending_input_name(model))
+        drain_rate = self._drain_rate(redis_conn, model)
+
+        if max_queue_depth > 0 and depth + jobs > max_queue_depth:
+            raise AdmissionRejected(
+                "Too many queued jobs of model {}".format(model),
+                429,
+                self._retry_after(depth + jobs - max_queue_depth, drain_rate))
+
+        if max_pending_mb > 0:
+            pending_bytes = int(
+                redis_conn.hget(pending_input_name(), model) or 0)
+            excess_bytes = pending_bytes + input_bytes -\
+                max_pending_mb * 2**20
+            if excess_bytes > 0:
+                # drained at the rate of jobs of the average input size
+                job_bytes = float(pending_bytes) / depth if depth > 0 else\
+                    float(input_bytes) / jobs
+                raise AdmissionRejected(
+                    "Too much queued input of model {}".format(model),
+                    429,
+                    self._retry_after(
+                        excess_bytes / max(job_bytes, 1), drain_rate))
+
+    def limits_input(self):
+        """
+        Whether the input bytes of jobs are checked (so that they should be
+        given to check even if they have to be looked up)
+        """
+        return self.min_free_mb > 0 or self.max_pending_mb > 0 or any(
+            limits.get('max_pending_mb', 0) > 0
+            for limits in self.model_limits.values())
+
+    def _drain_rate(self, redis_conn, model):
+        """
+        Jobs of model dequeued per second within the last drain_window
+        seconds (None if unknown)
+        """
+        now = time.time()
+        count = int(redis_conn.hget(dequeued_count_name(), model) or 0)
+        with self._lock:
+            samples = self._samples[model]
+            samples.append((now, count))
+            while len(samples) > 2 and samples[1][0] < now - self.drain_window:
+                samples.popleft()
+            first_time, first_count = samples[0]
+
+        if now - first_time < 1 or count <= first_count:
+            return None
+        return (count - first_count) / (now - first_time)
+
+    def _retry_after(self, excess_jobs, drain_rate):
+        """
+        Seconds until excess_jobs are drained at drain_rate
+        """
+        if drain_rate is None:
+            return self.default_retry_after
+        return int(max(1, min(self.max_retry_after,
+                              math.ceil(excess_jobs / drain_rate))))
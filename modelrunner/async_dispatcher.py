@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+Dispatcher running on an asyncio event loop (requires python 3 and
+redis >= 4.2 for redis.asyncio)
+"""
+import asyncio
+import logging
+from .dispatcher import Dispatcher, WeightedQueueOrder
+from .redis_utils import decode_command
+from .transport import ListTransport
+from .utils import json_dumps_datetime
+from . import Node
+
+logger = logging.getLogger('modelrunner')
+
+
+class AsyncDispatcher(Dispatcher):
+    """
+    Dispatcher (see dispatcher.Dispatcher) that waits on its queues and
+    channels and processes their commands as coroutines on one event loop,
+    so that a process needs no thread per slot or per loop
+
+    Functions of the command handler's dispatch may be coroutine functions,
+    which are awaited on the loop (e.g. to wait for subprocesses via
+    asyncio.create_subprocess_exec, see AsyncWorkerServer), others are
+    run in the loop's default executor so that they do not block it.  So
+    channel commands (e.g. KILL_JOB) are processed while queue commands
+    are.
+
+    Up to slots queue commands are processed at once, each by the command
+    handler of a free slot (command_handler.slot(slot)).
+
+    Commands are popped without processing lists (no lease_timeout) via
+    the lists transport (queues as lists and channels as pub/sub)
+
+    e.g.:
+
+    >>> asyncio.run(AsyncDispatcher(
+    ...     async_redis_connection(), handler, queue, channels).run())
+    """
+
+    def __init__(
+            self,
+            redis_conn,
+            command_handler,
+            queue_name,
+            channel_names,
+            slots=1,
+            queue_weights=None,
+            name=None):
+        """
+        redis_conn:  redis.asyncio connection object (see
+            settings.async_redis_connection)
+
+        See Dispatcher for the other arguments
+        """
+        super(AsyncDispatcher, self).__init__(
+            redis_conn,
+            command_handler,
+            queue_name,
+            channel_names,
+            slots=slots,
+            queue_weights=queue_weights,
+            transport=ListTransport(),
+            name=name)
+
+    async def run(self):
+        """
+        Wait for commands on queues and channels until both are stopped
+        """
+        await asyncio.gather(
+            self.wait_for_queue_commands(),
+            self.wait_for_channel_commands())
+
+    async def wait_for_channel_commands(self):
+        """
+        Wait for commands on channels
+
+        loops until a 'STOP_PROCESSING_CHANNELS' command is received
+        """
+        logger.info("waiting for commands on channels {}".
+                    format(self.channel_names))
+
+        pubsub = self.redis_conn.pubsub()
+        await pubsub.subscribe(*self.channel_names)
+        try:
+            async for raw_message in pubsub.listen():
+                logger.info("message received {}".format(raw_message))
+                if raw_message['type'] != 'message':
+                    continue
+                await self.process_command(
+                    decode_command(raw_message['data']))
+                if not self._keep_processing_channels:
+                    break
+        finally:
+            # reset was renamed aclose in redis 5.0.1
+            await getattr(pubsub, 'aclose', pubsub.reset)()
+
+    async def wait_for_queue_commands(self):
+        """
+        Wait for commands on queues, processing up to slots of them at once
+
+        loops until a 'STOP_PROCESSING_QUEUE' command is received (and
+        the commands being processed are done)
+        """
+        # stop commands left by a previous run
+        await self.redis_conn.delete(self.stop_queue_name)
+
+        command_handlers = [
+            self.command_handler if self.slots == 1 else
+            self.command_handler.slot(slot)
+            for slot in range(self.slots)]
+        for command_handler in command_handlers:
+            command_handler.set_node_status(Node.STATUS_WAITING)
+
+        free_slots = list(range(self.slots))
+        slot_freed = asyncio.Condition()
+        processing = set()
+
+        async def process(command_dict, slot):
+            try:
+                await self.process_command(
+                    command_dict, command_handlers[slot])
+            except Exception:
+                logger.exception(
+                    "failed processing command {}".format(command_dict))
+            finally:
+                command_handlers[slot].set_node_status(Node.STATUS_WAITING)
+                async with slot_freed:
+                    free_slots.append(slot)
+                    slot_freed.notify()
+
+        queue_order = WeightedQueueOrder(self.queue_groups, self.queue_weights)
+        logger.info(
+            "waiting for commands on queues {}".format(self.queue_names))
+        while(self._keep_processing_queue):
+            async with slot_freed:
+                await slot_freed.wait_for(lambda: len(free_slots) > 0)
+            if not self._keep_processing_queue:
+                break
+
+            order = self._pop_order(queue_order)
+            popped_queue_names = [self.stop_queue_name] +\
+                [self.queue_names[i] for i in order]
+            queue_name, serialized = await self.redis_conn.blpop(
+                popped_queue_names, timeout=0)
+
+            # stopped (see stop_processing_queue)
+            if queue_name == self.stop_queue_name:
+                continue
+
+            index = order[popped_queue_names.index(queue_name) - 1]
+            queue_order.served(self._queue_group[index])
+            slot = free_slots.pop(0)
+            command_handlers[slot].set_node_status(Node.STATUS_RUNNING)
+            task = asyncio.ensure_future(
+                process(decode_command(serialized), slot))
+            processing.add(task)
+            task.add_done_callback(processing.discard)
+
+        if len(processing) > 0:
+            await asyncio.wait(processing)
+        for command_handler in command_handlers:
+            command_handler.set_node_status(Node.STATUS_STOPPED)
+        await self.redis_conn.delete(self.stop_queue_name)
+
+    async def process_command(self, command_dict, command_handler=None):
+        """
+        Dispatch a command (see Dispatcher.process_command)
+        """
+        if command_handler is None:
+            command_handler = self.command_handler
+        command = command_dict['command']
+        logger.info("command received {}".format(command))
+        # first try the command_handler
+        if command in command_handler.dispatch:
+            await self._call(command_handler.dispatch[command], command_dict)
+        # now the default
+        if command in self.dispatch:
+            await self._call(self.dispatch[command], command_dict)
+
+    async def _call(self, function, command_dict):
+        """
+        await function (in the default executor if not a coroutine function)
+        """
+        if asyncio.iscoroutinefunction(function):
+            await function(command_dict)
+        else:
+            await asyncio.get_event_loop().run_in_executor(
+                None, function, command_dict)
+
+    async def stop_processing_queue(self, command_dict):
+        """
+        command format {'command': 'STOP_PROCESSING_QUEUE'}
+        """
+        self._keep_processing_queue = False
+        self._queue_stopped.set()
+        # wake up the queue loop waiting on the queues
+        await self.redis_conn.rpush(
+            self.stop_queue_name,
+            json_dumps_datetime({'command': 'STOP_PROCESSING_QUEUE'}))
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Worker running its jobs on an asyncio event loop (see AsyncDispatcher)
+"""
+import asyncio
+import logging
+import time
+from .worker_server import WorkerServer, WorkerSlot
+from . import Node
+
+logger = logging.getLogger('modelrunner')
+
+
+class AsyncWorkerServer(WorkerServer):
+    """
+    WorkerServer whose jobs are run via asyncio.create_subprocess_exec and
+    waited for on the event loop of an AsyncDispatcher, so that running
+    jobs do not hold a thread each
+
+    Preparing the input and zipping the output of jobs is still done in the
+    loop's default executor
+    """
+
+    def slot(self, slot):
+        """
+        Return the command handler of the slot (see AsyncWorkerSlot)
+        """
+        return AsyncWorkerSlot(self, slot)
+
+    async def process_job(self, command_dict, slot=0):
+        """
+        process job (see WorkerServer.process_job)
+
+        slot:  the slot the job is run in
+        """
+        loop = asyncio.get_event_loop()
+        started = await loop.run_in_executor(
+            None, self._start_job, command_dict)
+        if started is None:
+            return
+        job, job_data_log = started
+
+        start = time.time()
+        process = await asyncio.create_subprocess_exec(
+                        *self._command_args(job),
+                        stdout=job_data_log,
+                        stderr=job_data_log)
+
+        # set hidden status attributes
+        self.set_node_status(
+            Node.STATUS_RUNNING,
+            job_uuid=job.uuid,
+            job_pid=process.pid,
+            slot=slot)
+
+        logger.info(
+            "job {} running with pid {}".
+            format(job.uuid, process.pid))
+
+        # wait for command to finish or for it to be killed
+        return_code = await process.wait()
+
+        # Reset hidden status attributes
+        self.set_node_status(Node.STATUS_WAITING, slot=slot)
+
+        await loop.run_in_executor(
+            None, self._finish_job, job, job_data_log, return_code,
+            time.time() - start)
+
+
+class AsyncWorkerSlot(WorkerSlot):
+    """
+    WorkerSlot of an AsyncWorkerServer
+    """
+
+    async def process_job(self, command_dict):
+        await self.worker.process_job(command_dict, slot=self.slot)
@@ -14,6 +14,10 @@ define("config_file", default="config.ini", help="config file for modelrunner")
 define("port", default=8888, help="run on the given port", type=int)
 define("debug", default=False, help="run in debug mode")
 define("redis_url", default="localhost:6379", help="Redis server connection")
+define(
+    "codec",
+    default="json",
+    help="codec jobs and nodes are stored with (json or msgpack)")
 define(
     "primary_url",
     default="localhost:8000",
@@ -28,6 +32,134 @@ define(
     default="input.zip",
     help="input file for new job (job_creator only)")
 define("model", default="test", help="model to be run")
+define(
+    "models",
+    default=[],
+    multiple=True,
+    help="models to be run by a worker (comma separated, default model)")
+define(
+    "model_weights",
+    default=[],
+    multiple=True,
+    help="relative share of jobs a worker runs of each of its models "
+         "(comma separated, default equal)",
+    type=int)
+define(
+    "slots",
+    default=1,
+    help="number of jobs a worker runs at once "
+         "(0 for as many as cpus and free memory allow, see slot_memory)",
+    type=int)
+define(
+    "primary_slots",
+    default=4,
+    help="number of completed jobs a primary retrieves the results of "
+         "at once",
+    type=int)
+define(
+    "worker_fetch_limit",
+    default=2,
+    help="max number of jobs a primary retrieves the results of from one "
+         "worker at once",
+    type=int)
+define(
+    "slot_memory",
+    default=1024,
+    help="MB of memory a job is expected to need (for slots = 0)",
+    type=int)
+define(
+    "page_size",
+    default=100,
+    help="default number of jobs per page when listing jobs",
+    type=int)
+define(
+    "job_cache_size",
+    default=10000,
+    help="max number of jobs cached by the web server (0 to disable)",
+    type=int)
+define(
+    "job_cache_ttl",
+    default=60,
+    help="max seconds the web server serves a job from its cache",
+    type=float)
+define(
+    "transport",
+    default="lists",
+    help="transport of commands between nodes (lists or streams), "
+         "must be the same for all nodes")
+define(
+    "stream_maxlen",
+    default=10000,
+    help="approximate max number of commands kept per channel stream",
+    type=int)
+define(
+    "stream_count",
+    default=1,
+    help="max number of commands read from a queue stream at once",
+    type=int)
+define(
+    "lease_timeout",
+    default=0,
+    help="seconds until jobs of an unresponsive worker are requeued "
+         "(0 to not track jobs being processed)",
+    type=float)
+define(
+    "asyncio",
+    default=False,
+    help="run a primary's or worker's queue and channel loops (and a "
+         "worker's jobs) on one asyncio event loop (python 3, lists "
+         "transport and no lease_timeout only)",
+    type=bool)
+define(
+    "max_queue_depth",
+    default=0,
+    help="max number of queued jobs per model, more are rejected with "
+         "429 (0 for no limit)",
+    type=int)
+define(
+    "max_pending_mb",
+    default=0,
+    help="max MB of input of queued jobs per model, more are rejected "
+         "with 429 (0 for no limit)",
+    type=int)
+define(
+    "min_free_disk_mb",
+    default=0,
+    help="MB of free disk space in data_dir below which jobs are "
+         "rejected with 503 (0 for no limit)",
+    type=int)
+define(
+    "model_limits",
+    default={},
+    help="max_queue_depth and max_pending_mb by model overriding the "
+         "defaults, e.g. {\"test\": {\"max_queue_depth\": 100}} "
+         "(config file only)",
+    type=dict)
+define(
+    "short_job_seconds",
+    default=0,
+    help="run time up to which normal priority jobs are estimated short and "
+         "run before other normal priority jobs (0 to queue jobs by "
+         "priority only)",
+    type=float)
+define(
+    "max_short_wait",
+    default=600,
+    help="seconds a normal priority job may wait before no more jobs are "
+         "run ahead of it as short (see short_job_seconds)",
+    type=float)
+define(
+    "result_cache_size",
+    default=10000,
+    help="max number of completed jobs whose results are reused by jobs "
+         "with the same model, model command and input (0 to always run "
+         "jobs), must be the same for the primary and the web server",
+    type=int)
+define(
+    "status_refresh_interval",
+    default=5,
+    help="min seconds between node status refreshes (0 for every request)",
+    type=float)
 define(
     "admin_key",
     default="",
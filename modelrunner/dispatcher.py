@@ -1,11 +1,57 @@
 # -*- coding: utf-8 -*-
-from modelrunner.redis_utils import pubsub_listen, pop_command
+from modelrunner.settings import (
+    processing_registry_name,
+    stop_queue_name,
+    command_transport
+)
 import logging
+from threading import Event, Thread
+from uuid import uuid4
+from six import string_types
 from . import Node
 
 logger = logging.getLogger('modelrunner')
 
 
+class WeightedQueueOrder(object):
+    """
+    Orders queues to pop from via smooth weighted round robin, so that
+    (while they all have commands) each queue is served in proportion to
+    its weight and none starves
+
+    Equal weights make it plain round robin
+    """
+
+    def __init__(self, queue_names, weights=None):
+        self.queue_names = list(queue_names)
+        self.weights = list(weights) if weights else\
+            [1] * len(self.queue_names)
+        assert len(self.weights) == len(self.queue_names),\
+            "one weight per queue is required"
+        self.total = sum(self.weights)
+        self.current = [0] * len(self.queue_names)
+
+    def order(self):
+        """
+        Returns:
+            indexes of the queues, the one to serve next first
+        """
+        return sorted(
+            range(len(self.queue_names)),
+            key=lambda i: -(self.current[i] + self.weights[i]))
+
+    def served(self, index):
+        """
+        Account for a command popped from the queue at index
+        """
+        for i, weight in enumerate(self.weights):
+            self.current[i] += weight
+        self.current[index] -= self.total
+        # bound the credit of queues that stay empty
+        self.current = [max(-self.total, min(self.total, current))
+                        for current in self.current]
+
+
 class Dispatcher:
     """
     Receives and dispatches commands to command handlers acting as nodes in
@@ -22,7 +68,34 @@ class Dispatcher:
     The command_handler member must have a dispatch attribute which
     maps command names to functions
 
-    Implemented via redis (see redis_utils)
+    Queue commands can be consumed reliably by giving a processing_name
+    and lease_timeout.  Commands are then kept in the processing list
+    while they are processed and the list is leased (and the lease renewed
+    while processing the queue), so that if this dispatcher dies its
+    commands are requeued (see the transport's requeue_expired).  A
+    dispatcher restarted with the same processing_name first processes the commands
+    left in its processing list.  Such commands, and commands claimed from
+    consumers whose lease expired (see the transport's
+    pop_command_reliable_any), are passed to the reclaim_commands method of
+    the command handler (if it has one) before they are processed again.
+
+    Queue commands can be prioritized by giving a group of queues (in
+    priority order) in place of a queue.  Commands are popped from the
+    highest priority queue of any group that has commands, groups with
+    commands of the same priority are served by queue_weights.
+
+    Queue commands can be processed concurrently by giving a number of
+    slots.  Each slot pops and processes commands on its own thread (and
+    its own processing list) via the command handler returned by
+    command_handler.slot(slot).
+
+    Waiting on queues blocks until a command arrives (as far as the
+    transport allows, see its idle_timeout).  To stop waiting, a
+    STOP_PROCESSING_QUEUE command is pushed on the stop queue of the
+    dispatcher, which is popped along with its queues.
+
+    Implemented via redis (see redis_utils) over a transport of commands
+    (see transport, the transport of settings by default)
     """
 
     def __init__(
@@ -30,21 +103,64 @@ class Dispatcher:
             redis_conn,
             command_handler,
             queue_name,
-            channel_names):
+            channel_names,
+            processing_name=None,
+            lease_timeout=0,
+            slots=1,
+            queue_weights=None,
+            transport=None,
+            name=None):
         """
         redis_conn:  redis connection object
         command_handler:  object with a dispatch member
             dispatch:  maps queue or channel command names to functions
-        queue_name:  name of queue to wait on
+        queue_name:  name of queue to wait on (or list of names of queues
+            to wait on at once, where each may be a list of names of
+            queues in priority order, highest first)
         channel_names:  names of channels to listen on
+        processing_name:  name of list to hold queue commands while they
+            are processed (only used if lease_timeout > 0)
+        lease_timeout:  seconds the processing list is leased for
+            (0 to pop commands without a processing list)
+        slots:  number of queue commands to process at once (if > 1,
+            command_handler must have a slot method)
+        queue_weights:  relative share of commands to pop from each queue
+            (or group of queues) when there are several (default equal,
+            see WeightedQueueOrder)
+        transport:  transport of commands (default
+            settings.command_transport())
+        name:  name of the dispatcher, naming its stop queue (default a
+            uuid)
         """
 
         self.channel_names = channel_names
-        self.queue_name = queue_name
+        if isinstance(queue_name, string_types):
+            queue_name = [queue_name]
+        self.queue_groups = [
+            [queue] if isinstance(queue, string_types) else list(queue)
+            for queue in queue_name]
+        # flattened, with the group of each queue
+        self.queue_names = []
+        self._queue_group = []
+        for group, queue_names in enumerate(self.queue_groups):
+            self.queue_names.extend(queue_names)
+            self._queue_group.extend([group] * len(queue_names))
+        self.queue_weights = queue_weights
         self.redis_conn = redis_conn
         self.command_handler = command_handler
+        self.processing_name = processing_name
+        self.lease_timeout = lease_timeout
+        self.slots = slots
+        self.transport = transport if transport is not None else\
+            command_transport()
+        self.stop_queue_name = stop_queue_name(
+            name if name is not None else uuid4())
+
+        assert lease_timeout == 0 or processing_name is not None,\
+            "a processing_name is required for leases"
 
         assert hasattr(command_handler, 'dispatch')
+        assert slots == 1 or hasattr(command_handler, 'slot')
 
         # handle STOP_PROCESSING_{QUEUE,CHANNELS} commands by default
         # so that we can always stop the threads
@@ -55,6 +171,7 @@ class Dispatcher:
 
         self._keep_processing_queue = True
         self._keep_processing_channels = True
+        self._queue_stopped = Event()
 
     def wait_for_channel_commands(self):
         """
@@ -69,12 +186,11 @@ class Dispatcher:
         >>> Thread(target=my_job_node.wait_for_channel_commands).start()
 
         """
-        pubsub = self.redis_conn.pubsub()
-        pubsub.subscribe(self.channel_names)
         logger.info("waiting for commands on channels {}".
                     format(self.channel_names))
 
-        for command_dict in pubsub_listen(pubsub):
+        for command_dict in self.transport.listen(
+                self.redis_conn, self.channel_names):
             self.process_command(command_dict)
             if not self._keep_processing_channels:
                 break
@@ -92,30 +208,233 @@ class Dispatcher:
         >>> Thread(target=my_job_node.wait_for_queue_commands).start()
 
         """
-        logger.info("waiting for commands on queue {}".format(self.queue_name))
+        # stop commands left by a previous run
+        self.redis_conn.delete(self.stop_queue_name)
+
+        if self.lease_timeout > 0:
+            lease_thread = Thread(target=self._renew_leases)
+            lease_thread.daemon = True
+            lease_thread.start()
+
+        slot_threads = [
+            Thread(target=self._wait_for_slot_commands, args=(slot,))
+            for slot in range(1, self.slots)]
+        for slot_thread in slot_threads:
+            slot_thread.start()
+        self._wait_for_slot_commands(0)
+        for slot_thread in slot_threads:
+            slot_thread.join()
+
+        # stop commands not popped by slots that were busy when stopped
+        self.redis_conn.delete(self.stop_queue_name)
+
+    def slot_processing_names(self, slot):
+        """
+        Names of the processing lists of the slot (one per queue)
+        """
+        processing_name = self.processing_name
+        if self.slots > 1:
+            processing_name = "{}/{}".format(processing_name, slot)
+        if len(self.queue_names) == 1:
+            return [processing_name]
+        return ["{}:{}".format(processing_name, queue_name)
+                for queue_name in self.queue_names]
+
+    def _pop_order(self, queue_order):
+        """
+        Indexes of the queues (in queue_names) to pop from, in order:
+        highest priority first, then by the weighted order of groups
+        """
+        group_order = queue_order.order()
+        offsets = [self._queue_group.index(group)
+                   for group in range(len(self.queue_groups))]
+        order = []
+        for priority in range(max(map(len, self.queue_groups))):
+            for group in group_order:
+                if priority < len(self.queue_groups[group]):
+                    order.append(offsets[group] + priority)
+        return order
+
+    def _wait_for_slot_commands(self, slot):
+        """
+        wait_for_queue_commands for one slot
+        """
+        if self.slots == 1:
+            command_handler = self.command_handler
+        else:
+            command_handler = self.command_handler.slot(slot)
+
+        if self.lease_timeout > 0:
+            self._wait_for_slot_commands_reliably(
+                command_handler,
+                self.slot_processing_names(slot))
+            return
+
+        queue_order = WeightedQueueOrder(self.queue_groups, self.queue_weights)
+        timeout = self._idle_timeout()
+        logger.info(
+            "waiting for commands on queues {}".format(self.queue_names))
+        status = None
+        while(self._keep_processing_queue):
+            # set on transitions only, not while idle
+            if status != Node.STATUS_WAITING:
+                status = Node.STATUS_WAITING
+                command_handler.set_node_status(status)
+            order = self._pop_order(queue_order)
+            popped = self.transport.pop_command_any(
+                        self.redis_conn,
+                        [self.stop_queue_name] +
+                        [self.queue_names[i] for i in order],
+                        timeout=timeout)
+
+            # timed out or stopped (see stop_processing_queue)
+            if popped is None or popped[0] == 0:
+                continue
+
+            index = order[popped[0] - 1]
+            queue_order.served(self._queue_group[index])
+            status = Node.STATUS_RUNNING
+            command_handler.set_node_status(status)
+            self.process_command(popped[1], command_handler)
+
+        self.transport.release_consumer(
+            self.redis_conn,
+            [self.stop_queue_name] + self.queue_names)
+        command_handler.set_node_status(Node.STATUS_STOPPED)
+
+    def _wait_for_slot_commands_reliably(
+            self,
+            command_handler,
+            processing_names):
+        """
+        wait_for_queue_commands for one slot via its processing lists
+        """
+        for queue_name, processing_name in zip(
+                self.queue_names, processing_names):
+            self.transport.renew_lease(
+                self.redis_conn,
+                processing_registry_name(),
+                processing_name,
+                queue_name,
+                self.lease_timeout)
+
+        def process(command_dict, token, index):
+            try:
+                self.process_command(command_dict, command_handler)
+            finally:
+                # processed (even if it failed), so it should not be requeued
+                self.transport.ack_command(
+                    self.redis_conn,
+                    self.queue_names[index],
+                    processing_names[index],
+                    token)
+
+        reclaim_commands = getattr(command_handler, 'reclaim_commands', None)
+
+        # commands left by a previous run with the same processing lists
+        for index, processing_name in enumerate(processing_names):
+            pending = self.transport.pending_commands(
+                self.redis_conn,
+                self.queue_names[index],
+                processing_name)
+            if len(pending) > 0 and reclaim_commands is not None:
+                reclaim_commands(
+                    [command_dict for command_dict, token in pending])
+            for command_dict, token in pending:
+                logger.info("resuming command {}".format(command_dict))
+                command_handler.set_node_status(Node.STATUS_RUNNING)
+                process(command_dict, token, index)
+
+        queue_order = WeightedQueueOrder(self.queue_groups, self.queue_weights)
+        timeout = self._idle_timeout()
+        stop_processing_name = "{}:processing".format(self.stop_queue_name)
+        logger.info(
+            "waiting for commands on queues {} (processing via {})".
+            format(self.queue_names, processing_names))
+        status = None
         while(self._keep_processing_queue):
-            # timeout so that we can stop listening via _keep_processing_queue
-            self.command_handler.set_node_status(Node.STATUS_WAITING)
-            command_dict = pop_command(
-                            self.redis_conn,
-                            self.queue_name,
-                            timeout=1)
+            # set on transitions only, not while idle
+            if status != Node.STATUS_WAITING:
+                status = Node.STATUS_WAITING
+                command_handler.set_node_status(status)
+            order = self._pop_order(queue_order)
+            popped = self.transport.pop_command_reliable_any(
+                        self.redis_conn,
+                        [self.stop_queue_name] +
+                        [self.queue_names[i] for i in order],
+                        [stop_processing_name] +
+                        [processing_names[i] for i in order],
+                        timeout=timeout,
+                        lease_timeout=self.lease_timeout,
+                        on_claimed=reclaim_commands,
+                        # block on the next job queue rather than the stop
+                        # queue (which is checked before the job queues,
+                        # at least every timeout seconds)
+                        block_index=1)
 
-            if command_dict is not None:
-                self.command_handler.set_node_status(Node.STATUS_RUNNING)
-                self.process_command(command_dict)
+            if popped is None:
+                continue
 
-        self.command_handler.set_node_status(Node.STATUS_STOPPED)
+            if popped[0] == 0:
+                # stopped (see stop_processing_queue)
+                self.transport.ack_command(
+                    self.redis_conn,
+                    self.stop_queue_name,
+                    stop_processing_name,
+                    popped[2])
+                continue
 
-    def process_command(self, command_dict):
+            index = order[popped[0] - 1]
+            queue_order.served(self._queue_group[index])
+            status = Node.STATUS_RUNNING
+            command_handler.set_node_status(status)
+            process(popped[1], popped[2], index)
+
+        for processing_name in processing_names:
+            self.transport.release_lease(self.redis_conn, processing_name)
+        command_handler.set_node_status(Node.STATUS_STOPPED)
+
+    def _renew_leases(self):
+        """
+        Renew the leases of the processing lists while processing the queue
+        """
+        while not self._queue_stopped.wait(self.lease_timeout / 3.0):
+            for slot in range(self.slots):
+                for queue_name, processing_name in zip(
+                        self.queue_names, self.slot_processing_names(slot)):
+                    held = self.transport.renew_lease(
+                        self.redis_conn,
+                        processing_registry_name(),
+                        processing_name,
+                        queue_name,
+                        self.lease_timeout)
+                    if not held:
+                        logger.warning(
+                            "lease of {} expired, its commands may be "
+                            "requeued".format(processing_name))
+
+    def _idle_timeout(self):
+        """
+        Seconds to block for while waiting on the queues (0 forever)
+        """
+        timeout = self.transport.idle_timeout(
+            len(self.queue_names) + 1,
+            lease_timeout=self.lease_timeout)
+        return timeout if timeout is not None else 0
+
+    def process_command(self, command_dict, command_handler=None):
         """
         Main dispatcher for commands that come through on queues or channels
+
+        command_handler:  handler to dispatch to (default command_handler)
         """
+        if command_handler is None:
+            command_handler = self.command_handler
         command = command_dict['command']
         logger.info("command received {}".format(command))
         # first try the command_handler
-        if command in self.command_handler.dispatch:
-            self.command_handler.dispatch[command](command_dict)
+        if command in command_handler.dispatch:
+            command_handler.dispatch[command](command_dict)
         # now the default
         if command in self.dispatch:
             self.dispatch[command](command_dict)
@@ -125,6 +444,13 @@ class Dispatcher:
         command format {'command': 'STOP_PROCESSING_QUEUE'}
         """
         self._keep_processing_queue = False
+        self._queue_stopped.set()
+        # wake up the slots waiting on the queues
+        for slot in range(self.slots):
+            self.transport.enqueue_command(
+                self.redis_conn,
+                self.stop_queue_name,
+                {'command': 'STOP_PROCESSING_QUEUE'})
 
     def stop_processing_channels(self, command_dict):
         """
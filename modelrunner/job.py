@@ -1,7 +1,13 @@
 # -*- coding: utf-8 -*-
 import datetime
 from uuid import uuid4
-from .redisent import RedisEntity
+from .redisent import RedisEntity, STORAGE_BLOB, STORAGE_HASH
+from .redis_utils import publish_command
+from .settings import (
+    redis_connection,
+    job_events_channel_name,
+    job_queue_name
+)
 from six import string_types
 
 
@@ -22,6 +28,18 @@ class Job(RedisEntity):
         primary_data_dir (str):  path on primary server holding job data
         worker_data_dir (str):  path on worker server holding job data
         on_primary (bool): whether job is currently on primary or worker
+        priority (str):  One of PRIORITY constants, workers take queued
+            jobs of higher priority first
+        input_size (int):  bytes of the job's input (counted against the
+            admission limits of its model while queued, see admission)
+        expected_seconds (float):  run time estimated when it was queued
+            (None if not estimated, see scheduler)
+        run_seconds (float):  seconds its model command ran for (None until
+            run)
+        cache_key (str):  hash of its model, model command and input that
+            its results are cached by (None if not cached, see result_cache)
+        cached_from (str):  uuid of the job whose results it was completed
+            with (None if it was run)
 
     """
 
@@ -33,6 +51,38 @@ class Job(RedisEntity):
     STATUS_FAILED = "FAILED"
     STATUS_KILLED = "KILLED"
 
+    # statuses a job does not leave
+    FINAL_STATUSES = (STATUS_COMPLETE, STATUS_FAILED, STATUS_KILLED)
+
+    PRIORITY_HIGH = "high"
+    PRIORITY_NORMAL = "normal"
+    PRIORITY_LOW = "low"
+
+    # highest first, each has its own queue per model (see queue_name)
+    PRIORITIES = (PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW)
+
+    # queue of normal priority jobs expected to run briefly (see scheduler)
+    LANE_SHORT = "short"
+
+    # queues of each model, popped from in this order
+    QUEUE_ORDER = (PRIORITY_HIGH, LANE_SHORT, PRIORITY_NORMAL, PRIORITY_LOW)
+
+    # keep jobs indexed by creation time for paging
+    _order_by = "created"
+
+    # allow finding jobs by these attributes (see RedisEntity.find)
+    _indexes = ("status", "model", "worker_url")
+
+    # store each job as a hash so that status changes can be written
+    # without rewriting (or racing with writes to) the rest of the job
+    _storage = STORAGE_HASH
+
+    # allow jobs to be cached by the web server (see RedisEntity.enable_cache)
+    _publish_writes = True
+
+    # count writes so that clients polling jobs can be told nothing changed
+    _versioned = True
+
     def __init__(self,
                  model=None,
                  name=None,
@@ -43,7 +93,13 @@ class Job(RedisEntity):
                  worker_url=None,
                  primary_data_dir=None,
                  worker_data_dir=None,
-                 on_primary=True):
+                 on_primary=True,
+                 priority=PRIORITY_NORMAL,
+                 input_size=0,
+                 expected_seconds=None,
+                 run_seconds=None,
+                 cache_key=None,
+                 cached_from=None):
 
         self.model = model
         self.name = name
@@ -60,6 +116,97 @@ class Job(RedisEntity):
         self.primary_data_dir = primary_data_dir
         self.worker_data_dir = worker_data_dir
         self.on_primary = on_primary
+        self.priority = priority
+        self.input_size = input_size
+        self.expected_seconds = expected_seconds
+        self.run_seconds = run_seconds
+        self.cache_key = cache_key
+        self.cached_from = cached_from
+
+    @classmethod
+    def check_storage(cls):
+        """
+        Raise RuntimeError if jobs are still stored in the single hash
+        used before per job hashes (see _storage), as they would not be
+        found until scripts/job_migration_02.py rewrites them
+
+        To be called from entry points after settings.initialize
+        """
+        if cls.stored_via(STORAGE_BLOB):
+            raise RuntimeError(
+                "Jobs in {} are stored in the legacy single hash, "
+                "run scripts/job_migration_02.py first".
+                format(cls.hash_name()))
+
+    @classmethod
+    def set_status(cls, uuid, status, **values):
+        """
+        Update the status (and any other attributes) of the job with uuid
+        and publish the status change (see publish_status)
+        """
+        cls.update(uuid, status=status, **values)
+        cls.publish_status(uuid, status)
+
+    @classmethod
+    def set_status_if(cls, uuid, statuses, status, **values):
+        """
+        Like set_status, but only if the job currently has one of statuses
+
+        Lets the primary and workers race for a job without overwriting
+        each other (e.g. a worker starting a queued job that is killed)
+
+        Returns:
+            whether the status was set
+        """
+        if not cls.update_if(
+                uuid, {'status': list(statuses)}, status=status, **values):
+            return False
+        cls.publish_status(uuid, status)
+        return True
+
+    @classmethod
+    def publish_status(cls, uuid, status, redis_conn=None):
+        """
+        Publish a status change of the job with uuid on the job events
+        channel (e.g. to push it to clients of the web server)
+
+        redis_conn:  connection (or pipeline) to publish via
+            (default redis_connection())
+
+        event format {'command': 'JOB_STATUS',
+                      'job_uuid': <uuid>,
+                      'status': <status>,
+                      'updated': <datetime>}
+        """
+        event_dict = {'command': 'JOB_STATUS',
+                      'job_uuid': uuid,
+                      'status': status,
+                      'updated': datetime.datetime.utcnow()}
+        publish_command(
+            redis_conn if redis_conn is not None else redis_connection(),
+            job_events_channel_name(),
+            event_dict)
+
+    @classmethod
+    def queue_names(cls, model):
+        """
+        Names of the queues of jobs of model, in the order they are popped
+        from (see QUEUE_ORDER)
+        """
+        return [cls.queue_name(model, priority)
+                for priority in cls.QUEUE_ORDER]
+
+    @classmethod
+    def queue_name(cls, model, priority=PRIORITY_NORMAL):
+        """
+        Name of the queue of jobs of model with priority (or LANE_SHORT)
+
+        Normal priority jobs use the plain model queue, so that jobs queued
+        before priorities existed are still processed
+        """
+        if priority == cls.PRIORITY_NORMAL:
+            return job_queue_name(model)
+        return job_queue_name(model, priority)
 
     def get_data_dir(self):
         """
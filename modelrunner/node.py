@@ -15,6 +15,7 @@ class Node(RedisEntity):
         version (str): version of modelrunner
         # only pertain to WORKER nodes
         model (str): name of model that worker runs
+        job_uuid (str): uuid of job the worker is running (if any)
     """
 
     TYPE_PRIMARY = "PRIMARY"
@@ -24,13 +25,20 @@ class Node(RedisEntity):
     STATUS_WAITING = "WAITING"
     STATUS_RUNNING = "RUNNING"
 
+    # allow finding nodes by these attributes (see RedisEntity.find)
+    _indexes = ("node_type", "model", "status")
+
+    # count writes so that clients polling status can be told nothing changed
+    _versioned = True
+
     def __init__(self,
                  name=None,
                  node_url=None,
                  status=STATUS_WAITING,
                  node_type=None,
                  version=None,
-                 model=None):
+                 model=None,
+                 job_uuid=None):
 
         self.name = name
         self.node_url = node_url
@@ -38,6 +46,7 @@ class Node(RedisEntity):
         self.node_type = node_type
         self.version = version
         self.model = model
+        self.job_uuid = job_uuid
 
     def __str__(self):
         return str(self.__dict__)
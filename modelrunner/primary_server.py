@@ -2,23 +2,22 @@
 
 import os
 import logging
+import threading
 
 import modelrunner
-from modelrunner.utils import fetch_file_from_url
-from modelrunner.redis_utils import (
-    enqueue_command,
-    remove_command,
-    publish_command
-)
-
+from modelrunner.utils import fetch_file_from_url, fetch_files_from_urls
 from modelrunner.settings import (
     redis_connection,
-    job_queue_name,
+    command_transport,
     worker_name,
     node_channel_name,
-    all_nodes_channel_name
+    all_nodes_channel_name,
+    node_refresh_name,
+    processing_registry_name
 )
 
+from .admission import pend_input, unpend_input
+from .result_cache import file_digest
 from . import Job
 from . import Node
 
@@ -33,12 +32,32 @@ class PrimaryServer:
     Implements 'CommandHandler interface' required by TaskNode
 
     Main entry point for submitting jobs and retrieving results
+
+    Completed jobs can be handled concurrently by processing the primary
+    queue in several slots (see Dispatcher slots), while the results of at
+    most worker_fetch_limit jobs are retrieved from any one worker at once
+
+    Jobs are queued by priority, or on the queue chosen by scheduler (see
+    scheduler.RuntimeScheduler) if given
+
+    With a result_cache (see result_cache.ResultCache), jobs matching a
+    completed job are completed with its results instead of being queued
     """
 
-    def __init__(self, primary_url, data_dir):
+    def __init__(self, primary_url, data_dir, worker_fetch_limit=2,
+                 scheduler=None, result_cache=None):
         if(not os.path.exists(data_dir)):
             os.mkdir(data_dir)
         self.data_dir = data_dir
+        self.worker_fetch_limit = worker_fetch_limit
+        self.scheduler = scheduler
+        self.result_cache = result_cache
+
+        # semaphores limiting fetches by worker url
+        self._worker_fetches = {}
+        # slots processing commands
+        self._running_slots = set()
+        self._lock = threading.Lock()
 
         self.dispatch = {
             'COMPLETE_JOB': self.complete_job,
@@ -59,25 +78,39 @@ class PrimaryServer:
         """
         return self._node
 
-    def refresh_node_status(self):
+    def refresh_node_status(self, min_interval=0):
         """
         Refresh the status of all nodes by
         1.  Deleting existing state
         2.  Publishing a request for all nodes to update
 
         All listening nodes will update the Node hash with their state
+
+        Args:
+            min_interval (float):  if > 0, skip the refresh if the status
+                was refreshed (by any server) within min_interval seconds
+
+        Returns:
+            whether the status was refreshed
         """
 
-        for node in Node.values():
-            del Node[node.name]
+        if min_interval > 0 and not redis_connection().set(
+                node_refresh_name(), 1,
+                nx=True, px=int(min_interval * 1000)):
+            return False
+
+        for name in Node.keys():
+            del Node[name]
 
         status_command = {"command": "UPDATE_STATUS"}
-        publish_command(
+        command_transport().publish_command(
             redis_connection(),
             all_nodes_channel_name(),
             status_command)
+        return True
 
-    def enqueue(self, job, job_data_blob=None, job_data_url=None):
+    def enqueue(self, job, job_data_blob=None, job_data_url=None,
+                use_cache=True):
         """
         Write job data to file and queue up for processing
 
@@ -87,36 +120,105 @@ class PrimaryServer:
         Args:
             job_data_blob (blob):  blob of a zip file to be written to disk
             job_data_url (str):  the url of a zip file to fetched
+            use_cache (bool):  whether the job may be completed with the
+                results of a matching job (see enqueue_many)
 
         """
 
         # only allow job data as blob or url
         assert((job_data_blob is None) ^ (job_data_url is None))
 
-        job_data_dir = os.path.join(self.data_dir, job.uuid)
-        if(not os.path.exists(job_data_dir)):
-            os.mkdir(job_data_dir)
+        self.enqueue_many(
+            [job],
+            job_data_blob=job_data_blob,
+            job_data_urls=None if job_data_url is None else [job_data_url],
+            use_cache=use_cache)
+
+    def enqueue_many(self, jobs, job_data_blob=None, job_data_urls=None,
+                     use_cache=True):
+        """
+        Write the data of jobs to file and queue them up for processing
+
+        The jobs are stored and queued in one redis transaction
+
+        With a result_cache (and use_cache), jobs whose model, model command
+        and input match those of a completed job are completed right away
+        with links to its results instead (see Job.cached_from)
+
+        Note:  This should be run async wrt a web server as it will block
+            on fetching/writing data
+
+        Args:
+            jobs (list of modelrunner.Job):  jobs to queue
+            job_data_blob (blob):  blob of a zip file to be written to disk
+                as the input of every job
+            job_data_urls (list of str):  the url of a zip file to be
+                fetched for each job
+            use_cache (bool):  whether jobs may be completed with the
+                results of matching jobs
+
+        """
 
-        job_data_file = os.path.join(job_data_dir, "input.zip")
-        if(job_data_blob):
-            logger.info("writing input file for job to {}".
-                        format(job_data_file))
-            file_handle = open(job_data_file, 'wb')
-            file_handle.write(job_data_blob)
-            file_handle.close()
+        # only allow job data as blob or urls
+        assert((job_data_blob is None) ^ (job_data_urls is None))
+        assert job_data_urls is None or len(job_data_urls) == len(jobs)
+
+        for i, job in enumerate(jobs):
+            job_data_dir = os.path.join(self.data_dir, job.uuid)
+            if(not os.path.exists(job_data_dir)):
+                os.mkdir(job_data_dir)
+
+            job_data_file = os.path.join(job_data_dir, "input.zip")
+            if(job_data_blob):
+                logger.info("writing input file for job to {}".
+                            format(job_data_file))
+                file_handle = open(job_data_file, 'wb')
+                file_handle.write(job_data_blob)
+                file_handle.close()
+            else:
+                logger.info("retrieving input file for job and writing to {}".
+                            format(job_data_file))
+                fetch_file_from_url(
+                    job_data_urls[i], job_data_dir, "input.zip")
+            job.input_size = os.path.getsize(job_data_file)
+
+            job.primary_url = self.node.node_url
+            # to know where output.zip is
+            job.primary_data_dir = self.data_dir
+            job.status = Job.STATUS_QUEUED
+
+            if use_cache and self.result_cache is not None:
+                job.cache_key = self.result_cache.key(
+                    job.model, file_digest(job_data_file))
+                cached_job = self.result_cache.lookup(job.cache_key)
+                if cached_job is not None:
+                    logger.info("completing job {} with results of job {}".
+                                format(job.uuid, cached_job.uuid))
+                    self.result_cache.link_results(cached_job, job_data_dir)
+                    job.cached_from = cached_job.uuid
+                    job.status = Job.STATUS_COMPLETE
+
+        queued_jobs = [job for job in jobs if job.status == Job.STATUS_QUEUED]
+        if self.scheduler is not None:
+            job_queues = self.scheduler.queue_names(queued_jobs)
         else:
-            logger.info("retrieving input file for job and writing to {}".
-                        format(job_data_file))
-            fetch_file_from_url(job_data_url, job_data_dir, "input.zip")
-
-        # add to global job list then queue it to be run
-        job.primary_url = self.node.node_url
-        job.primary_data_dir = self.data_dir  # to know where output.zip is
-        job.status = Job.STATUS_QUEUED
-        Job[job.uuid] = job
-        job_queue = job_queue_name(job.model)
-        command_dict = {'command': 'PROCESS_JOB', 'job_uuid': job.uuid}
-        enqueue_command(redis_connection(), job_queue, command_dict)
+            job_queues = [Job.queue_name(job.model, job.priority)
+                          for job in queued_jobs]
+
+        # add to global job list then queue them to be run
+        def queue_jobs(pipe):
+            for job in jobs:
+                if job.status != Job.STATUS_QUEUED:
+                    Job.publish_status(job.uuid, job.status, redis_conn=pipe)
+            for job, job_queue in zip(queued_jobs, job_queues):
+                Job.publish_status(job.uuid, job.status, redis_conn=pipe)
+                pend_input(pipe, job)
+                command_dict = {'command': 'PROCESS_JOB',
+                                'job_uuid': job.uuid}
+                command_transport().enqueue_command(
+                    pipe, job_queue, command_dict)
+
+        Job.set_many(((job.uuid, job) for job in jobs), also=queue_jobs)
 
     def kill_job(self, job):
         """
@@ -128,19 +230,20 @@ class PrimaryServer:
 
         if job.status == Job.STATUS_QUEUED:
             # case 1:  job is in QUEUED state
-            #          remove it from the queue and mark as killed
-
-            job_queue = job_queue_name(job.model)
-            logger.info(
-                "killing job {} by removing from queue {}".
-                format(job.uuid, job_queue))
-
-            command_dict = {'command': 'PROCESS_JOB', 'job_uuid': job.uuid}
-            remove_command(redis_connection(), job_queue, command_dict)
-            job.status = Job.STATUS_KILLED
-            # save it
-            Job[job.uuid] = job
-        elif job.status == Job.STATUS_RUNNING:
+            #          mark it as killed, its command is left in the queue
+            #          and ignored by the worker that pops it (so that
+            #          killing does not scan the queue)
+            logger.info("killing queued job {}".format(job.uuid))
+            if Job.set_status_if(
+                    job.uuid, [Job.STATUS_QUEUED], Job.STATUS_KILLED):
+                job.status = Job.STATUS_KILLED
+                unpend_input(redis_connection(), job)
+                return
+
+            # a worker started it meanwhile
+            job = Job[job.uuid]
+
+        if job.status == Job.STATUS_RUNNING:
             # case 2:  job is in RUNNING state
             #          send message to worker to kill the job
             worker = worker_name(job.worker_url, job.model)
@@ -148,11 +251,45 @@ class PrimaryServer:
             logger.info("sending command to kill job on channel {}".
                         format(worker_channel))
             command_dict = {'command': "KILL_JOB", 'job_uuid': job.uuid}
-            publish_command(redis_connection(), worker_channel, command_dict)
+            command_transport().publish_command(
+                redis_connection(), worker_channel, command_dict)
         else:
             logger.info("kill called on job {} in incompatible state {}".
                         format(job.uuid, job.status))
 
+    def requeue_expired_jobs(self):
+        """
+        Requeue jobs whose worker's lease on them expired (e.g. because the
+        worker crashed) so that another worker runs them
+
+        See Dispatcher lease_timeout
+
+        Returns:
+            list of uuids of requeued jobs
+        """
+
+        def queue_jobs(command_dicts):
+            # mark them queued before they can be popped again
+            for command_dict in command_dicts:
+                if command_dict['command'] != 'PROCESS_JOB':
+                    continue
+                job_uuid = command_dict['job_uuid']
+                try:
+                    status = Job.get_fields(job_uuid, "status")["status"]
+                except KeyError:
+                    continue
+                if status == Job.STATUS_RUNNING:
+                    logger.warning("requeueing job {}".format(job_uuid))
+                    Job.set_status(
+                        job_uuid, Job.STATUS_QUEUED, on_primary=True)
+
+        requeued = command_transport().requeue_expired(
+            redis_connection(),
+            processing_registry_name(),
+            before_requeue=queue_jobs)
+        return [command_dict['job_uuid'] for command_dict in requeued
+                if command_dict['command'] == 'PROCESS_JOB']
+
     def complete_job(self, command_dict):
         """
         Handle jobs that have been completed (by workers)
@@ -172,24 +309,30 @@ class PrimaryServer:
 
         logger.info("job {} finished with status of {}".format(job.uuid,
                                                                job.status))
-        # Get the job log from the worker
-        logger.info("retrieving log for job {}".format(job.uuid))
         job_data_dir = os.path.join(self.data_dir, job.uuid)
         if(not os.path.exists(job_data_dir)):
             os.mkdir(job_data_dir)
 
-        fetch_file_from_url(job.log_url(), job_data_dir)
-
-        # Now get the job output data from the worker
+        # Get the job log (and output data) from the worker at once
+        urls = [job.log_url()]
         if(job.status == Job.STATUS_PROCESSED):
+            urls.append(job.download_url())
+
+        logger.info("retrieving results of job {}".format(job.uuid))
+        with self._worker_fetch_semaphore(job.worker_url):
+            fetch_files_from_urls(urls, job_data_dir)
 
-            logger.info("retrieving output for job {}".format(job.uuid))
-            fetch_file_from_url(job.download_url(), job_data_dir)
+        if(job.status == Job.STATUS_PROCESSED):
             job.status = Job.STATUS_COMPLETE
 
         job.on_primary = True
         # save job
-        Job[job.uuid] = job
+        Job.set_status(job.uuid, job.status, on_primary=job.on_primary)
+
+        # so that matching jobs are completed with its results
+        if self.result_cache is not None and job.cache_key is not None and\
+                job.status == Job.STATUS_COMPLETE:
+            self.result_cache.add(job)
 
     def update_status(self, command_dict):
         """
@@ -200,9 +343,56 @@ class PrimaryServer:
         # just save it as Node redis entity
         Node[self.node.name] = self.node
 
-    def set_node_status(self, status):
+    def set_node_status(self, status, slot=0):
         """
         Will be called by dispatcher to set node status as it
         waits on queue (WAITING) and as it starts processing (RUNNING)
+
+        slot:  the slot whose status changed (the node is RUNNING while
+            any slot is)
+        """
+        with self._lock:
+            if status == Node.STATUS_RUNNING:
+                self._running_slots.add(slot)
+            else:
+                self._running_slots.discard(slot)
+            if len(self._running_slots) > 0:
+                status = Node.STATUS_RUNNING
+            self._node.status = status
+
+    def slot(self, slot):
+        """
+        Return the command handler of the slot (see PrimarySlot)
+        """
+        return PrimarySlot(self, slot)
+
+    def _worker_fetch_semaphore(self, worker_url):
         """
-        self._node.status = status
+        Semaphore limiting the fetches from worker_url to worker_fetch_limit
+        """
+        with self._lock:
+            if worker_url not in self._worker_fetches:
+                self._worker_fetches[worker_url] =\
+                    threading.BoundedSemaphore(self.worker_fetch_limit)
+            return self._worker_fetches[worker_url]
+
+
+class PrimarySlot(object):
+    """
+    Implements 'CommandHandler interface' for one of the slots of a
+    PrimaryServer, so that completed jobs are handled concurrently
+    """
+
+    def __init__(self, primary, slot):
+        self.primary = primary
+        self.slot = slot
+        self.dispatch = {
+            'COMPLETE_JOB': primary.complete_job
+        }
+
+    @property
+    def node(self):
+        return self.primary.node
+
+    def set_node_status(self, status):
+        self.primary.set_node_status(status, slot=self.slot)
@@ -3,15 +3,85 @@
 functions associated with implementing modelrunner 'protocol' via Redis
 
 command dicts are serialized as json
+
+Only the attributes that a command declares as datetimes (see
+COMMAND_SCHEMAS) are loaded as datetimes, everything else is loaded as is
+
+Queues can be consumed reliably via pop_command_reliable, which moves
+commands to a processing list until they are acked.  The processing list
+is leased by its consumer and requeue_expired moves the commands of
+expired leases (e.g. of crashed consumers) back to their queue.
 """
 
+import json
 import logging
-from .utils import json_dumps_datetime, json_loads_datetime
+from redis import WatchError
+from redis.commands.core import Script
+from datetime import datetime
+from six import string_types
+from .utils import json_dumps_datetime
 
 # setup log
 logger = logging.getLogger('modelrunner')
 
 
+def lua_script(script):
+    """
+    Lua script to be created once (e.g. at module level) and run via
+    script(keys=..., args=..., client=redis_conn), rather than registered
+    with a connection on every call (see redis' register_script)
+    """
+    # as bytes, so that no connection is needed to compute its sha
+    return Script(None, script.encode('utf-8'))
+
+# maps command names to the names of their attributes that are datetimes
+# (serialized as isoformat strings)
+COMMAND_SCHEMAS = {
+    'PROCESS_JOB': (),
+    'COMPLETE_JOB': (),
+    'KILL_JOB': (),
+    'UPDATE_STATUS': (),
+    'STOP_PROCESSING_QUEUE': (),
+    'STOP_PROCESSING_CHANNELS': (),
+    'JOB_STATUS': ('updated',)
+}
+
+DATETIME_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S')
+
+
+def register_command(command_name, datetime_attrs=()):
+    """
+    declare a command and which of its attributes are datetimes so that
+    they are decoded as such (commands not declared are decoded as plain
+    json)
+    """
+    COMMAND_SCHEMAS[command_name] = tuple(datetime_attrs)
+
+
+def _parse_datetime(value):
+    for format in DATETIME_FORMATS:
+        try:
+            return datetime.strptime(value, format)
+        except ValueError:
+            pass
+    raise ValueError("Invalid datetime {}".format(value))
+
+
+def decode_command(dump):
+    """
+    load a command dict from json, converting only the attributes declared
+    as datetimes in COMMAND_SCHEMAS
+    """
+    command_dict = json.loads(dump)
+    datetime_attrs = COMMAND_SCHEMAS.get(command_dict.get('command'), ())
+    for attr in datetime_attrs:
+        value = command_dict.get(attr)
+        if isinstance(value, string_types):
+            command_dict[attr] = _parse_datetime(value)
+
+    return command_dict
+
+
 def pop_command(redis_conn, queue_name, timeout=0):
     """
     *Blocking*
@@ -26,10 +96,188 @@ def pop_command(redis_conn, queue_name, timeout=0):
         # timedout
         return None
 
-    command_dict = json_loads_datetime(result[1])
+    command_dict = decode_command(result[1])
     return command_dict
 
 
+def pop_command_reliable(redis_conn, queue_name, processing_name, timeout=0):
+    """
+    *Blocking*
+
+    Waits for command on redis queue and moves it to the processing list
+    (where it stays until acked via ack_command)
+
+    timeout:  if 0, wait forever for item on queue, else seconds to timeout
+    Returns (command dict, serialized command) or None if timeout
+    """
+
+    result = redis_conn.blmove(
+        queue_name, processing_name, timeout, src="LEFT", dest="RIGHT")
+    if result is None:
+        # timedout
+        return None
+
+    return decode_command(result), result
+
+
+def pop_command_any(redis_conn, queue_names, timeout=0):
+    """
+    *Blocking*
+
+    Waits for command on any of the redis queues (preferring earlier ones)
+    timeout:  if 0, wait forever for item on a queue, else seconds to timeout
+    Returns (index of queue popped from, command dict) or None if timeout
+    """
+
+    result = redis_conn.blpop(queue_names, timeout=timeout)
+    if result is None:
+        # timedout
+        return None
+
+    return list(queue_names).index(result[0]), decode_command(result[1])
+
+
+# move the first command of the first non-empty queue to its processing list
+# KEYS:  queue_1, processing_1, queue_2, processing_2, ...
+_MOVE_FIRST_COMMAND = lua_script("""
+for i = 1, #KEYS, 2 do
+    local item = redis.call('LMOVE', KEYS[i], KEYS[i + 1], 'LEFT', 'RIGHT')
+    if item then
+        return {i, item}
+    end
+end
+return false
+""")
+
+
+def pop_command_reliable_any(
+        redis_conn,
+        queue_names,
+        processing_names,
+        timeout=0,
+        block_index=0):
+    """
+    *Blocking*
+
+    pop_command_reliable from any of the redis queues (preferring earlier
+    ones), moving the command to the processing list of its queue
+
+    Redis cannot block on moving from several lists, so if all are empty
+    this only blocks on the queue at block_index (commands on the others
+    are popped on the next call)
+
+    timeout:  if 0, wait forever for item on a queue, else seconds to timeout
+    Returns (index of queue popped from, command dict, serialized command)
+    or None if timeout
+    """
+
+    if len(queue_names) > 1:
+        keys = []
+        for queue_name, processing_name in zip(queue_names, processing_names):
+            keys.extend([queue_name, processing_name])
+        result = _MOVE_FIRST_COMMAND(keys=keys, client=redis_conn)
+        if result is not None:
+            return (int(result[0]) - 1) // 2,\
+                decode_command(result[1]), result[1]
+
+    result = pop_command_reliable(
+        redis_conn,
+        queue_names[block_index],
+        processing_names[block_index],
+        timeout=timeout)
+    if result is None:
+        return None
+
+    return (block_index,) + result
+
+
+def ack_command(redis_conn, processing_name, serialized_command):
+    """
+    remove a processed command from the processing list
+    """
+    redis_conn.lrem(processing_name, 1, serialized_command)
+
+
+def lease_name(processing_name):
+    return "{}:lease".format(processing_name)
+
+
+def renew_lease(
+        redis_conn,
+        registry_name,
+        processing_name,
+        queue_name,
+        lease_timeout):
+    """
+    (re)register processing_name as the processing list of commands
+    from queue_name and lease it for lease_timeout seconds
+
+    Returns whether the lease was held until now (if not, its commands
+    may have been requeued)
+    """
+    pipe = redis_conn.pipeline()
+    pipe.hset(registry_name, processing_name, queue_name)
+    pipe.set(
+        lease_name(processing_name),
+        1,
+        px=int(lease_timeout * 1000),
+        get=True)
+    return pipe.execute()[1] is not None
+
+
+def release_lease(redis_conn, processing_name):
+    """
+    release the lease (any commands left in the processing list will be
+    requeued by requeue_expired)
+    """
+    redis_conn.delete(lease_name(processing_name))
+
+
+def requeue_expired(redis_conn, registry_name, before_requeue=None):
+    """
+    move commands in processing lists (registered in registry_name) whose
+    lease expired back to the front of their queue
+
+    before_requeue:  if not None, called with the list of command dicts of
+        a processing list before they are requeued
+    Returns list of requeued command dicts
+    """
+    requeued = []
+    for processing_name, queue_name in \
+            redis_conn.hgetall(registry_name).items():
+        with redis_conn.pipeline() as pipe:
+            try:
+                # abort if the lease is renewed or commands are acked
+                pipe.watch(lease_name(processing_name), processing_name)
+                if pipe.exists(lease_name(processing_name)):
+                    pipe.unwatch()
+                    continue
+
+                serialized_commands = pipe.lrange(processing_name, 0, -1)
+                command_dicts = [decode_command(item)
+                                 for item in serialized_commands]
+                if before_requeue is not None and len(command_dicts) > 0:
+                    before_requeue(command_dicts)
+
+                pipe.multi()
+                if len(serialized_commands) > 0:
+                    logger.warning(
+                        "requeueing commands {} of expired {} to {}".
+                        format(command_dicts, processing_name, queue_name))
+                    # keep their order
+                    pipe.lpush(queue_name, *reversed(serialized_commands))
+                    pipe.delete(processing_name)
+                pipe.hdel(registry_name, processing_name)
+                pipe.execute()
+                requeued.extend(command_dicts)
+            except WatchError:
+                logger.warning(
+                    "lease of {} renewed while requeueing".
+                    format(processing_name))
+
+    return requeued
+
+
 def enqueue_command(redis_conn, queue_name, command_dict):
     """
     enqueue command on redis queue
@@ -46,7 +294,7 @@ def remove_command(redis_conn, queue_name, command_dict):
     """
     result = redis_conn.lrange(queue_name, 0, -1)
     matches = filter(lambda d: d == command_dict,
-                     [json_loads_datetime(item) for item in result])
+                     [decode_command(item) for item in result])
     for match in matches:
         redis_conn.lrem(queue_name, 1, json_dumps_datetime(match))
 
@@ -63,7 +311,15 @@ def get_all_commands(redis_conn, queue_name):
     get all command_dicts on queue
     """
     result = redis_conn.lrange(queue_name, 0, -1)
-    return [json_loads_datetime(item) for item in result]
+    return [decode_command(item) for item in result]
+
+
+def peek_commands(redis_conn, queue_name, count=1):
+    """
+    get the (up to) count command_dicts to be popped next from queue
+    """
+    result = redis_conn.lrange(queue_name, 0, count - 1)
+    return [decode_command(item) for item in result]
 
 
 def pubsub_listen(pubsub):
@@ -78,5 +334,5 @@ def pubsub_listen(pubsub):
 
         # assume we subscribed and throw away anything other than messages
         if raw_message is not None and raw_message['type'] == 'message':
-            message_dict = json_loads_datetime(raw_message['data'])
+            message_dict = decode_command(raw_message['data'])
             yield message_dict
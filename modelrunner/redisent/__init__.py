@@ -8,4 +8,10 @@ If more functionality is needed, see
 [rom](http://pythonhosted.org/rom/)
 """
 
-from .entity import RedisEntity  # noqa
+from .entity import (  # noqa
+    RedisEntity,
+    RedisEntityBatch,
+    STORAGE_BLOB,
+    STORAGE_HASH
+)
+from .codec import JSONCodec, MsgpackCodec, get_codec  # noqa
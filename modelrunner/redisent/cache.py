@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+In-process cache of entities for redisent (see RedisEntity.enable_cache)
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+
+class RedisEntityCache(object):
+    """
+    Bounded LRU cache of entities where entries expire after ttl seconds
+
+    Thread safe.  Entities are copied in and out of the cache so that
+    callers modifying an entity do not modify the cached entity.  The
+    stored json of an entity may be cached along with it (see get_json).
+
+    Invalidations bump a generation counter so that a reader can avoid
+    caching a value it read before a concurrent invalidation, e.g.:
+
+    >>> generation = cache.generation
+    >>> entity = read_from_redis(key)
+    >>> cache.put(key, entity, generation)
+    """
+
+    def __init__(self, size=1000, ttl=60):
+        """
+        Args:
+            size (int):  max number of entities to cache
+            ttl (float):  seconds an entity may be served from the cache
+        """
+        self.size = size
+        self.ttl = ttl
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns:
+            copy of the cached entity for key or None if not cached
+        """
+        entry = self._get_entry(key)
+        return copy.copy(entry[1]) if entry is not None else None
+
+    def get_json(self, key):
+        """
+        Returns:
+            the cached json of the entity for key or None if not cached
+            (or cached without its json)
+        """
+        entry = self._get_entry(key, with_json=True)
+        return entry[2] if entry is not None else None
+
+    def _get_entry(self, key, with_json=False):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.time():
+                del self._entries[key]
+                entry = None
+            if entry is None or (with_json and entry[2] is None):
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, entity, generation=None, json=None):
+        """
+        Cache entity for key
+
+        Args:
+            generation (int):  value of self.generation before entity was
+                read, if there were invalidations since, entity is not cached
+            json (str):  the stored json of entity (if read, see get_json)
+        """
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+
+            self._entries[key] = (
+                time.time() + self.ttl, copy.copy(entity), json)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, keys):
+        with self._lock:
+            self.generation += 1
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Codecs for serializing entities (and their attribute values) to redis
+
+A codec has:
+- dumps(value):  serialize a dict or attribute value
+- loads(data):  deserialize what dumps serialized
+- binary:  whether serialized data is bytes rather than a (utf-8) str
+
+See RedisEntity._codec
+"""
+import calendar
+import datetime
+import json
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class EntityJSONEncoder(json.JSONEncoder):
+    """
+    Encode entities (via their __dict__) and datetimes (as isoformat)
+    """
+    def default(self, obj):
+        if isinstance(obj, datetime.datetime):
+            return obj.isoformat()
+        if hasattr(obj, '__dict__'):
+            return obj.__dict__
+        return json.JSONEncoder.default(self, obj)
+
+
+class JSONCodec(object):
+    """
+    Serialize as json strings
+
+    datetimes are stored as isoformat strings and loaded as strings
+    (entity constructors are expected to convert them)
+    """
+
+    name = "json"
+    binary = False
+
+    def dumps(self, value):
+        return json.dumps(value, cls=EntityJSONEncoder)
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class MsgpackCodec(object):
+    """
+    Serialize as msgpack bytes (requires the msgpack package)
+
+    datetimes are stored as microseconds since the epoch (naive datetimes
+    are assumed to be utc) and loaded as naive utc datetimes
+    """
+
+    name = "msgpack"
+    binary = True
+
+    # msgpack extension type code for datetimes
+    DATETIME_TYPE = 1
+
+    def __init__(self):
+        assert msgpack is not None, "MsgpackCodec requires msgpack"
+
+    def dumps(self, value):
+        return msgpack.packb(value, default=self._default, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, ext_hook=self._ext_hook, raw=False)
+
+    def _default(self, obj):
+        if isinstance(obj, datetime.datetime):
+            micros = calendar.timegm(obj.utctimetuple()) * 1000000 +\
+                obj.microsecond
+            return msgpack.ExtType(
+                self.DATETIME_TYPE,
+                struct.pack(">q", micros))
+        if hasattr(obj, '__dict__'):
+            return obj.__dict__
+        raise TypeError("Cannot serialize {!r}".format(obj))
+
+    def _ext_hook(self, code, data):
+        if code == self.DATETIME_TYPE:
+            micros = struct.unpack(">q", data)[0]
+            return datetime.datetime(1970, 1, 1) +\
+                datetime.timedelta(microseconds=micros)
+        return msgpack.ExtType(code, data)
+
+
+CODECS = {
+    JSONCodec.name: JSONCodec,
+    MsgpackCodec.name: MsgpackCodec
+}
+
+
+def get_codec(name):
+    """
+    Return a codec instance by name (one of CODECS)
+    """
+    if name not in CODECS:
+        raise ValueError(
+            "Unknown codec {}, must be one of {}".
+            format(name, ", ".join(sorted(CODECS))))
+    return CODECS[name]()
@@ -1,8 +1,26 @@
 # -*- coding: utf-8 -*-
 import json
 import datetime
+import calendar
 import re
 import six
+import time
+from uuid import uuid4
+from redis import StrictRedis
+from .cache import RedisEntityCache
+from .codec import JSONCodec
+
+
+# storage modes (see RedisEntity._storage)
+STORAGE_BLOB = "blob"
+STORAGE_HASH = "hash"
+
+# for encoding entities as json regardless of the configured codec
+_JSON_CODEC = JSONCodec()
+
+# number of keys of the order index checked at a time when paging by a
+# single criterion (see RedisEntityMeta._scan_page_keys)
+PAGE_SCAN_BATCH = 1000
 
 
 class RedisEntityMeta(type):
@@ -12,39 +30,885 @@ class RedisEntityMeta(type):
     Meta class was needed to implement class level 'magic' methods
     """
     def __setitem__(cls, key, entity):
-        json_entity = json.dumps(entity, cls=cls.json_encoder())
-        cls._db.hset(cls.hash_name(), key, json_entity)
+        cls.set_many({key: entity})
 
     def __delitem__(cls, key):
-        cls._db.hdel(cls.hash_name(), key)
+        cls.delete_many([key])
 
     def __getitem__(cls, key):
-        json_entity = cls._db.hget(cls.hash_name(), key)
-        if json_entity is None:
+        entity = cls.get_many([key])[0]
+        if entity is None:
             raise KeyError(
                 "Key {} does not exist in {}".
                 format(key, cls.hash_name()))
         else:
-            return json.loads(json_entity, object_hook=cls.json_decode)
+            return entity
 
     def keys(cls):
+        if cls._storage == STORAGE_HASH:
+            return list(cls._db.smembers(cls.keys_name()))
         return cls._db.hkeys(cls.hash_name())
 
     def __len__(cls):
+        if cls._storage == STORAGE_HASH:
+            return cls._db.scard(cls.keys_name())
         return cls._db.hlen(cls.hash_name())
 
+    def get_many(cls, keys):
+        """
+        Get the entities for keys in one round trip
+
+        Returns:
+            list of entities in the order of keys (None for missing keys)
+        """
+        keys = list(keys)
+        if len(keys) == 0:
+            return []
+
+        if cls._cache is None:
+            return [cls._decode(stored) if stored is not None else None
+                    for stored in cls._fetch(keys)]
+
+        entities = [cls._cache.get(key) for key in keys]
+        missing = [i for i, entity in enumerate(entities) if entity is None]
+        if len(missing) > 0:
+            generation = cls._cache.generation
+            fetched = cls._fetch([keys[i] for i in missing])
+            for i, stored in zip(missing, fetched):
+                if stored is not None:
+                    entities[i] = cls._decode(stored)
+                    cls._cache.put(keys[i], entities[i], generation)
+
+        return entities
+
+    def get_json_many(cls, keys):
+        """
+        Get the entities for keys as json strings in one round trip
+
+        With the json codec, stored entities are passed through as is
+        rather than decoded into entities only to be encoded again (so
+        the json reflects what is stored, not what the entity class
+        constructs from it).  With the cache enabled, the stored json is
+        cached along with the entity, so it is the same whether or not
+        it is served from the cache.
+
+        Returns:
+            list of json strings in the order of keys (None for missing keys)
+        """
+        keys = list(keys)
+        if len(keys) == 0:
+            return []
+
+        if cls._cache is None:
+            return [cls._stored_json(stored) if stored is not None else None
+                    for stored in cls._fetch(keys)]
+
+        json_entities = [cls._cache.get_json(key) for key in keys]
+        missing = [i for i, json_entity in enumerate(json_entities)
+                   if json_entity is None]
+        if len(missing) > 0:
+            generation = cls._cache.generation
+            fetched = cls._fetch([keys[i] for i in missing])
+            for i, stored in zip(missing, fetched):
+                if stored is not None:
+                    json_entities[i] = cls._stored_json(stored)
+                    cls._cache.put(
+                        keys[i], cls._decode(stored), generation,
+                        json=json_entities[i])
+
+        return json_entities
+
+    def get_json(cls, key):
+        """
+        Get the entity for key as a json string (see get_json_many)
+            KeyError if there is no entity for key
+        """
+        json_entity = cls.get_json_many([key])[0]
+        if json_entity is None:
+            raise KeyError(
+                "Key {} does not exist in {}".
+                format(key, cls.hash_name()))
+        return json_entity
+
+    def set_many(cls, entities, also=None):
+        """
+        Write entities (and their index entries) in one transaction
+
+        Args:
+            entities (dict):  key -> entity
+                (or an iterable of (key, entity) pairs)
+            also (function):  also(pipe) queues more commands on the
+                transaction's pipeline (e.g. to queue work for entities
+                only if, and as soon as, they are written)
+        """
+        entities = dict(entities)
+        if len(entities) == 0:
+            return
+
+        encoded = {key: cls._encode(entity)
+                   for key, entity in entities.items()}
+
+        def write(pipe):
+            old_values = cls._fetch_index_values(entities.keys())
+            pipe.multi()
+            cls._write_stored(pipe, encoded)
+            for key, entity in entities.items():
+                cls._remove_from_indexes(pipe, key, old_values[key])
+                cls._add_to_indexes(pipe, key, vars(entity))
+            cls._bump_versions(pipe, entities.keys())
+            cls._publish_written(pipe, entities.keys())
+            if also is not None:
+                also(pipe)
+
+        cls._transaction(write, entities.keys())
+        cls._invalidate_cached(entities.keys())
+
+    def delete_many(cls, keys):
+        """
+        Delete the entities for keys (and their index entries) in one
+        transaction
+        """
+        keys = list(keys)
+        if len(keys) == 0:
+            return
+
+        def delete(pipe):
+            old_values = cls._fetch_index_values(keys)
+            pipe.multi()
+            cls._delete_stored(pipe, keys)
+            for key in keys:
+                cls._remove_from_indexes(pipe, key, old_values[key])
+            if cls._order_by is not None:
+                pipe.zrem(cls.order_index_name(), *keys)
+            cls._bump_versions(pipe, keys, deleted=True)
+            cls._publish_written(pipe, keys)
+
+        cls._transaction(delete, keys)
+        cls._invalidate_cached(keys)
+
+    def update(cls, key, **values):
+        """
+        Atomically update only the given attributes of the entity for key
+
+        e.g. Job.update(job.uuid, status=Job.STATUS_RUNNING)
+
+        With STORAGE_HASH only the given attributes are sent to redis,
+        otherwise the stored entity is read, modified and written back
+        (in both cases concurrent updates of other attributes are kept)
+
+        Raises:
+            KeyError if there is no entity for key
+        """
+        cls.update_if(key, None, **values)
+
+    def update_if(cls, key, expected, **values):
+        """
+        Atomically update the given attributes of the entity for key only
+        if its stored attributes have one of the expected values
+
+        e.g. Job.update_if(job.uuid, {'status': [Job.STATUS_QUEUED]},
+                           status=Job.STATUS_KILLED)
+
+        Args:
+            expected (dict):  attribute -> list of allowed values
+                (None to update unconditionally, see update)
+
+        Returns:
+            whether the entity was updated
+
+        Raises:
+            KeyError if there is no entity for key
+        """
+        expected = expected or {}
+        # set within write which may be retried
+        updated = [False]
+
+        def write(pipe):
+            updated[0] = False
+            if cls._storage == STORAGE_HASH:
+                entity_name = cls.entity_name(key)
+                if not pipe.exists(entity_name):
+                    raise KeyError(
+                        "Key {} does not exist in {}".
+                        format(key, cls.hash_name()))
+                if expected:
+                    attrs = list(expected)
+                    current_values = {
+                        attr: cls._codec.loads(value)
+                        if value is not None else None
+                        for attr, value in
+                        zip(attrs, pipe.hmget(entity_name, attrs))}
+                    if not cls._matches(current_values, expected):
+                        return
+                old_values = cls._fetch_index_values([key])[key]
+                pipe.multi()
+                pipe.hset(
+                    entity_name,
+                    mapping={attr: cls._codec.dumps(value)
+                             for attr, value in values.items()})
+            else:
+                stored = pipe.hget(cls.hash_name(), key)
+                if stored is None:
+                    raise KeyError(
+                        "Key {} does not exist in {}".
+                        format(key, cls.hash_name()))
+                entity = cls._decode(stored)
+                old_values = cls._codec.loads(stored)
+                if not cls._matches(old_values, expected):
+                    return
+                for attr, value in values.items():
+                    setattr(entity, attr, value)
+                pipe.multi()
+                pipe.hset(cls.hash_name(), key, cls._encode(entity))
+                pipe.incr(cls.written_name(key))
+
+            changed_values = {attr: old_values.get(attr)
+                              for attr in values}
+            cls._remove_from_indexes(pipe, key, changed_values)
+            cls._add_to_indexes(pipe, key, values)
+            cls._bump_versions(pipe, [key])
+            cls._publish_written(pipe, [key])
+            updated[0] = True
+
+        cls._value_db().transaction(write, *cls._watch_names([key]))
+        if updated[0]:
+            cls._invalidate_cached([key])
+        return updated[0]
+
+    def get_fields(cls, key, *attrs):
+        """
+        Get only the given attributes of the entity for key
+
+        With STORAGE_HASH only the given attributes are read from redis
+        (values are returned as loaded by the codec, e.g. datetimes are
+        strings with JSONCodec)
+
+        Returns:
+            dict of attribute -> value
+
+        Raises:
+            KeyError if there is no entity for key
+        """
+        if cls._storage == STORAGE_HASH:
+            pipe = cls._value_db().pipeline(transaction=False)
+            pipe.exists(cls.entity_name(key))
+            pipe.hmget(cls.entity_name(key), attrs)
+            exists, stored_values = pipe.execute()
+            if not exists:
+                raise KeyError(
+                    "Key {} does not exist in {}".
+                    format(key, cls.hash_name()))
+            return {attr: cls._codec.loads(value)
+                    if value is not None else None
+                    for attr, value in zip(attrs, stored_values)}
+
+        entity = cls[key]
+        return {attr: getattr(entity, attr, None) for attr in attrs}
+
+    def version(cls, key=None):
+        """
+        Return the number of writes to the entity for key (or to any
+        entity if key is None), e.g. to tell whether entities changed
+        since they were last read
+
+        Versions of entities are dropped when they are deleted (so an
+        entity written again after being deleted starts over at 1)
+
+        Requires _versioned
+        """
+        assert cls._versioned,\
+            "{} does not set _versioned".format(cls.__name__)
+        if key is None:
+            version = cls._db.get(cls.version_name())
+        else:
+            version = cls._db.hget(cls.versions_name(), key)
+        return int(version) if version is not None else 0
+
+    def enable_cache(cls, size=1000, ttl=60):
+        """
+        Serve reads of entities by key (__getitem__, get_many) from an
+        in-process LRU cache
+
+        Cached entities are dropped when written by this process and, via
+        the invalidation channel, when written by other processes (so the
+        class must set _publish_writes).  ttl bounds how stale an entity
+        can be if invalidations are missed (e.g. on a lost connection).
+
+        Args:
+            size (int):  max number of entities to cache
+            ttl (float):  seconds an entity may be served from the cache
+        """
+        assert cls._publish_writes,\
+            "{} does not set _publish_writes".format(cls.__name__)
+
+        cache = RedisEntityCache(size=size, ttl=ttl)
+
+        def handle_invalidation(message):
+            cache.invalidate(json.loads(message['data']))
+
+        def handle_exception(e, pubsub, worker_thread):
+            # invalidations may have been missed while disconnected
+            cache.clear()
+            time.sleep(1)
+
+        pubsub = cls._db.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(
+            **{cls.invalidation_channel_name(): handle_invalidation})
+        cls._cache_listener = pubsub.run_in_thread(
+            sleep_time=1,
+            daemon=True,
+            exception_handler=handle_exception)
+        cls._cache = cache
+
+    def disable_cache(cls):
+        if cls._cache_listener is not None:
+            cls._cache_listener.stop()
+        cls._cache_listener = None
+        cls._cache = None
+
+    def batch(cls, size=1000):
+        """
+        Return a RedisEntityBatch buffering writes to this class, e.g.:
+
+        >>> with Job.batch() as batch:
+        ...     for job in jobs:
+        ...         batch[job.uuid] = job
+        """
+        return RedisEntityBatch(cls, size=size)
+
     def items(cls):
-        items = cls._db.hgetall(cls.hash_name()).items()
-        items = [(key, json.loads(entity, object_hook=cls.json_decode))
+        if cls._storage == STORAGE_HASH:
+            return list(cls.iter_items())
+        items = cls._value_db().hgetall(cls.hash_name()).items()
+        items = [(_to_str(key), cls._decode(entity))
                  for key, entity in items]
         return items
 
     def values(cls):
-        values = cls._db.hgetall(cls.hash_name()).values()
-        values = [json.loads(entity, object_hook=cls.json_decode)
-                  for entity in values]
+        if cls._storage == STORAGE_HASH:
+            return list(cls.iter_values())
+        values = cls._value_db().hgetall(cls.hash_name()).values()
+        values = [cls._decode(entity) for entity in values]
         return values
 
+    def iter_items(cls, batch=1000):
+        """
+        Generate (key, entity) pairs via HSCAN (SSCAN of the keys for
+        STORAGE_HASH)
+
+        Entities are fetched batch (approximately) at a time and decoded
+        lazily so that neither the client nor redis has to hold the whole
+        hash at once (an entity modified during iteration may be returned
+        more than once)
+        """
+        if cls._storage == STORAGE_HASH:
+            keys = []
+            for key in cls._db.sscan_iter(cls.keys_name(), count=batch):
+                keys.append(key)
+                if len(keys) == batch:
+                    for item in cls._iter_fetched(keys):
+                        yield item
+                    keys = []
+            for item in cls._iter_fetched(keys):
+                yield item
+        else:
+            for key, stored in cls._value_db().hscan_iter(
+                    cls.hash_name(), count=batch):
+                yield _to_str(key), cls._decode(stored)
+
+    def iter_values(cls, batch=1000):
+        """
+        Generate entities via HSCAN (see iter_items)
+        """
+        for key, entity in cls.iter_items(batch=batch):
+            yield entity
+
+    def find_keys(cls, **criteria):
+        """
+        Return the keys of entities whose indexed attributes match criteria
+
+        e.g. Job.find_keys(status="RUNNING", model="test")
+        """
+        assert len(criteria) > 0, "find requires at least one criterion"
+        index_names = [cls.index_name(attr, value)
+                       for attr, value in criteria.items()]
+        return list(cls._db.sinter(index_names))
+
+    def find(cls, **criteria):
+        """
+        Return entities whose indexed attributes match criteria
+
+        Only the matching entities are read from redis
+        """
+        return cls._get_existing(cls.find_keys(**criteria))
+
+    def count(cls, **criteria):
+        """
+        Return the number of entities matching criteria (all if None)
+        """
+        if len(criteria) == 0:
+            return len(cls)
+        if len(criteria) == 1:
+            attr, value = list(criteria.items())[0]
+            return cls._db.scard(cls.index_name(attr, value))
+        return len(cls.find_keys(**criteria))
+
+    def page(cls, offset=0, limit=None, descending=True, **criteria):
+        """
+        Return a list of entities ordered by the _order_by attribute
+
+        Only the requested page is read from redis, so the cost does not
+        depend on the total number of entities
+
+        Args:
+            offset (int):  number of entities to skip
+            limit (int):  max number of entities to return (None for all)
+            descending (bool):  whether to return largest values first
+            criteria:  indexed attribute values entities must match
+        """
+        return cls._get_existing(
+            cls.page_keys(offset, limit, descending, **criteria))
+
+    def page_json(cls, offset=0, limit=None, descending=True, **criteria):
+        """
+        Return a page of entities (see page) as json strings
+
+        See get_json_many
+        """
+        json_entities = cls.get_json_many(
+            cls.page_keys(offset, limit, descending, **criteria))
+        return [json_entity for json_entity in json_entities
+                if json_entity is not None]
+
+    def page_keys(cls, offset=0, limit=None, descending=True, **criteria):
+        """
+        Return the keys of a page of entities (see page)
+        """
+        assert cls._order_by is not None,\
+            "{} does not define _order_by".format(cls.__name__)
+
+        if len(criteria) == 1 and limit is not None:
+            attr, value = list(criteria.items())[0]
+            index_name = cls.index_name(attr, value)
+            pipe = cls._db.pipeline()
+            pipe.zcard(cls.order_index_name())
+            pipe.scard(index_name)
+            total, matching = pipe.execute()
+            if matching == 0:
+                return []
+            # walk the order index when matches are dense enough for the
+            # page to be found before checking as many keys as intersecting
+            # the indexes would (e.g. by model rather than a rare status)
+            if (offset + limit) * total <= matching * matching:
+                return cls._scan_page_keys(
+                    index_name, offset, limit, descending)
+
+        stop = -1 if limit is None else offset + limit - 1
+        order_index = cls.order_index_name()
+        pipe = cls._db.pipeline()
+        if len(criteria) > 0:
+            # intersect the order index with the matching value indexes
+            # (value index scores are weighted 0 to keep the order scores)
+            order_index = "{}:page:{}".format(cls.hash_name(), uuid4())
+            weights = {cls.order_index_name(): 1}
+            for attr, value in criteria.items():
+                weights[cls.index_name(attr, value)] = 0
+            pipe.zinterstore(order_index, weights)
+
+        if descending:
+            pipe.zrevrange(order_index, offset, stop)
+        else:
+            pipe.zrange(order_index, offset, stop)
+
+        if len(criteria) > 0:
+            pipe.delete(order_index)
+            return pipe.execute()[1]
+        return pipe.execute()[0]
+
+    def _scan_page_keys(cls, index_name, offset, limit, descending):
+        """
+        Return the keys of a page of entities in the value index index_name
+        by checking the keys of the order index in order until the page is
+        full (instead of intersecting the whole indexes, see page_keys)
+        """
+        keys = []
+        seen = set()
+        start = 0
+        while len(keys) < offset + limit:
+            stop = start + PAGE_SCAN_BATCH - 1
+            if descending:
+                batch = cls._db.zrevrange(cls.order_index_name(), start, stop)
+            else:
+                batch = cls._db.zrange(cls.order_index_name(), start, stop)
+            if len(batch) == 0:
+                break
+
+            # skip keys seen before entities added meanwhile shifted them
+            for key, is_member in zip(
+                    batch, cls._db.smismember(index_name, batch)):
+                if is_member and key not in seen:
+                    seen.add(key)
+                    keys.append(key)
+            start += len(batch)
+
+        return keys[offset:offset + limit]
+
+    def reindex(cls):
+        """
+        Rebuild the indexes of entities from the hash
+
+        Needed for entities written before the indexes existed
+        """
+        index_names = list(
+            cls._db.scan_iter(match="{}:index:*".format(cls.hash_name())))
+
+        if len(index_names) > 0:
+            cls._db.delete(*index_names)
+
+        pipe = cls._db.pipeline(transaction=False)
+        for i, (key, entity) in enumerate(cls.iter_items(), 1):
+            cls._add_to_indexes(pipe, key, vars(entity))
+            if i % 1000 == 0:
+                pipe.execute()
+        pipe.execute()
+
+    def migrate_storage(cls, from_storage, batch=1000):
+        """
+        Rewrite entities stored via from_storage to the class' _storage
+
+        e.g. after changing a class from STORAGE_BLOB to STORAGE_HASH:
+
+        >>> Job.migrate_storage(STORAGE_BLOB)
+
+        The old storage is removed once all entities have been rewritten
+        """
+        if from_storage == cls._storage:
+            return
+
+        source = cls.storage_view(from_storage)
+
+        with cls.batch(size=batch) as entity_batch:
+            for key, entity in source.iter_items(batch=batch):
+                entity_batch[key] = entity
+
+        # index entries are shared, so only remove the stored entities
+        keys = source.keys()
+        for i in range(0, len(keys), batch):
+            pipe = cls._value_db().pipeline()
+            source._delete_stored(pipe, keys[i:i + batch])
+            pipe.execute()
+
+    def storage_view(cls, storage):
+        """
+        Subclass reading and writing the same entities stored via storage
+        (e.g. to write entities in the layout migrate_storage expects)
+        """
+        return type(cls.__name__, (cls,), {
+            '_storage': storage,
+            '_custom_hash_name': cls.hash_name(),
+            '_cache': None})
+
+    def stored_via(cls, storage):
+        """
+        Whether any entities are stored via storage, e.g. to detect
+        entities not yet rewritten by migrate_storage
+        """
+        if storage == STORAGE_HASH:
+            return cls._value_db().exists(cls.keys_name()) > 0
+        return cls._value_db().exists(cls.hash_name()) > 0
+
+    def migrate_codec(cls, from_codec, batch=1000):
+        """
+        Rewrite entities serialized via from_codec with the class' _codec
+
+        e.g. after switching the class to MsgpackCodec:
+
+        >>> Job.migrate_codec(JSONCodec())
+
+        Entities are rewritten in place, so this should be run while
+        no other process is reading or writing entities of the class
+        """
+        # view of the same entities serialized via from_codec
+        source = type(cls.__name__, (cls,), {
+            '_codec': from_codec,
+            '_custom_hash_name': cls.hash_name(),
+            '_cache': None})
+
+        # attribute values (and so index entries) are unchanged
+        pipe = cls._value_db().pipeline(transaction=False)
+        for i, (key, entity) in enumerate(source.iter_items(batch=batch), 1):
+            cls._write_stored(pipe, {key: cls._encode(entity)})
+            if i % batch == 0:
+                pipe.execute()
+        pipe.execute()
+        cls._invalidate_cached(cls.keys())
+
+    def keys_name(cls):
+        """
+        Name of the set of entity keys (STORAGE_HASH only)
+        """
+        return "{}:keys".format(cls.hash_name())
+
+    def entity_name(cls, key):
+        """
+        Name of the hash holding the entity for key (STORAGE_HASH only)
+        """
+        return "{}:{}".format(cls.hash_name(), key)
+
+    def written_name(cls, key):
+        """
+        Name of the counter of writes to the entity for key, watched by
+        transactions instead of the whole hash (STORAGE_BLOB only)
+        """
+        return "{}:written:{}".format(cls.hash_name(), key)
+
+    def version_name(cls):
+        """
+        Name of the counter of writes to the class (_versioned only)
+        """
+        return "{}:version".format(cls.hash_name())
+
+    def versions_name(cls):
+        """
+        Name of the hash of per entity write counters (_versioned only)
+        """
+        return "{}:versions".format(cls.hash_name())
+
+    def invalidation_channel_name(cls):
+        """
+        Name of the channel keys of written entities are published on
+        (see _publish_writes)
+        """
+        return "{}:invalidations".format(cls.hash_name())
+
+    def order_index_name(cls):
+        return "{}:index:{}".format(cls.hash_name(), cls._order_by)
+
+    def index_name(cls, attr, value):
+        assert attr in cls._indexes,\
+            "{} is not an indexed attribute of {}".format(attr, cls.__name__)
+        return "{}:index:{}:{}".format(cls.hash_name(), attr, value)
+
+    def order_score(cls, value):
+        """
+        Convert an _order_by attribute value to a sorted set score
+
+        datetimes are scored as (utc) seconds since the epoch
+        """
+        if isinstance(value, datetime.datetime):
+            return calendar.timegm(value.utctimetuple()) +\
+                value.microsecond / 1e6
+        return float(value)
+
+    def _transaction(cls, write, keys):
+        """
+        Run write(pipe) as a transaction
+
+        When there are indexes to maintain, the stored entities for keys
+        are watched so that the values read by write are consistent with
+        what it writes
+        """
+        if cls._indexes:
+            cls._value_db().transaction(write, *cls._watch_names(keys))
+        else:
+            pipe = cls._value_db().pipeline()
+            write(pipe)
+            pipe.execute()
+
+    def _bump_versions(cls, pipe, keys, deleted=False):
+        """
+        Queue increments of the versions of keys and the class on pipe
+        (versions of deleted keys are dropped)
+        """
+        if not cls._versioned:
+            return
+        if deleted:
+            pipe.hdel(cls.versions_name(), *keys)
+        else:
+            for key in keys:
+                pipe.hincrby(cls.versions_name(), key, 1)
+        pipe.incr(cls.version_name())
+
+    def _publish_written(cls, pipe, keys):
+        if cls._publish_writes:
+            pipe.publish(
+                cls.invalidation_channel_name(),
+                json.dumps(list(keys)))
+
+    def _invalidate_cached(cls, keys):
+        if cls._cache is not None:
+            cls._cache.invalidate(keys)
+
+    def _value_db(cls):
+        """
+        Connection to read/write serialized entities with
+
+        Binary codecs need a connection that does not decode responses
+        """
+        if not cls._codec.binary:
+            return cls._db
+
+        if cls._raw_db is None or cls._raw_db[0] is not cls._db:
+            pool = cls._db.connection_pool
+            raw_pool = pool.__class__(
+                connection_class=pool.connection_class,
+                **dict(pool.connection_kwargs, decode_responses=False))
+            cls._raw_db = (cls._db, StrictRedis(connection_pool=raw_pool))
+        return cls._raw_db[1]
+
+    def _watch_names(cls, keys):
+        """
+        Names to watch for writes to the entities for keys (so that writes
+        to other entities do not conflict)
+        """
+        if cls._storage == STORAGE_HASH:
+            return [cls.entity_name(key) for key in keys]
+        return [cls.written_name(key) for key in keys]
+
+    def _encode(cls, entity):
+        """
+        Encode entity for storage
+
+        Returns:
+            serialized entity (STORAGE_BLOB) or
+            dict of attribute -> serialized value (STORAGE_HASH)
+        """
+        if cls._storage == STORAGE_HASH:
+            return {attr: cls._codec.dumps(value)
+                    for attr, value in vars(entity).items()}
+        return cls._codec.dumps(vars(entity))
+
+    def _decode(cls, stored):
+        """
+        Decode a stored entity (as returned by _fetch)
+        """
+        if cls._storage == STORAGE_HASH:
+            return cls.json_decode(
+                {_to_str(attr): cls._codec.loads(value)
+                 for attr, value in stored.items()})
+        return cls.json_decode(cls._codec.loads(stored))
+
+    def _stored_json(cls, stored):
+        """
+        Convert a stored entity (as returned by _fetch) to a json string
+        """
+        if cls._codec.name != JSONCodec.name:
+            return _JSON_CODEC.dumps(vars(cls._decode(stored)))
+
+        if cls._storage == STORAGE_HASH:
+            # attribute values are already json
+            return "{" + ", ".join(
+                json.dumps(attr) + ": " + value
+                for attr, value in stored.items()) + "}"
+        return stored
+
+    def _fetch(cls, keys):
+        """
+        Read the stored (encoded) entities for keys in one round trip
+
+        Returns:
+            list of stored entities in the order of keys (None if missing)
+        """
+        if cls._storage == STORAGE_HASH:
+            pipe = cls._value_db().pipeline(transaction=False)
+            for key in keys:
+                pipe.hgetall(cls.entity_name(key))
+            return [stored if len(stored) > 0 else None
+                    for stored in pipe.execute()]
+        return cls._value_db().hmget(cls.hash_name(), keys)
+
+    def _iter_fetched(cls, keys):
+        """
+        Generate (key, entity) pairs for those keys that still exist
+        """
+        if len(keys) == 0:
+            return
+        for key, stored in zip(keys, cls._fetch(keys)):
+            if stored is not None:
+                yield key, cls._decode(stored)
+
+    def _write_stored(cls, pipe, encoded):
+        """
+        Queue writes of encoded entities (dict of key -> encoded) on pipe
+        """
+        if cls._storage == STORAGE_HASH:
+            for key, stored in encoded.items():
+                pipe.hset(cls.entity_name(key), mapping=stored)
+            pipe.sadd(cls.keys_name(), *encoded.keys())
+        else:
+            pipe.hset(cls.hash_name(), mapping=encoded)
+            for key in encoded:
+                pipe.incr(cls.written_name(key))
+
+    def _delete_stored(cls, pipe, keys):
+        if cls._storage == STORAGE_HASH:
+            pipe.delete(*[cls.entity_name(key) for key in keys])
+            pipe.srem(cls.keys_name(), *keys)
+        else:
+            pipe.hdel(cls.hash_name(), *keys)
+            pipe.delete(*[cls.written_name(key) for key in keys])
+
+    def _fetch_index_values(cls, keys):
+        """
+        Read the indexed attribute values of the stored entities for keys
+
+        Returns:
+            dict of key -> dict of stored (loaded) attribute values
+        """
+        keys = list(keys)
+        if not cls._indexes:
+            return {key: {} for key in keys}
+
+        if cls._storage == STORAGE_HASH:
+            pipe = cls._value_db().pipeline(transaction=False)
+            for key in keys:
+                pipe.hmget(cls.entity_name(key), cls._indexes)
+            return {key: {attr: cls._codec.loads(value)
+                          for attr, value in zip(cls._indexes, stored_values)
+                          if value is not None}
+                    for key, stored_values in zip(keys, pipe.execute())}
+
+        stored_entities = cls._value_db().hmget(cls.hash_name(), keys)
+        return {key: cls._codec.loads(stored) if stored is not None else {}
+                for key, stored in zip(keys, stored_entities)}
+
+    def _add_to_indexes(cls, pipe, key, values):
+        """
+        Queue index entries for key on pipe
+
+        Args:
+            values (dict):  attribute -> value of (some of) the entity's
+                attributes, only those that are indexed are used
+        """
+        if cls._order_by in values:
+            pipe.zadd(
+                cls.order_index_name(),
+                {key: cls.order_score(values[cls._order_by])})
+        for attr in cls._indexes:
+            value = values.get(attr)
+            if value is not None:
+                pipe.sadd(cls.index_name(attr, value), key)
+
+    def _remove_from_indexes(cls, pipe, key, values):
+        for attr in cls._indexes:
+            value = values.get(attr)
+            if value is not None:
+                pipe.srem(cls.index_name(attr, value), key)
+
+    def _matches(cls, stored_values, expected):
+        """
+        Whether stored_values (attribute -> value) have one of the
+        expected values (attribute -> list of allowed values)
+        """
+        return all(stored_values.get(attr) in allowed
+                   for attr, allowed in expected.items())
+
+    def _get_existing(cls, keys):
+        """
+        Get the entities for keys, skipping any that no longer exist
+        """
+        return [entity for entity in cls.get_many(keys) if entity is not None]
+
     def hash_name(cls):
         if cls._custom_hash_name is not None:
             return cls._custom_hash_name
@@ -60,33 +924,10 @@ class RedisEntityMeta(type):
         else:
             return entity_snake_case
 
-    def json_encoder(cls):
-        """
-        Return a JSONEncoder that supports encoding classes of this object
-        Mainly done for datetime to isoformat conversion
-
-        override as needed
-        """
-        if hasattr(cls, '_json_encoder'):
-            return cls._json_encoder
-        else:
-            class RedisEntityEncoder(json.JSONEncoder):
-                """
-                Encode Entity as something that can be json serialized
-                """
-                def default(self, obj):
-                    if isinstance(obj, cls):
-                        return obj.__dict__
-                    if isinstance(obj, datetime.datetime):
-                        return obj.isoformat()
-                    return json.JSONEncoder.default(self, obj)
-
-            cls._json_encoder = RedisEntityEncoder
-            return RedisEntityEncoder
-
     def json_decode(cls, entity_dict):
         """
-        Decode an entity from a dict (useful for JSON decoding)
+        Decode an entity from a dict of its attributes (as loaded by
+        the codec)
 
         Assumes that each entity has an init that supports kwargs for setting
         its attributes
@@ -100,7 +941,8 @@ class RedisEntity():
 
     Exposes a mutable container interface for an entity
 
-    The class itself maps to a redis hash
+    The class itself maps to a redis hash (or with STORAGE_HASH, a set of
+    keys and a hash per entity)
 
     TODO:  Examples!
 
@@ -116,3 +958,91 @@ class RedisEntity():
 
     # allow subclasses to override the hash_name
     _custom_hash_name = None
+
+    # attribute to keep a sorted set index on (datetime or number)
+    # enables paging through entities in order via page
+    _order_by = None
+
+    # attributes to keep per value indexes on
+    # enables querying entities by attribute value via find
+    _indexes = ()
+
+    # how entities are stored, one of:
+    # STORAGE_BLOB:  one json string per entity in the class hash
+    # STORAGE_HASH:  one redis hash per entity with a json string per
+    #                attribute (allows reading/updating single attributes)
+    _storage = STORAGE_BLOB
+
+    # whether to publish the keys of written entities so that processes
+    # caching them (see enable_cache) can drop them
+    _publish_writes = False
+
+    # whether to count writes per entity and per class (see version)
+    _versioned = False
+
+    # in-process cache of entities (see enable_cache)
+    _cache = None
+    _cache_listener = None
+
+    # how entities are serialized (see codec module)
+    _codec = JSONCodec()
+
+    # connection that does not decode responses (for binary codecs)
+    _raw_db = None
+
+
+def _to_str(key):
+    """
+    keys read via a connection that does not decode responses are bytes
+    """
+    return key.decode('utf-8') if isinstance(key, bytes) else key
+
+
+class RedisEntityBatch(object):
+    """
+    Buffers writes and deletes of entities of a RedisEntity class so that
+    they are sent to redis in bulk (via set_many and delete_many)
+
+    Buffered operations are flushed when size operations are pending and
+    when used as a context manager, on exit
+    """
+
+    def __init__(self, entity_class, size=1000):
+        self.entity_class = entity_class
+        self.size = size
+        self._sets = {}
+        self._deletes = set()
+
+    def __setitem__(self, key, entity):
+        self._deletes.discard(key)
+        self._sets[key] = entity
+        self._flush_if_full()
+
+    def __delitem__(self, key):
+        self._sets.pop(key, None)
+        self._deletes.add(key)
+        self._flush_if_full()
+
+    def __len__(self):
+        return len(self._sets) + len(self._deletes)
+
+    def flush(self):
+        """
+        Send all pending writes and deletes to redis
+        """
+        self.entity_class.set_many(self._sets)
+        self.entity_class.delete_many(self._deletes)
+        self._sets = {}
+        self._deletes = set()
+
+    def _flush_if_full(self):
+        if len(self) >= self.size:
+            self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # only write what was buffered if the block succeeded
+        if exc_type is None:
+            self.flush()
@@ -7,9 +7,14 @@ from . import RedisEntity
 from redis import StrictRedis
 
 
-def initialize(redis_connection=None, prefix=None):
+def initialize(redis_connection=None, prefix=None, codec=None):
     """
     Must be called before using redisent package
+
+    Args:
+        redis_connection (StrictRedis):  connection to store entities via
+        prefix (str):  prefix of the names of all entity hashes
+        codec:  codec to serialize entities with (default JSONCodec)
     """
     assert isinstance(redis_connection, StrictRedis),\
         "redis_connection must be instance of StrictRedis"
@@ -17,3 +22,5 @@ def initialize(redis_connection=None, prefix=None):
     # can reference a pool
     RedisEntity._db = redis_connection
     RedisEntity._prefix = prefix
+    if codec is not None:
+        RedisEntity._codec = codec
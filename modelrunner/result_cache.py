@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Memoization of job results
+
+A job whose model, model command and input match those of a completed job
+is completed right away with links to that job's results instead of being
+run again (see ResultCache and PrimaryServer.enqueue_many)
+"""
+import hashlib
+import logging
+import os
+import shutil
+import time
+from .settings import redis_connection, result_cache_name
+from . import Job
+
+logger = logging.getLogger('modelrunner')
+
+# files holding the results of a completed job (in its primary data dir)
+RESULT_FILES = ("output.zip", "job_log.txt")
+
+
+def file_digest(path, chunk_size=2**20):
+    """
+    sha256 hex digest of the content of the file at path
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file_handle:
+        for chunk in iter(lambda: file_handle.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ResultCache(object):
+    """
+    Index of completed jobs by cache key (see key) kept in redis
+
+    Only the max_entries most recently used jobs are indexed, less recently
+    used ones are evicted from the index (their results are kept with the
+    job).  Hits, misses and evictions are counted (see stats)
+    """
+
+    def __init__(self, model_commands=None, max_entries=10000):
+        """
+        model_commands:  command of each model (see config model_command),
+            so that results are not reused once the command of their model
+            changes
+        """
+        self.model_commands = model_commands or {}
+        self.max_entries = max_entries
+
+    def key(self, model, input_digest):
+        """
+        cache key of jobs of model whose input has input_digest (see
+        file_digest)
+        """
+        identity = "\0".join(
+            [model, self.model_commands.get(model, ""), input_digest])
+        return hashlib.sha256(identity.encode('utf-8')).hexdigest()
+
+    def lookup(self, key):
+        """
+        Returns:
+            the completed job indexed by key (None if there is none or its
+            results were removed)
+        """
+        redis_conn = redis_connection()
+        job_uuid = redis_conn.hget(result_cache_name(), key)
+        job = None
+        if job_uuid is not None:
+            try:
+                job = Job[job_uuid]
+            except KeyError:
+                pass
+
+        if job is not None and job.status == Job.STATUS_COMPLETE and\
+                all(os.path.exists(path) for path in self._result_paths(job)):
+            pipe = redis_conn.pipeline()
+            pipe.zadd(result_cache_name("used"), {key: time.time()})
+            pipe.hincrby(result_cache_name("stats"), "hits", 1)
+            pipe.execute()
+            return job
+
+        if job_uuid is not None:
+            logger.info("results of cached job {} are gone".format(job_uuid))
+            self._remove(redis_conn, [key])
+        redis_conn.hincrby(result_cache_name("stats"), "misses", 1)
+        return None
+
+    def add(self, job):
+        """
+        Index the completed job by its cache_key (evicting the least
+        recently used jobs beyond max_entries)
+        """
+        redis_conn = redis_connection()
+        pipe = redis_conn.pipeline()
+        pipe.hset(result_cache_name(), job.cache_key, job.uuid)
+        pipe.zadd(result_cache_name("used"), {job.cache_key: time.time()})
+        pipe.zcard(result_cache_name("used"))
+        excess = pipe.execute()[-1] - self.max_entries
+        if excess > 0:
+            evicted = redis_conn.zrange(result_cache_name("used"), 0, excess - 1)
+            self._remove(redis_conn, evicted, stat="evictions")
+
+    def link_results(self, cached_job, job_data_dir):
+        """
+        Link the result files of cached_job into job_data_dir (copy them if
+        they cannot be linked, e.g. across file systems)
+        """
+        for path in self._result_paths(cached_job):
+            linked_path = os.path.join(job_data_dir, os.path.basename(path))
+            try:
+                os.link(path, linked_path)
+            except OSError:
+                shutil.copyfile(path, linked_path)
+
+    def stats(self):
+        """
+        Returns:
+            dict of the number of hits, misses and evictions and of the
+            indexed jobs (entries)
+        """
+        redis_conn = redis_connection()
+        stats = redis_conn.hgetall(result_cache_name("stats"))
+        stats_dict = {stat: int(stats.get(stat, 0))
+                      for stat in ("hits", "misses", "evictions")}
+        stats_dict['entries'] = redis_conn.hlen(result_cache_name())
+        return stats_dict
+
+    def _result_paths(self, job):
+        job_data_dir = os.path.join(job.primary_data_dir, job.uuid)
+        return [os.path.join(job_data_dir, name) for name in RESULT_FILES]
+
+    def _remove(self, redis_conn, keys, stat=None):
+        """
+        Remove keys from the index (counting them as stat if given)
+        """
+        if len(keys) == 0:
+            return
+        pipe = redis_conn.pipeline()
+        pipe.hdel(result_cache_name(), *keys)
+        pipe.zrem(result_cache_name("used"), *keys)
+        if stat is not None:
+            pipe.hincrby(result_cache_name("stats"), stat, len(keys))
+        pipe.execute()
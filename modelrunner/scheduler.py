@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Runtime aware scheduling of jobs
+
+The run times of processed jobs are regressed on their input size per model
+(see record_runtime), so that the run time of a job being queued can be
+estimated and a short one put in the short lane of its model, which
+workers pop from before the normal priority queue (see Job.QUEUE_ORDER and
+RuntimeScheduler)
+"""
+import datetime
+from .settings import redis_connection, command_transport, runtime_stats_name
+from .redis_utils import lua_script
+from . import Job
+
+# fields of the runtime stats hash:  weighted sums of 1, x, y, x*x and x*y
+# with x the input size in MB and y the run time in seconds
+_STATS_FIELDS = ("n", "x", "y", "xx", "xy")
+
+# decay the sums and add a sample
+# KEYS:  runtime stats of model
+# ARGV:  decay, x, y
+_RECORD_RUNTIME = lua_script("""
+local decay = tonumber(ARGV[1])
+local x = tonumber(ARGV[2])
+local y = tonumber(ARGV[3])
+local sums = redis.call('HMGET', KEYS[1], 'n', 'x', 'y', 'xx', 'xy')
+local samples = {1, x, y, x * x, x * y}
+local fields = {'n', 'x', 'y', 'xx', 'xy'}
+for i, field in ipairs(fields) do
+    local sum = (tonumber(sums[i]) or 0) * decay + samples[i]
+    redis.call('HSET', KEYS[1], field, tostring(sum))
+end
+return 1
+""")
+
+
+def record_runtime(redis_conn, job, run_seconds, decay=0.99):
+    """
+    Add the run time of a processed job to the runtime stats of its model
+
+    Older samples are weighed down by decay per sample, so that estimates
+    follow changes of the model (a weight of 1/2 after about 70 samples by
+    default)
+    """
+    _RECORD_RUNTIME(
+        keys=[runtime_stats_name(job.model)],
+        args=[decay, float(job.input_size or 0) / 2**20, run_seconds],
+        client=redis_conn)
+
+
+class RuntimeEstimate(object):
+    """
+    Run time of jobs of a model as a linear function of their input size
+    (least squares fit of the runtime stats)
+    """
+
+    def __init__(self, n=0, x=0, y=0, xx=0, xy=0):
+        self.samples = n
+        denominator = n * xx - x * x
+        # all samples of (about) the same size
+        self.slope = (n * xy - x * y) / denominator\
+            if denominator > 1e-9 * n * n else 0
+        self.intercept = (y - self.slope * x) / n if n > 0 else 0
+
+    @classmethod
+    def get(cls, redis_conn, model):
+        stats = redis_conn.hmget(runtime_stats_name(model), _STATS_FIELDS)
+        return cls(*[float(value or 0) for value in stats])
+
+    def seconds(self, input_size):
+        """
+        Estimated seconds a job with input_size bytes of input runs for
+        """
+        return max(0, self.intercept + self.slope * input_size / 2**20)
+
+
+class RuntimeScheduler(object):
+    """
+    Chooses the queue of jobs being queued (see PrimaryServer.enqueue_many)
+
+    Normal priority jobs expected to run at most short_job_seconds go to the
+    short lane of their model, which workers pop from first, so that small
+    jobs need not wait behind big ones.  Jobs are estimated once their model
+    has min_samples runtime samples (decayed, see record_runtime).
+
+    To not starve big jobs, jobs go to the normal queue (behind the big
+    ones) while the job next in it has waited for more than max_short_wait
+    seconds.  Jobs that are no longer queued (i.e. killed jobs whose
+    commands are left in the queue) are skipped, up to PEEK_COUNT of them.
+    """
+
+    # max number of commands at the head of the normal queue to look at for
+    # the job next in it
+    PEEK_COUNT = 100
+
+    def __init__(self, short_job_seconds=60, max_short_wait=600,
+                 min_samples=10):
+        self.short_job_seconds = short_job_seconds
+        self.max_short_wait = max_short_wait
+        self.min_samples = min_samples
+
+    def queue_names(self, jobs):
+        """
+        Estimate the run time of jobs (setting their expected_seconds)
+
+        Returns:
+            list of the names of the queues to queue jobs on
+        """
+        redis_conn = redis_connection()
+        estimates = {}
+        short_lane_open = {}
+        names = []
+        for job in jobs:
+            if job.priority != Job.PRIORITY_NORMAL:
+                names.append(Job.queue_name(job.model, job.priority))
+                continue
+
+            if job.model not in estimates:
+                estimates[job.model] = RuntimeEstimate.get(
+                    redis_conn, job.model)
+                short_lane_open[job.model] =\
+                    self._oldest_wait(redis_conn, job.model) <=\
+                    self.max_short_wait
+            estimate = estimates[job.model]
+            if estimate.samples < self.min_samples:
+                names.append(Job.queue_name(job.model))
+                continue
+
+            job.expected_seconds = estimate.seconds(job.input_size)
+            if short_lane_open[job.model] and\
+                    job.expected_seconds <= self.short_job_seconds:
+                names.append(Job.queue_name(job.model, Job.LANE_SHORT))
+            else:
+                names.append(Job.queue_name(job.model))
+
+        return names
+
+    def _oldest_wait(self, redis_conn, model):
+        """
+        Seconds the job next in the normal queue of model has waited for
+        (0 if there is none)
+        """
+        command_dicts = command_transport().peek_commands(
+            redis_conn, Job.queue_name(model), count=self.PEEK_COUNT)
+        for job in Job.get_many(
+                command_dict['job_uuid'] for command_dict in command_dicts):
+            if job is not None and job.status == Job.STATUS_QUEUED:
+                return (datetime.datetime.utcnow() -
+                        job.created).total_seconds()
+        return 0
@@ -3,18 +3,30 @@
 Functions and classes supporting tornado based web server for modelrunner
 """
 
-from six.moves.urllib_parse import urlparse
+from six.moves.urllib_parse import urlparse, urlencode
+import collections
 import json
 import datetime
+import logging
 import time
 
 import tornado
 import tornado.web
 import tornado.gen
+import tornado.concurrent
+import tornado.ioloop
+import tornado.queues
+from tornado.iostream import StreamClosedError
 
 from concurrent.futures import ThreadPoolExecutor
 
 from . import (Job, Node)
+from .admission import AdmissionRejected
+from .redis_utils import decode_command
+from .utils import url_content_length
+from .settings import redis_connection, job_events_channel_name
+
+logger = logging.getLogger('modelrunner')
 
 # Thread Pool used to handle handle large file uploads in parallel
 # TODO:  Research more scalable methods
@@ -41,6 +53,170 @@ class DateTimeEncoder(json.JSONEncoder):
             return super(DateTimeEncoder, self).default(obj)
 
 
+def get_page_arguments(handler, page_size):
+    """
+    Get the offset and limit paging arguments from a request
+
+    Args:
+        handler (tornado.web.RequestHandler):  handler of the request
+        page_size (int):  limit to use if none is requested
+
+    Returns:
+        (offset, limit) tuple of ints
+    """
+    try:
+        offset = int(handler.get_argument('offset', 0))
+        limit = int(handler.get_argument('limit', page_size))
+    except ValueError:
+        raise tornado.web.HTTPError(400, "offset and limit must be integers")
+
+    if offset < 0 or limit < 1:
+        raise tornado.web.HTTPError(400, "offset or limit out of range")
+
+    return offset, limit
+
+
+def get_job_criteria(handler):
+    """
+    Get the job attribute values to filter jobs by from a request
+
+    Only indexed Job attributes are supported (e.g. status, model)
+    """
+    return {attr: handler.get_argument(attr)
+            for attr in Job._indexes
+            if handler.get_argument(attr, None) is not None}
+
+
+def admit_jobs(handler, admission, jobs, input_bytes=0):
+    """
+    Check whether jobs may be queued (see AdmissionControl) and, if not,
+    respond with the rejection's status (429 or 503) and Retry-After
+
+    Args:
+        admission (modelrunner.admission.AdmissionControl):  None to admit
+            all jobs
+        input_bytes (int or list of int):  bytes of the input of each job
+            (or of all jobs, 0 if not known)
+
+    Returns:
+        whether the jobs were admitted
+    """
+    if admission is None:
+        return True
+
+    if not isinstance(input_bytes, list):
+        input_bytes = [input_bytes] * len(jobs)
+    counts = collections.Counter()
+    model_bytes = collections.Counter()
+    for job, job_bytes in zip(jobs, input_bytes):
+        counts[job.model] += 1
+        model_bytes[job.model] += job_bytes
+    try:
+        for model, count in counts.items():
+            admission.check(
+                model, jobs=count, input_bytes=model_bytes[model])
+    except AdmissionRejected as e:
+        logger.info("jobs rejected:  {}".format(e))
+        handler.set_status(e.status_code)
+        handler.set_header("Retry-After", str(e.retry_after))
+        handler.write({'message': "Error:  {}".format(e)})
+        handler.finish()
+        return False
+    return True
+
+
+@tornado.gen.coroutine
+def url_input_bytes(admission, urls):
+    """
+    Bytes of the input at each of urls, looked up (via HEAD requests) only
+    if admission checks them (0 if not, see AdmissionControl.limits_input)
+    """
+    if admission is None or not admission.limits_input():
+        raise tornado.gen.Return([0] * len(urls))
+
+    sizes = yield THREAD_POOL.submit(
+        lambda: {url: url_content_length(url) for url in set(urls)})
+    raise tornado.gen.Return([sizes[url] for url in urls])
+
+
+def check_version_etag(handler, *versions):
+    """
+    Set the Etag of a response from the versions (see RedisEntity.version)
+    of what it is built from and, if the request's If-None-Match matches,
+    respond 304 (without having to read or write the response body)
+
+    Returns:
+        whether the 304 response was sent
+    """
+    handler.set_header(
+        "Etag",
+        '"{}"'.format("-".join(str(version) for version in versions)))
+    if handler.check_etag_header():
+        handler.set_status(304)
+        handler.finish()
+        return True
+    return False
+
+
+class JobEventListener(object):
+    """
+    Shares one subscription to the job events channel (see
+    Job.publish_status) among all the handlers of a web server
+
+    Events are received on a thread and passed to the listeners on the
+    IOLoop, so listeners must not block
+    """
+
+    def __init__(self, io_loop=None):
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.current()
+        # job uuid (or None for all jobs) -> set of listener callbacks
+        self._listeners = {}
+        self._thread = None
+
+    def start(self):
+        """
+        Subscribe to the job events channel (in a thread)
+        """
+        def handle_event(message):
+            event_dict = decode_command(message['data'])
+            self.io_loop.add_callback(self._dispatch, event_dict)
+
+        def handle_exception(e, pubsub, worker_thread):
+            logger.warning("job event subscription failed: {}".format(e))
+            time.sleep(1)
+
+        pubsub = redis_connection().pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{job_events_channel_name(): handle_event})
+        self._thread = pubsub.run_in_thread(
+            sleep_time=1,
+            daemon=True,
+            exception_handler=handle_exception)
+
+    def stop(self):
+        if self._thread is not None:
+            self._thread.stop()
+        self._thread = None
+
+    def add_listener(self, callback, job_uuid=None):
+        """
+        Call callback(event_dict) on status changes of the job with
+        job_uuid (or of all jobs if None)
+        """
+        self._listeners.setdefault(job_uuid, set()).add(callback)
+
+    def remove_listener(self, callback, job_uuid=None):
+        listeners = self._listeners.get(job_uuid, set())
+        listeners.discard(callback)
+        if len(listeners) == 0:
+            self._listeners.pop(job_uuid, None)
+
+    def _dispatch(self, event_dict):
+        for job_uuid in (None, event_dict.get('job_uuid')):
+            # copy since listeners may remove themselves
+            for callback in list(self._listeners.get(job_uuid, ())):
+                callback(event_dict)
+
+
 class SubmitJobForm(tornado.web.RequestHandler):
     """
     Handles job submission input page rendering (but not the submission posts)
@@ -54,7 +230,11 @@ class SubmitJobForm(tornado.web.RequestHandler):
         self.models = models
 
     def get(self):
-        self.render("submit_job.html", models=self.models)
+        self.render(
+            "submit_job.html",
+            models=self.models,
+            priorities=Job.PRIORITIES,
+            default_priority=Job.PRIORITY_NORMAL)
 
 
 class JobKillHandler(tornado.web.RequestHandler):
@@ -120,33 +300,42 @@ class StatusHandler(tornado.web.RequestHandler):
     """
     Handles system status requests
     """
-    def initialize(self, primary_server):
+    def initialize(self, primary_server, refresh_interval=0):
         """
         init with the PrimaryServer instance
 
         Args:
             primary_server (modelrunner.PrimaryServer):  PrimaryServer instance
+            refresh_interval (float):  min seconds between node status
+                refreshes (0 to refresh on every request)
         """
 
         self.primary_server = primary_server
+        self.refresh_interval = refresh_interval
 
     def get(self):
         """
         Get or view node status
 
+        Responds 304 if nodes were not written since the If-None-Match Etag
         """
 
-        def job_json_dict(node):
-            return DateTimeEncoder().encode(node.__dict__)
+        if self.primary_server.refresh_node_status(self.refresh_interval):
+            # give the nodes 1/4 second to reply
+            time.sleep(0.25)
 
-        self.primary_server.refresh_node_status()
-        # give the nodes 1/4 second to reply
-        time.sleep(0.25)
+        accepts_json = 'application/json' in self.request.headers.get(
+            'Accept', '')
+        self.set_header("Vary", "Accept")
+        if check_version_etag(
+                self, "nodes", Node.version(),
+                "json" if accepts_json else "html"):
+            return
 
-        nodes = Node.values()
+        nodes = list(Node.iter_values())
 
         # handle json request
-        if 'application/json' in self.request.headers.get('Accept', ''):
+        if accepts_json:
             # write list as dict with one top-level data key to avoid
             # vulnerability:  http://stackoverflow.com/a/21692087
             data_dict = {'data': [node.__dict__ for node in nodes]}
@@ -161,15 +350,23 @@ class JobHandler(tornado.web.RequestHandler):
     Handles job submission posts and listing
     """
 
-    def initialize(self, primary_server):
+    # number of jobs per chunk when writing large json lists
+    chunk_size = 100
+
+    def initialize(self, primary_server, page_size=100, admission=None):
         """
         init with the PrimaryServer instance
 
         Args:
             primary_server (modelrunner.PrimaryServer):  PrimaryServer instance
+            page_size (int):  default number of jobs per listing page
+            admission (modelrunner.admission.AdmissionControl):  limits of
+                job submissions (None for no limits)
         """
 
         self.primary_server = primary_server
+        self.page_size = page_size
+        self.admission = admission
 
     @tornado.gen.coroutine
     def post(self):
@@ -179,13 +376,23 @@ class JobHandler(tornado.web.RequestHandler):
         Input files may be rather large and time consuming to stream in,
         so this is made asynchronous via tornado coroutines in attempt to
         reduce blocking
+
+        Unless cache is false, the job may be completed right away with the
+        results of a matching job (see PrimaryServer.enqueue_many)
         """
 
         model = self.get_argument('model')
         job_name = self.get_argument('job_name')
+        priority = self.get_argument('priority', Job.PRIORITY_NORMAL)
+        if priority not in Job.PRIORITIES:
+            raise tornado.web.HTTPError(
+                400, "priority must be one of {}".format(
+                    ", ".join(Job.PRIORITIES)))
+
+        use_cache = self.get_argument('cache', 'true').lower() != 'false'
 
         # create new job
-        job = Job(model=model, name=job_name)
+        job = Job(model=model, name=job_name, priority=priority)
         file_url = self.get_argument('zip_url', default=False)
         # validation
         if((not file_url) and (not len(self.request.files) > 0)):
@@ -202,14 +409,22 @@ class JobHandler(tornado.web.RequestHandler):
                 self.write(response_dict)
                 self.finish()
 
+            input_bytes = yield url_input_bytes(self.admission, [file_url])
+            if not admit_jobs(self, self.admission, [job], input_bytes):
+                return
             yield THREAD_POOL.submit(self.primary_server.enqueue, job,
-                                     job_data_url=file_url)
+                                     job_data_url=file_url,
+                                     use_cache=use_cache)
 
         else:
             file_info = self.request.files['zip_file'][0]
             # file_name = file_info['filename']
+            if not admit_jobs(self, self.admission, [job],
+                              input_bytes=len(file_info['body'])):
+                return
             yield THREAD_POOL.submit(self.primary_server.enqueue, job,
-                                     job_data_blob=file_info['body'])
+                                     job_data_blob=file_info['body'],
+                                     use_cache=use_cache)
 
         response_dict = {'message': "OK:  Submitted job id {}".
                          format(job.uuid),
@@ -217,36 +432,366 @@ class JobHandler(tornado.web.RequestHandler):
         self.write(response_dict)
         self.finish()
 
+    @tornado.gen.coroutine
     def get(self, job_uuid=None):
         """
         Get or view jobs
 
+        Jobs are listed most recent first, one page at a time
+        (see offset and limit query arguments) and can be filtered by
+        indexed job attributes (e.g. /jobs?status=RUNNING&model=test)
+
+        json responses are written from the stored job json, without
+        decoding jobs (see RedisEntity.get_json_many)
+
+        Responds 304 if the job(s) were not written since the
+        If-None-Match Etag
+
         Args:
             job_uuid (str):  If not None, the job id to retrieve json for
         """
 
-        def job_json_dict(job):
-            return DateTimeEncoder().encode(job.__dict__)
-
         if(job_uuid):  # single job info
-            job = Job[job_uuid]
-            self.write(DateTimeEncoder().encode(job.__dict__))
+            # jobs written before versioning have no version to tag
+            version = Job.version(job_uuid)
+            if version > 0 and check_version_etag(self, job_uuid, version):
+                return
+
+            try:
+                job_json = Job.get_json(job_uuid)
+            except KeyError:
+                raise tornado.web.HTTPError(404, "Job not found")
+            self.set_header("Content-Type", "application/json; charset=UTF-8")
+            self.write(job_json)
             self.finish()
         else:
-            jobs = Job.values()
+            offset, limit = get_page_arguments(self, self.page_size)
+            criteria = get_job_criteria(self)
+
+            accepts_json = 'application/json' in self.request.headers.get(
+                'Accept', '')
+            self.set_header("Vary", "Accept")
+            # tagged by page, so an Etag is not taken for another page's
+            if check_version_etag(
+                    self, "jobs", Job.version(),
+                    "json" if accepts_json else "html",
+                    offset, limit, urlencode(sorted(criteria.items()))):
+                return
 
-            # order descending
-            jobs.sort(key=lambda job: job.created, reverse=True)
+            total = Job.count(**criteria)
 
             # handle json request
-            if 'application/json' in self.request.headers.get('Accept', ''):
-                # write list as dict with one top-level data key to avoid
-                # vulnerability:  http://stackoverflow.com/a/21692087
-                data_dict = {'data': [job.__dict__ for job in jobs]}
-                encoded = DateTimeEncoder().encode(data_dict)
-                self.write(encoded)
+            if accepts_json:
+                # order descending
+                jobs_json = Job.page_json(offset, limit, **criteria)
+                yield self.write_jobs_json(jobs_json, offset, limit, total)
             else:
-                self.render("view_jobs.html", jobs=jobs, admin=False)
+                jobs = Job.page(offset, limit, **criteria)
+                self.render("view_jobs.html", jobs=jobs, admin=False,
+                            offset=offset, limit=limit, total=total,
+                            filter_query=urlencode(criteria))
+
+    @tornado.gen.coroutine
+    def write_jobs_json(self, jobs_json, offset, limit, total):
+        """
+        Write the list of job json strings, chunk_size jobs at a time
+
+        Written as a dict with one top-level data key to avoid
+        vulnerability:  http://stackoverflow.com/a/21692087
+        """
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.write('{"data": [')
+        for start in range(0, len(jobs_json), self.chunk_size):
+            if start > 0:
+                self.write(", ")
+                # send what we have so far (as a chunk)
+                yield self.flush()
+            self.write(", ".join(jobs_json[start:start + self.chunk_size]))
+
+        self.write('], "offset": {}, "limit": {}, "total": {}}}'.
+                   format(offset, limit, total))
+        self.finish()
+
+
+class JobBatchHandler(tornado.web.RequestHandler):
+    """
+    Handles submission of many jobs in one request
+    """
+
+    def initialize(self, primary_server, admission=None):
+        """
+        init with the PrimaryServer instance
+
+        Args:
+            primary_server (modelrunner.PrimaryServer):  PrimaryServer instance
+            admission (modelrunner.admission.AdmissionControl):  limits of
+                job submissions (None for no limits)
+        """
+
+        self.primary_server = primary_server
+        self.admission = admission
+
+    @tornado.gen.coroutine
+    def post(self):
+        """
+        Store the input files and queue the jobs
+
+        Arguments:
+            jobs:  json list of job specs, each with a job_name and model
+                (and optionally a priority and a zip_url)
+            zip_file or zip_url:  input shared by all jobs (if the job specs
+                do not each have a zip_url)
+            cache:  false to run all jobs even if matching jobs completed
+
+        All jobs are stored and queued at once (see
+        PrimaryServer.enqueue_many) and their ids returned in order
+        """
+
+        try:
+            job_specs = json.loads(self.get_argument('jobs'))
+            assert isinstance(job_specs, list) and len(job_specs) > 0
+            assert all(isinstance(spec, dict) for spec in job_specs)
+        except (ValueError, AssertionError):
+            raise tornado.web.HTTPError(
+                400, "jobs must be a json list of job specs")
+
+        jobs = []
+        for spec in job_specs:
+            if 'model' not in spec or 'job_name' not in spec:
+                raise tornado.web.HTTPError(
+                    400, "each job needs a model and job_name")
+            priority = spec.get('priority', Job.PRIORITY_NORMAL)
+            if priority not in Job.PRIORITIES:
+                raise tornado.web.HTTPError(
+                    400, "priority must be one of {}".format(
+                        ", ".join(Job.PRIORITIES)))
+            jobs.append(Job(model=spec['model'],
+                            name=spec['job_name'],
+                            priority=priority))
+
+        file_url = self.get_argument('zip_url', default=None)
+        if 'zip_file' in self.request.files:
+            file_info = self.request.files['zip_file'][0]
+            enqueue_args = {'job_data_blob': file_info['body']}
+            input_bytes = len(file_info['body'])
+        else:
+            file_urls = [spec.get('zip_url', file_url) for spec in job_specs]
+            if not all(file_urls):
+                raise tornado.web.HTTPError(400, "Invalid url or file")
+            if not all(urlparse(url).scheme for url in file_urls):
+                raise tornado.web.HTTPError(400, "Invalid url scheme")
+            enqueue_args = {'job_data_urls': file_urls}
+            input_bytes = yield url_input_bytes(self.admission, file_urls)
+
+        if not admit_jobs(self, self.admission, jobs, input_bytes):
+            return
+
+        enqueue_args['use_cache'] =\
+            self.get_argument('cache', 'true').lower() != 'false'
+        yield THREAD_POOL.submit(self.primary_server.enqueue_many, jobs,
+                                 **enqueue_args)
+
+        response_dict = {'message': "OK:  Submitted {} jobs".
+                         format(len(jobs)),
+                         'ids': [job.uuid for job in jobs]}
+        self.write(response_dict)
+        self.finish()
+
+
+class ResultCacheHandler(tornado.web.RequestHandler):
+    """
+    Handles requests for result cache stats
+    """
+
+    def initialize(self, result_cache):
+        """
+        init with the ResultCache instance
+
+        Args:
+            result_cache (modelrunner.result_cache.ResultCache):  None if
+                results are not cached
+        """
+
+        self.result_cache = result_cache
+
+    def get(self):
+        """
+        Get the number of hits, misses and evictions of the result cache
+        and of the jobs it indexes
+        """
+        if self.result_cache is None:
+            raise tornado.web.HTTPError(404, "Results are not cached")
+
+        self.write(self.result_cache.stats())
+
+
+class JobEventsHandler(tornado.web.RequestHandler):
+    """
+    Streams job status changes as Server-Sent Events
+
+    /jobs/events streams changes of all jobs, /jobs/<id>/events streams
+    changes of one job (starting with its current status)
+    """
+
+    # seconds between comments sent to keep idle connections open
+    keepalive_interval = 15
+
+    # max number of events buffered for a slow client before its
+    # connection is closed (so that it reconnects)
+    max_queued_events = 1000
+
+    def initialize(self, job_events):
+        """
+        Args:
+            job_events (JobEventListener):  the shared job event listener
+        """
+        self.job_events = job_events
+        self.events = tornado.queues.Queue(maxsize=self.max_queued_events)
+        self.closed = False
+
+    @tornado.gen.coroutine
+    def get(self, job_uuid=None):
+        """
+        Args:
+            job_uuid (str):  If not None, the job id to stream events for
+        """
+        self.set_header("Content-Type", "text/event-stream")
+        self.set_header("Cache-Control", "no-cache")
+
+        # listen before reading the current status so no change is missed
+        self.job_events.add_listener(self.on_job_event, job_uuid)
+        try:
+            if job_uuid:
+                try:
+                    status = Job.get_fields(job_uuid, "status")["status"]
+                except KeyError:
+                    raise tornado.web.HTTPError(404, "Job not found")
+                self.write_event(
+                    {'job_uuid': job_uuid, 'status': status})
+                yield self.flush()
+
+            while not self.closed:
+                try:
+                    event_dict = yield self.events.get(
+                        timeout=datetime.timedelta(
+                            seconds=self.keepalive_interval))
+                except tornado.gen.TimeoutError:
+                    self.write(": keepalive\n\n")
+                else:
+                    if self.closed:
+                        break
+                    self.write_event(event_dict)
+                yield self.flush()
+        except StreamClosedError:
+            pass
+        finally:
+            self.job_events.remove_listener(self.on_job_event, job_uuid)
+
+    def write_event(self, event_dict):
+        event_dict = {key: value for key, value in event_dict.items()
+                      if key != 'command'}
+        self.write("event: status\ndata: {}\n\n".format(
+            DateTimeEncoder().encode(event_dict)))
+
+    def on_job_event(self, event_dict):
+        try:
+            self.events.put_nowait(event_dict)
+        except tornado.queues.QueueFull:
+            logger.warning("closing job event stream of slow client")
+            self.closed = True
+            self.request.connection.close()
+
+    def on_connection_close(self):
+        self.closed = True
+        # wake up get so that it can finish
+        try:
+            self.events.put_nowait(None)
+        except tornado.queues.QueueFull:
+            pass
+
+
+class JobWaitHandler(tornado.web.RequestHandler):
+    """
+    Handles requests to wait for a job to reach a status (long polling)
+
+    e.g. /jobs/<id>/wait?timeout=60&until=COMPLETE,FAILED,KILLED
+
+    Waits are parked on the IOLoop (no thread or redis reads per waiter)
+    until a job event (see JobEventListener) or the timeout
+    """
+
+    # max seconds a request may wait
+    max_timeout = 600
+
+    def initialize(self, job_events):
+        """
+        Args:
+            job_events (JobEventListener):  the shared job event listener
+        """
+        self.job_events = job_events
+        self.reached = tornado.concurrent.Future()
+        self.closed = False
+
+    @tornado.gen.coroutine
+    def get(self, job_uuid):
+        """
+        Respond with the job json once the job has one of the until
+        statuses (default Job.FINAL_STATUSES) or after timeout seconds
+        (default 30), whichever comes first
+
+        Args:
+            job_uuid (str):  job id to wait for
+        """
+        try:
+            timeout = float(self.get_argument('timeout', 30))
+        except ValueError:
+            raise tornado.web.HTTPError(400, "timeout must be a number")
+        if timeout < 0 or timeout > self.max_timeout:
+            raise tornado.web.HTTPError(400, "timeout out of range")
+
+        until = self.get_argument('until', ",".join(Job.FINAL_STATUSES))
+        self.until = set(status for status in until.split(",") if status)
+        if len(self.until) == 0:
+            raise tornado.web.HTTPError(400, "until must name a status")
+
+        # listen before reading the status so no change is missed
+        self.job_events.add_listener(self.on_job_event, job_uuid)
+        try:
+            try:
+                status = Job.get_fields(job_uuid, "status")["status"]
+            except KeyError:
+                raise tornado.web.HTTPError(404, "Job not found")
+
+            if status not in self.until:
+                try:
+                    yield tornado.gen.with_timeout(
+                        datetime.timedelta(seconds=timeout), self.reached)
+                except tornado.gen.TimeoutError:
+                    pass
+        finally:
+            self.job_events.remove_listener(self.on_job_event, job_uuid)
+
+        if self.closed:
+            return
+
+        try:
+            job_json = Job.get_json(job_uuid)
+        except KeyError:
+            # deleted while waiting
+            raise tornado.web.HTTPError(404, "Job not found")
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.write(job_json)
+        self.finish()
+
+    def on_job_event(self, event_dict):
+        if event_dict['status'] in self.until and not self.reached.done():
+            self.reached.set_result(event_dict)
+
+    def on_connection_close(self):
+        # stop waiting
+        self.closed = True
+        if not self.reached.done():
+            self.reached.set_result(None)
 
 
 class AdminHandler(tornado.web.RequestHandler):
@@ -257,12 +802,14 @@ class AdminHandler(tornado.web.RequestHandler):
     VERY INSECURE
     """
 
-    def initialize(self, admin_key=None):
+    def initialize(self, admin_key=None, page_size=100):
         """
         Args:
             request_admin_key (str):  Key required to access this section
+            page_size (int):  default number of jobs per listing page
         """
         self.admin_key = admin_key
+        self.page_size = page_size
 
     def get(self, request_admin_key=None):
         """
@@ -274,9 +821,12 @@ class AdminHandler(tornado.web.RequestHandler):
         if request_admin_key != self.admin_key:
             raise tornado.web.HTTPError(403, "Only Admins Allowed")
 
-        jobs = Job.values()
-        jobs.sort(key=lambda job: job.created, reverse=True)
-        self.render("view_jobs.html", jobs=jobs, admin=True)
+        offset, limit = get_page_arguments(self, self.page_size)
+        criteria = get_job_criteria(self)
+        jobs = Job.page(offset, limit, **criteria)
+        self.render("view_jobs.html", jobs=jobs, admin=True,
+                    offset=offset, limit=limit, total=Job.count(**criteria),
+                    filter_query=urlencode(criteria))
 
 
 class JobOptionsModule(tornado.web.UIModule):
@@ -9,8 +9,12 @@ Note:  This initializes the redisent sub-package as well
 
 from redis import StrictRedis
 from .redisent import settings
+from .redisent.codec import get_codec
+from .transport import ListTransport, StreamTransport, get_transport
 
 _redis_connection = None
+_redis_url = None
+_command_transport = ListTransport()
 
 
 def redis_connection(redis_url="redis://@localhost:6379"):
@@ -19,31 +23,118 @@ def redis_connection(redis_url="redis://@localhost:6379"):
 
     This returns a pooled connection (see http://bit.ly/2axtR2k)
     """
-    global _redis_connection
+    global _redis_connection, _redis_url
     if _redis_connection is None:
         _redis_connection = StrictRedis.from_url(redis_url, decode_responses=True)
+        _redis_url = redis_url
 
     return _redis_connection
 
 
-def initialize(redis_url="redis://@localhost:6379"):
+def async_redis_connection():
+    """
+    Return a new asyncio Redis connection to the url of redis_connection
+    (see AsyncDispatcher, requires redis >= 4.2)
+
+    Connections are bound to the event loop they are used on, so this is
+    to be called from that loop
+    """
+    from redis.asyncio import StrictRedis as AsyncStrictRedis
+    redis_connection()
+    return AsyncStrictRedis.from_url(_redis_url, decode_responses=True)
+
+
+def command_transport():
+    """
+    Return the transport of commands between nodes (see transport)
+    """
+    return _command_transport
+
+
+def initialize(
+        redis_url="redis://@localhost:6379",
+        codec="json",
+        transport="lists",
+        stream_maxlen=10000,
+        stream_count=1):
     """
     Must be called before using modelrunner package
+
+    codec:  name of the codec entities are stored with (see redisent.codec)
+    transport:  name of the transport of commands (see transport)
+    stream_maxlen, stream_count:  maxlen and count of the streams transport
     """
+    global _command_transport
+    options = {}
+    if transport == StreamTransport.name:
+        options = dict(maxlen=stream_maxlen, count=stream_count)
+    _command_transport = get_transport(transport, **options)
 
     settings.initialize(
         redis_connection=redis_connection(redis_url),
-        prefix="modelrunner")
+        prefix="modelrunner",
+        codec=get_codec(codec))
 
 
-def job_queue_name(model_name):
-    return "modelrunner:queues:{}".format(model_name)
+def job_queue_name(model_name, priority=None):
+    """
+    Name of the queue of jobs of model_name (of priority if not the
+    default, see Job.queue_name)
+    """
+    if priority is None:
+        return "modelrunner:queues:{}".format(model_name)
+    return "modelrunner:queues:{}:{}".format(model_name, priority)
 
 
 def primary_queue_name(primary_name):
     return "modelrunner:queues:{}".format(primary_name)
 
 
+def processing_queue_name(consumer_name):
+    return "modelrunner:processing:{}".format(consumer_name)
+
+
+def processing_registry_name():
+    return "modelrunner:processing"
+
+
+def stop_queue_name(consumer_name):
+    return "modelrunner:stop:{}".format(consumer_name)
+
+
+def pending_input_name(model_name=None):
+    """
+    hash of the input bytes of the queued jobs of model_name by job uuid
+    (or of the total input bytes of queued jobs by model, if None)
+    """
+    if model_name is None:
+        return "modelrunner:pending_input"
+    return "modelrunner:pending_input:{}".format(model_name)
+
+
+def dequeued_count_name():
+    return "modelrunner:dequeued"
+
+
+def runtime_stats_name(model_name):
+    """
+    hash of the (decayed) sums regressing the run time of jobs of
+    model_name on their input size (see scheduler.record_runtime)
+    """
+    return "modelrunner:runtime_stats:{}".format(model_name)
+
+
+def result_cache_name(part=None):
+    """
+    hash of the uuids of completed jobs by cache key (or, with part, the
+    "used" sorted set of cache keys by last use or the "stats" hash of
+    the cache, see ResultCache)
+    """
+    if part is None:
+        return "modelrunner:result_cache"
+    return "modelrunner:result_cache:{}".format(part)
+
+
 def node_channel_name(node_name):
     return "modelrunner:channels:{}".format(node_name)
 
@@ -52,5 +143,13 @@ def all_nodes_channel_name():
     return "modelrunner:channels:nodes"
 
 
+def job_events_channel_name():
+    return "modelrunner:channels:job_events"
+
+
+def node_refresh_name():
+    return "modelrunner:node_refresh"
+
+
 def worker_name(node_url, model):
     return "{};{}".format(node_url, model)
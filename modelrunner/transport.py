@@ -0,0 +1,634 @@
+# -*- coding: utf-8 -*-
+"""
+Transports of the modelrunner 'protocol' (queues and channels of commands)
+
+A transport has the queue and channel functions of redis_utils as methods
+(each taking the redis connection as first argument), so that nodes
+(see Dispatcher, PrimaryServer and WorkerServer) do not depend on how
+commands are carried:
+
+- enqueue_command, get_all_commands, peek_commands, queue_length:  queues
+- pop_command_any, release_consumer:  pop without acknowledgement
+- idle_timeout:  how long pops may block for
+- pop_command_reliable_any, pending_commands, ack_command, renew_lease,
+  release_lease, requeue_expired:  pop with acknowledgement and leases
+- publish_command, listen:  channels
+
+Tokens returned with reliably popped commands are passed back to ack them
+
+All nodes must use the same transport (see settings.initialize)
+"""
+
+import logging
+import os
+import socket
+import threading
+import time
+from redis.exceptions import ConnectionError, ResponseError
+from . import redis_utils
+from .utils import json_dumps_datetime
+
+logger = logging.getLogger('modelrunner')
+
+
+class ListTransport(object):
+    """
+    Queues as redis lists and channels as redis pub/sub
+
+    Reliably popped commands are moved to processing lists which are
+    leased by their consumer (see redis_utils)
+    """
+
+    name = "lists"
+
+    # seconds between reliable pops of several queues
+    # (see redis_utils.pop_command_reliable_any)
+    POLL_INTERVAL = 1
+
+    def enqueue_command(self, redis_conn, queue_name, command_dict):
+        redis_utils.enqueue_command(redis_conn, queue_name, command_dict)
+
+    def get_all_commands(self, redis_conn, queue_name):
+        return redis_utils.get_all_commands(redis_conn, queue_name)
+
+    def peek_commands(self, redis_conn, queue_name, count=1):
+        return redis_utils.peek_commands(redis_conn, queue_name, count=count)
+
+    def queue_length(self, redis_conn, queue_name):
+        return redis_conn.llen(queue_name)
+
+    def pop_command_any(self, redis_conn, queue_names, timeout=0):
+        return redis_utils.pop_command_any(
+            redis_conn, queue_names, timeout=timeout)
+
+    def release_consumer(self, redis_conn, queue_names):
+        """
+        lists have no consumers to release
+        """
+        pass
+
+    def idle_timeout(self, queue_count, lease_timeout=0):
+        """
+        Seconds a pop of queue_count queues may block for so that commands
+        on any of them are popped (None for no limit)
+
+        Moving commands to processing lists (lease_timeout > 0) only blocks
+        on one queue (see pop_command_reliable_any), so several queues are
+        polled.  As the stop queue of a dispatcher is one of its queues,
+        leased dispatchers always poll:  an idle one pops once per
+        POLL_INTERVAL, and commands on the queues it does not block on
+        (including stop commands) wait for up to POLL_INTERVAL seconds
+        """
+        if lease_timeout > 0 and queue_count > 1:
+            return self.POLL_INTERVAL
+        return None
+
+    def pop_command_reliable_any(
+            self,
+            redis_conn,
+            queue_names,
+            processing_names,
+            timeout=0,
+            lease_timeout=0,
+            block_index=0,
+            on_claimed=None):
+        """
+        block_index:  index of the queue to block on if all are empty
+
+        Commands of expired leases are requeued rather than claimed (see
+        requeue_expired), so on_claimed is never called
+        """
+        return redis_utils.pop_command_reliable_any(
+            redis_conn, queue_names, processing_names, timeout=timeout,
+            block_index=block_index)
+
+    def pending_commands(self, redis_conn, queue_name, processing_name):
+        return [(redis_utils.decode_command(serialized), serialized)
+                for serialized in redis_conn.lrange(processing_name, 0, -1)]
+
+    def ack_command(self, redis_conn, queue_name, processing_name, token):
+        redis_utils.ack_command(redis_conn, processing_name, token)
+
+    def renew_lease(
+            self,
+            redis_conn,
+            registry_name,
+            processing_name,
+            queue_name,
+            lease_timeout):
+        return redis_utils.renew_lease(
+            redis_conn,
+            registry_name,
+            processing_name,
+            queue_name,
+            lease_timeout)
+
+    def release_lease(self, redis_conn, processing_name):
+        redis_utils.release_lease(redis_conn, processing_name)
+
+    def requeue_expired(self, redis_conn, registry_name, before_requeue=None):
+        return redis_utils.requeue_expired(
+            redis_conn, registry_name, before_requeue=before_requeue)
+
+    def publish_command(self, redis_conn, channel_name, command_dict):
+        redis_utils.publish_command(redis_conn, channel_name, command_dict)
+
+    def listen(self, redis_conn, channel_names):
+        """
+        generator of the command dicts published on channel_names
+        """
+        pubsub = redis_conn.pubsub()
+        pubsub.subscribe(channel_names)
+        return redis_utils.pubsub_listen(pubsub)
+
+
+class StreamTransport(object):
+    """
+    Queues and channels as redis streams (requires redis >= 6.2)
+
+    Queues are read via a consumer group, so commands are delivered to one
+    consumer.  Reliably popped commands stay pending for their consumer
+    (named by its processing name) until acked, when they are deleted from
+    the stream.  Consumers keep their pending commands by reclaiming them
+    (see renew_lease) and claim the commands of consumers that did not for
+    lease_timeout seconds (e.g. crashed), so nothing needs requeueing.
+
+    Channels are streams trimmed to about maxlen commands that listeners
+    read from the last command they received, so commands published while
+    a listener reconnects are not lost.
+
+    Up to count commands are read from a queue at once, those not yet
+    returned are kept by the reading thread for its next pops.
+    """
+
+    name = "streams"
+
+    # consumer group reading every queue
+    GROUP = "modelrunner"
+
+    # field of stream entries holding the serialized command
+    FIELD = "command"
+
+    # max commands to resume or reclaim per queue at once
+    MAX_PENDING = 1000
+
+    def __init__(self, maxlen=10000, count=1):
+        """
+        Args:
+            maxlen (int):  approximate max number of commands kept per channel
+            count (int):  max number of commands read from a queue at once
+        """
+        self.maxlen = maxlen
+        self.count = count
+        self._groups = set()
+        self._local = threading.local()
+
+    def enqueue_command(self, redis_conn, queue_name, command_dict):
+        logger.info(
+            "adding command {} to queue {}".
+            format(command_dict, queue_name))
+        redis_conn.xadd(
+            queue_name,
+            {self.FIELD: json_dumps_datetime(command_dict)})
+
+    def get_all_commands(self, redis_conn, queue_name):
+        """
+        get all command_dicts on queue that were not yet popped
+        """
+        last_delivered_id = self._last_delivered_id(redis_conn, queue_name)
+        if last_delivered_id is None:
+            return []
+
+        return [command for entry_id, command in
+                self._decode_entries(redis_conn.xrange(
+                    queue_name, min="(" + last_delivered_id))]
+
+    def peek_commands(self, redis_conn, queue_name, count=1):
+        """
+        get the (up to) count command_dicts on queue to be popped next
+        """
+        last_delivered_id = self._last_delivered_id(redis_conn, queue_name)
+        if last_delivered_id is None:
+            return []
+
+        return [command for entry_id, command in
+                self._decode_entries(redis_conn.xrange(
+                    queue_name, min="(" + last_delivered_id, count=count))]
+
+    def queue_length(self, redis_conn, queue_name):
+        """
+        number of commands on queue that were not yet popped
+        """
+        try:
+            pending = redis_conn.xpending(queue_name, self.GROUP)['pending']
+        except ResponseError:
+            # no such stream or group
+            pending = 0
+        return redis_conn.xlen(queue_name) - pending
+
+    def pop_command_any(self, redis_conn, queue_names, timeout=0):
+        """
+        *Blocking*
+
+        Waits for command on any of the queues (preferring earlier ones)
+        without tracking it as pending
+
+        Commands are read one at a time, the first queue with one first, and
+        deleted once read (so none are read ahead of the one returned).
+        While all queues are empty, the queues are watched via XREAD (which
+        does not consume commands) for commands after the last ones popped.
+
+        Returns (index of queue popped from, command dict) or None if timeout
+        """
+        consumer = self._consumer()
+        deadline = time.time() + timeout if timeout else None
+        while True:
+            for index, queue_name in enumerate(queue_names):
+                read = self._read_group(
+                    redis_conn, consumer, {queue_name: ">"},
+                    count=1, noack=True)
+                if len(read) > 0:
+                    stream_name, entry_id, command = read[0]
+                    # never acked, so delete it once read
+                    redis_conn.xdel(stream_name, entry_id)
+                    return index, command
+
+            block = 0
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                block = max(1, int(remaining * 1000))
+            redis_conn.xread(
+                self._last_delivered_ids(redis_conn, queue_names),
+                count=1,
+                block=block)
+
+    def release_consumer(self, redis_conn, queue_names):
+        """
+        remove the consumer of this thread (see pop_command_any) from the
+        group of queue_names once it stops popping from them (it has no
+        pending commands since they are not acked)
+        """
+        consumer = self._consumer()
+        pipe = redis_conn.pipeline(transaction=False)
+        for queue_name in queue_names:
+            pipe.xgroup_delconsumer(queue_name, self.GROUP, consumer)
+        # no such stream or group is fine too
+        pipe.execute(raise_on_error=False)
+
+    def idle_timeout(self, queue_count, lease_timeout=0):
+        """
+        Seconds a pop of queue_count queues may block for (None for no
+        limit), expired commands are only claimed between pops
+        """
+        if lease_timeout > 0:
+            return lease_timeout / 2.0
+        return None
+
+    def pop_command_reliable_any(
+            self,
+            redis_conn,
+            queue_names,
+            processing_names,
+            timeout=0,
+            lease_timeout=0,
+            block_index=0,
+            on_claimed=None):
+        """
+        *Blocking*
+
+        Waits for command on any of the queues (preferring earlier ones),
+        keeping it pending for the consumer named by the processing name of
+        its queue until acked via ack_command
+
+        Commands pending for lease_timeout seconds (i.e. whose consumer did
+        not renew its lease) are claimed first (if lease_timeout > 0) and
+        passed to on_claimed (if given) as a list of command dicts
+
+        Blocks on all queues, so block_index is ignored
+
+        Returns (index of queue popped from, command dict, entry id)
+        or None if timeout
+        """
+        if lease_timeout > 0:
+            self._claim_expired(
+                redis_conn, queue_names, processing_names, lease_timeout,
+                on_claimed=on_claimed)
+
+        return self._pop(
+            redis_conn, queue_names, processing_names, timeout)
+
+    def pending_commands(self, redis_conn, queue_name, processing_name):
+        """
+        Commands popped by the consumer processing_name but not acked
+        (e.g. when it was restarted) as (command dict, entry id) pairs
+        """
+        result = self._read_group(
+            redis_conn, processing_name, {queue_name: "0"},
+            count=self.MAX_PENDING)
+        return [(command, entry_id) for stream_name, entry_id, command
+                in result]
+
+    def ack_command(self, redis_conn, queue_name, processing_name, token):
+        pipe = redis_conn.pipeline()
+        pipe.xack(queue_name, self.GROUP, token)
+        pipe.xdel(queue_name, token)
+        pipe.execute()
+
+    def renew_lease(
+            self,
+            redis_conn,
+            registry_name,
+            processing_name,
+            queue_name,
+            lease_timeout):
+        """
+        reclaim the pending commands of processing_name so that they are
+        not claimed by other consumers for lease_timeout seconds
+
+        Returns True (commands already claimed by others are not reported)
+        """
+        pending = self._with_groups(
+            redis_conn,
+            [queue_name],
+            lambda: redis_conn.xpending_range(
+                queue_name, self.GROUP, "-", "+", self.MAX_PENDING,
+                consumername=processing_name))
+        ids = [entry['message_id'] for entry in pending]
+        if len(ids) > 0:
+            redis_conn.xclaim(
+                queue_name, self.GROUP, processing_name, 0, ids, justid=True)
+        return True
+
+    def release_lease(self, redis_conn, processing_name):
+        """
+        commands left pending are claimed by other consumers once expired
+        """
+        pass
+
+    def requeue_expired(self, redis_conn, registry_name, before_requeue=None):
+        """
+        expired commands are claimed by consumers (see
+        pop_command_reliable_any) so there is nothing to requeue
+        """
+        return []
+
+    def publish_command(self, redis_conn, channel_name, command_dict):
+        redis_conn.xadd(
+            channel_name,
+            {self.FIELD: json_dumps_datetime(command_dict)},
+            maxlen=self.maxlen,
+            approximate=True)
+
+    def listen(self, redis_conn, channel_names):
+        """
+        generator of the command dicts published on channel_names (from
+        now on), resuming after the last one received on reconnection
+        """
+        last_ids = {}
+        for channel_name in channel_names:
+            last = redis_conn.xrevrange(channel_name, count=1)
+            last_ids[channel_name] = last[0][0] if len(last) > 0 else "0-0"
+
+        return self._listen(redis_conn, channel_names, last_ids)
+
+    def _listen(self, redis_conn, channel_names, last_ids):
+        while True:
+            try:
+                result = redis_conn.xread(last_ids, block=0)
+            except ConnectionError as e:
+                logger.warning(
+                    "lost connection listening on {} ({}), retrying".
+                    format(channel_names, e))
+                time.sleep(1)
+                continue
+
+            for channel_name, entries in result:
+                for entry_id, command_dict in self._decode_entries(entries):
+                    last_ids[channel_name] = entry_id
+                    logger.info("message received {}".format(command_dict))
+                    yield command_dict
+
+    def _pop(
+            self,
+            redis_conn,
+            queue_names,
+            consumers,
+            timeout):
+        """
+        Pop the next command of the first queue with one (keeping it pending
+        for the consumer of its queue), blocking on all queues if all are
+        empty
+
+        Pending commands are read up to count at once per queue and the
+        ones not returned are buffered for the next pops (queues before
+        theirs are read again first, so buffered commands do not run ahead
+        of commands of earlier queues).
+
+        Returns (index of queue popped from, command dict, entry id)
+        or None if timeout
+        """
+        buffered = self._buffered(queue_names, consumers)
+
+        # only queues before the first one with buffered commands
+        first = min([queue_names.index(stream_name)
+                     for stream_name, entry_id, command in buffered] or
+                    [len(queue_names)])
+        for queue_name, consumer in zip(queue_names[:first],
+                                        consumers[:first]):
+            read = self._read_group(
+                redis_conn, consumer, {queue_name: ">"}, count=self.count)
+            if len(read) > 0:
+                buffered.extend(read)
+                break
+
+        if len(buffered) == 0:
+            # consumers are per queue, so commands read from other queues
+            # are claimed by the consumers of their queue
+            buffered.extend(self._read_group(
+                redis_conn, consumers[0],
+                {queue_name: ">" for queue_name in queue_names},
+                count=self.count, timeout=timeout))
+            for stream_name, entry_id, command in buffered:
+                consumer = consumers[queue_names.index(stream_name)]
+                if consumer != consumers[0]:
+                    redis_conn.xclaim(
+                        stream_name, self.GROUP, consumer, 0,
+                        [entry_id], justid=True)
+
+        if len(buffered) == 0:
+            return None
+
+        buffered.sort(key=lambda item: queue_names.index(item[0]))
+        stream_name, entry_id, command = buffered.pop(0)
+        return queue_names.index(stream_name), command, entry_id
+
+    def _consumer(self):
+        """
+        name of the consumer popping without acknowledgement for this thread
+        """
+        return "{}:{}:{}".format(
+            socket.gethostname(), os.getpid(), threading.current_thread().name)
+
+    def _buffered(self, queue_names, consumers):
+        """
+        commands read by this thread from queue_names (for consumers) but
+        not yet returned
+        """
+        if not hasattr(self._local, 'buffers'):
+            self._local.buffers = {}
+        key = tuple(sorted(zip(queue_names, consumers)))
+        return self._local.buffers.setdefault(key, [])
+
+    def _claim_expired(
+            self,
+            redis_conn,
+            queue_names,
+            consumers,
+            lease_timeout,
+            on_claimed=None):
+        """
+        Claim the commands pending for more than lease_timeout seconds,
+        checking at most every lease_timeout / 2 seconds per thread
+
+        on_claimed:  called with the list of claimed command dicts (if any)
+        """
+        now = time.time()
+        if getattr(self._local, 'next_claim', 0) > now:
+            return
+        self._local.next_claim = now + lease_timeout / 2.0
+
+        buffered = self._buffered(queue_names, consumers)
+        claimed = []
+        for queue_name, consumer in zip(queue_names, consumers):
+            result = self._with_groups(
+                redis_conn,
+                [queue_name],
+                lambda: redis_conn.xautoclaim(
+                    queue_name, self.GROUP, consumer,
+                    int(lease_timeout * 1000), count=self.MAX_PENDING))
+            for entry_id, command in self._decode_entries(result[1]):
+                logger.warning(
+                    "claimed expired command {} of {}".
+                    format(command, queue_name))
+                buffered.append((queue_name, entry_id, command))
+                claimed.append(command)
+
+        if len(claimed) > 0 and on_claimed is not None:
+            on_claimed(claimed)
+
+    def _read_group(
+            self,
+            redis_conn,
+            consumer,
+            streams,
+            count,
+            noack=False,
+            timeout=None):
+        """
+        XREADGROUP (creating the group of streams if needed)
+
+        timeout:  seconds to block for (0 forever, None to not block)
+        Returns list of (stream name, entry id, command dict)
+        """
+        block = None if timeout is None else int(timeout * 1000)
+        result = self._with_groups(
+            redis_conn,
+            streams,
+            lambda: redis_conn.xreadgroup(
+                self.GROUP, consumer, streams,
+                count=count, block=block, noack=noack))
+
+        return [(stream_name, entry_id, command)
+                for stream_name, entries in result or []
+                for entry_id, command in self._decode_entries(entries)]
+
+    def _with_groups(self, redis_conn, stream_names, call):
+        """
+        Returns call() once the group of stream_names exists
+        """
+        for stream_name in stream_names:
+            self._create_group(redis_conn, stream_name)
+        try:
+            return call()
+        except ResponseError:
+            # retry in case the streams (and so their group) were deleted
+            # since the group was created
+            self._groups.difference_update(stream_names)
+            for stream_name in stream_names:
+                self._create_group(redis_conn, stream_name)
+            return call()
+
+    def _create_group(self, redis_conn, stream_name):
+        if stream_name in self._groups:
+            return
+        try:
+            redis_conn.xgroup_create(
+                stream_name, self.GROUP, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        self._groups.add(stream_name)
+
+    def _last_delivered_id(self, redis_conn, queue_name):
+        """
+        id of the last entry of queue popped via the group ("0-0" if none,
+        None if there is no such stream)
+        """
+        last_delivered_id = "0-0"
+        try:
+            for group in redis_conn.xinfo_groups(queue_name):
+                if group['name'] == self.GROUP:
+                    last_delivered_id = group['last-delivered-id']
+        except ResponseError:
+            # no such stream
+            return None
+        return last_delivered_id
+
+    def _last_delivered_ids(self, redis_conn, queue_names):
+        """
+        dict of queue name -> _last_delivered_id of queue (in one round
+        trip, "0-0" if there is no such stream)
+        """
+        pipe = redis_conn.pipeline(transaction=False)
+        for queue_name in queue_names:
+            pipe.xinfo_groups(queue_name)
+        last_delivered_ids = {}
+        for queue_name, groups in zip(
+                queue_names, pipe.execute(raise_on_error=False)):
+            last_delivered_ids[queue_name] = "0-0"
+            if isinstance(groups, ResponseError):
+                continue
+            for group in groups:
+                if group['name'] == self.GROUP:
+                    last_delivered_ids[queue_name] =\
+                        group['last-delivered-id']
+        return last_delivered_ids
+
+    def _decode_entries(self, entries):
+        """
+        (entry id, command dict) of stream entries, skipping deleted ones
+        """
+        return [(entry_id, redis_utils.decode_command(fields[self.FIELD]))
+                for entry_id, fields in entries
+                if fields and self.FIELD in fields]
+
+
+TRANSPORTS = {
+    ListTransport.name: ListTransport,
+    StreamTransport.name: StreamTransport
+}
+
+
+def get_transport(name, **options):
+    """
+    Return a transport instance by name (one of TRANSPORTS)
+
+    options:  passed to the transport's constructor
+    """
+    if name not in TRANSPORTS:
+        raise ValueError(
+            "Unknown transport {}, must be one of {}".
+            format(name, ", ".join(sorted(TRANSPORTS))))
+    return TRANSPORTS[name](**options)
@@ -3,11 +3,12 @@ import os
 import logging
 import zipfile
 import shutil
+import threading
 import psutil
 from datetime import datetime
 import json
 from zipfile import ZipFile
-from six.moves.urllib.request import urlopen
+from six.moves.urllib.request import urlopen, Request
 from six import string_types
 
 # setup log
@@ -46,6 +47,52 @@ def fetch_file_from_url(url, destination_dir, file_name=None):
     logger.info("Finished retrieving file from url {}".format(url))
 
 
+def url_content_length(url, timeout=10):
+    """
+    Size of the file at url according to a HEAD request
+
+    Returns:
+        its Content-Length in bytes (0 if unknown)
+    """
+    try:
+        response = urlopen(Request(url, method="HEAD"), timeout=timeout)
+        try:
+            return int(response.headers.get("Content-Length") or 0)
+        finally:
+            response.close()
+    except Exception as e:
+        logger.warning("Failed to get size of file at url {}: {}".
+                       format(url, e))
+        return 0
+
+
+def fetch_files_from_urls(urls, destination_dir):
+    """
+    Retrieve remote files (see fetch_file_from_url) in parallel, each on
+    its own thread
+
+    Exceptions:  will propagate the first exception occuring during a copy
+        (once all copies are done)
+    """
+
+    errors = []
+
+    def fetch(url):
+        try:
+            fetch_file_from_url(url, destination_dir)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=fetch, args=(url,)) for url in urls]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if len(errors) > 0:
+        raise errors[0]
+
+
 def zipdir(path, zip_file_name):
     """
     Recursively zip up a directory
@@ -4,14 +4,22 @@ import os
 import logging
 import subprocess
 import signal
+import threading
+import time
+import psutil
 from zipfile import ZipFile
+from six import string_types
 import modelrunner
 from modelrunner.utils import fetch_file_from_url, zipdir, kill_process_tree
-from modelrunner.redis_utils import enqueue_command
 from modelrunner.settings import redis_connection,\
+                                 command_transport,\
                                  primary_queue_name,\
+                                 node_channel_name,\
+                                 all_nodes_channel_name,\
                                  worker_name
 
+from .admission import unpend_input
+from .scheduler import record_runtime
 from . import Job
 from . import Node
 
@@ -32,8 +40,12 @@ class WorkerServer:
 
         worker_url (str):  url of Worker server
         data_dir (str):  path where job data should be stored
-        model (str):  name of model to be run via this worker
+        model (str or list of str):  name of model(s) to be run via this
+            worker (the queues of several models are waited on at once,
+            see Dispatcher queue_weights)
         model_commands (dict str -> str):  model -> command to run model via
+        slots (int):  number of jobs to run at once (each slot processes
+            the queue via its own WorkerSlot, see Dispatcher slots)
 
     """
     def __init__(
@@ -41,13 +53,20 @@ class WorkerServer:
             worker_url,
             data_dir,
             model,
-            model_commands):
+            model_commands,
+            slots=1):
 
         self.model_commands = model_commands
         if(not os.path.exists(data_dir)):
             os.mkdir(data_dir)
         self.data_dir = data_dir
 
+        if isinstance(model, string_types):
+            model = [model]
+        self.models = list(model)
+        # nodes report the models as one (comma separated) name
+        model = ",".join(self.models)
+
         # used for reporting status
         self._node = Node(
                         worker_name(worker_url, model),
@@ -57,6 +76,27 @@ class WorkerServer:
                         modelrunner.__version__,
                         model)
 
+        # with more than one slot, each slot reports its own status
+        if slots == 1:
+            self._slot_nodes = [self._node]
+        else:
+            self._slot_nodes = [
+                Node("{}/{}".format(self._node.name, slot),
+                     worker_url,
+                     Node.STATUS_WAITING,
+                     Node.TYPE_WORKER,
+                     modelrunner.__version__,
+                     model)
+                for slot in range(slots)]
+
+        # pids of running jobs by job uuid (for killing them)
+        self._job_pids = {}
+        # uuids of jobs being started (no pid yet) and of those of them
+        # to kill as soon as they have a pid (see kill_job)
+        self._starting_jobs = set()
+        self._pending_kills = set()
+        self._lock = threading.Lock()
+
         self.dispatch = {
             'PROCESS_JOB': self.process_job,
             'KILL_JOB': self.kill_job,
@@ -70,12 +110,120 @@ class WorkerServer:
         """
         return self._node
 
-    def process_job(self, command_dict):
+    @property
+    def channel_names(self):
+        """
+        Names of the channels this worker receives commands on (including
+        the channel of each of its models' workers, see
+        PrimaryServer.kill_job)
+        """
+        channel_names = [node_channel_name(self.node.name)]
+        for model in self.models:
+            channel_name = node_channel_name(
+                worker_name(self.node.node_url, model))
+            if channel_name not in channel_names:
+                channel_names.append(channel_name)
+        return channel_names + [all_nodes_channel_name()]
+
+    @property
+    def slots(self):
+        return len(self._slot_nodes)
+
+    def slot(self, slot):
+        """
+        Return the command handler of the slot (see WorkerSlot)
+        """
+        return WorkerSlot(self, slot)
+
+    def reclaim_commands(self, command_dicts):
+        """
+        queue the running jobs of PROCESS_JOB commands again that were
+        popped before but not processed to the end (by this worker before
+        a restart or by one whose lease expired, see Dispatcher), so that
+        they can be started again
+        """
+        for command_dict in command_dicts:
+            if command_dict['command'] != 'PROCESS_JOB':
+                continue
+            job_uuid = command_dict['job_uuid']
+            try:
+                requeued = Job.set_status_if(
+                    job_uuid,
+                    [Job.STATUS_RUNNING],
+                    Job.STATUS_QUEUED,
+                    on_primary=True)
+            except KeyError:
+                continue
+            if requeued:
+                logger.warning("requeueing job {}".format(job_uuid))
+
+    def process_job(self, command_dict, slot=0):
         """
         process job
         command format {'command': 'PROCESS_JOB',
                         'job_uuid': <uuid>}
 
+        slot:  the slot the job is run in
+        """
+        started = self._start_job(command_dict)
+        if started is None:
+            return
+        job, job_data_log = started
+
+        # add the input and output dir to the command
+        start = time.time()
+        popen_proc = self._run_subprocess(job, job_data_log)
+
+        # set hidden status attributes
+        self.set_node_status(
+            Node.STATUS_RUNNING,
+            job_uuid=job.uuid,
+            job_pid=popen_proc.pid,
+            slot=slot)
+
+        logger.info(
+            "job {} running with pid {}".
+            format(job.uuid, popen_proc.pid))
+
+        # wait for command to finish or for it to be killed
+        return_code = popen_proc.wait()
+
+        # Reset hidden status attributes
+        self.set_node_status(Node.STATUS_WAITING, slot=slot)
+
+        self._finish_job(
+            job, job_data_log, return_code, run_seconds=time.time() - start)
+
+    def _start_job(self, command_dict):
+        """
+        assign the job of a PROCESS_JOB command to this worker and prep its
+        input
+
+        The job counts as starting until its pid is set (see
+        set_node_status), so that it can be killed meanwhile
+
+        Returns:
+            (job, open job log) to run the job with or None if the job is
+            not to be run (e.g. it failed)
+        """
+        job_uuid = command_dict['job_uuid']
+        with self._lock:
+            self._starting_jobs.add(job_uuid)
+
+        started = None
+        try:
+            started = self._assign_job(command_dict)
+        finally:
+            if started is None:
+                with self._lock:
+                    self._starting_jobs.discard(job_uuid)
+                    self._pending_kills.discard(job_uuid)
+        return started
+
+    def _assign_job(self, command_dict):
+        """
+        assign the job of a PROCESS_JOB command to this worker and prep its
+        input (see _start_job)
         """
         job_uuid = command_dict['job_uuid']
         try:
@@ -84,25 +232,39 @@ class WorkerServer:
             # Job not found is not worth re-raising
             logger.warn(e)
             logger.warn("Job {} missing".format(job_uuid))
-            return
+            return None
 
         # assign the job to this worker
         job.worker_url = self.node.node_url
         job.worker_data_dir = self.data_dir
+        job.status = Job.STATUS_RUNNING
+        job.on_primary = False  # now on worker
+
+        # only start jobs that are not yet running or processed, the command
+        # may be for a job that was killed while queued (such commands are
+        # left in the queue, see PrimaryServer.kill_job) or a requeued
+        # command (see Dispatcher lease_timeout) for a job that was
+        # processed after all (jobs of requeued commands are queued again,
+        # see reclaim_commands and PrimaryServer.requeue_expired_jobs)
+        if not Job.set_status_if(
+                job.uuid,
+                [Job.STATUS_CREATED, Job.STATUS_QUEUED],
+                job.status,
+                on_primary=job.on_primary,
+                worker_url=job.worker_url,
+                worker_data_dir=job.worker_data_dir):
+            logger.warn(
+                "Job {} already processed or killed, ignoring".
+                format(job.uuid))
+            return None
+        unpend_input(redis_connection(), job)
+
         job_data_dir = self._setup_job_dir(job)
 
         # setup subproc to run model command and output to local job log
         logger.info("preparing input for job {}".format(job.uuid))
         job_data_log = open(os.path.join(job_data_dir, "job_log.txt"), 'w')
 
-        # primary_queue to notify primary server of any errors or completion
-        primary_queue = primary_queue_name(job.primary_url)
-
-        # update job status
-        job.status = Job.STATUS_RUNNING
-        job.on_primary = False  # now on worker
-        Job[job.uuid] = job
-
         # catch data prep exceptions so that we mark the job as failed
         try:
             self._prep_input(job)
@@ -113,34 +275,20 @@ class WorkerServer:
             job_data_log.write(failure_msg)
             job_data_log.close()
             job.status = Job.STATUS_FAILED
-            Job[job.uuid] = job
-            command_dict = {'command': 'COMPLETE_JOB', 'job_uuid': job.uuid}
-            enqueue_command(redis_connection(), primary_queue, command_dict)
-            return
+            Job.set_status(job.uuid, job.status)
+            self._notify_primary(job)
+            return None
 
         # Input has been prepped so start the job
-        command = self.model_commands[self.node.model]
         logger.info("starting job {}".format(job.uuid))
+        return job, job_data_log
 
-        # add the input and output dir to the command
-        popen_proc = self._run_subprocess(command, job, job_data_log)
-
-        # set hidden status attributes
-        self.set_node_status(
-            Node.STATUS_RUNNING,
-            job_uuid=job.uuid,
-            job_pid=popen_proc.pid)
-
-        logger.info(
-            "job {} running with pid {}".
-            format(job.uuid, popen_proc.pid))
-
-        # wait for command to finish or for it to be killed
-        return_code = popen_proc.wait()
-
-        # Reset hidden status attributes
-        self.set_node_status(Node.STATUS_WAITING)
-
+    def _finish_job(self, job, job_data_log, return_code, run_seconds=None):
+        """
+        set the status of a job whose command returned return_code after
+        run_seconds (zipping its output and recording its run time if it
+        succeeded, see scheduler.record_runtime) and notify the primary
+        """
         # close job log
         job_data_log.close()
         logger.info("finished job {} with return code {}".format(job.uuid,
@@ -151,16 +299,25 @@ class WorkerServer:
             logger.info("zipping output of job {}".format(job.uuid))
             self._prep_output(job)
             job.status = Job.STATUS_PROCESSED
+            if run_seconds is not None:
+                record_runtime(redis_connection(), job, run_seconds)
         elif return_code == -signal.SIGKILL:
             job.status = Job.STATUS_KILLED
         else:
             job.status = Job.STATUS_FAILED
 
-        Job[job.uuid] = job
+        Job.set_status(job.uuid, job.status, run_seconds=run_seconds)
+        self._notify_primary(job)
 
-        # notify primary server job is done
+    def _notify_primary(self, job):
+        """
+        notify the primary server of the job that the job is done
+        """
+        # primary_queue to notify primary server of any errors or completion
+        primary_queue = primary_queue_name(job.primary_url)
         command_dict = {'command': 'COMPLETE_JOB', 'job_uuid': job.uuid}
-        enqueue_command(redis_connection(), primary_queue, command_dict)
+        command_transport().enqueue_command(
+            redis_connection(), primary_queue, command_dict)
 
     def kill_job(self, command_dict):
         """
@@ -170,36 +327,72 @@ class WorkerServer:
                         'job_uuid': <uuid>}
         """
         # ensure the command makes sense
-        if self.node.status == Node.STATUS_RUNNING and \
-           self._job_uuid == command_dict['job_uuid']:
-            try:
-                kill_process_tree(self._job_pid)
-            except Exception as e:
-                logger.warning(
-                    "exception occurred while killing pid {}: {}".
-                    format(self._job_pid, e))
+        job_uuid = command_dict['job_uuid']
+        with self._lock:
+            job_pid = self._job_pids.get(job_uuid)
+            if job_pid is None and job_uuid in self._starting_jobs:
+                # the job is RUNNING but has no pid yet, so kill it once
+                # it does (see set_node_status)
+                self._pending_kills.add(job_uuid)
+                logger.info(
+                    "job {} is starting, killing it once started".
+                    format(job_uuid))
+                return
+
+        if job_pid is not None:
+            self._kill_job_process(job_pid)
         else:
             logger.warning("command {} ignored".format(command_dict))
 
+    def _kill_job_process(self, job_pid):
+        try:
+            kill_process_tree(job_pid)
+        except Exception as e:
+            logger.warning(
+                "exception occurred while killing pid {}: {}".
+                format(job_pid, e))
+
     def update_status(self, command_dict):
         """
         handle command to update global status of this node
 
         command format {'command': 'UPDATE_STATUS'}
         """
-        # just save it as Node redis entity
-        Node[self.node.name] = self.node
+        # just save it as Node redis entity (one per slot)
+        with self._lock:
+            Node.set_many((node.name, node) for node in self._slot_nodes)
 
-    def set_node_status(self, status, job_uuid=None, job_pid=None):
+    def set_node_status(
+            self,
+            status,
+            job_uuid=None,
+            job_pid=None,
+            slot=0):
         """
         Will be called by dispatcher to set node status as it
         waits on queue (WAITING) and as it starts processing (RUNNING)
 
-        Also sets hidden worker attributes
+        Also tracks the pid of the job being run (for kill_job), killing
+        the job right away if it was killed while starting
+
+        slot:  the slot whose status to set
         """
-        self._node.status = status
-        self._job_uuid = job_uuid
-        self._job_pid = job_pid
+        node = self._slot_nodes[slot]
+        killed = False
+        with self._lock:
+            if node.job_uuid is not None and node.job_uuid != job_uuid:
+                self._job_pids.pop(node.job_uuid, None)
+            if job_pid is not None:
+                self._starting_jobs.discard(job_uuid)
+                killed = job_uuid in self._pending_kills
+                self._pending_kills.discard(job_uuid)
+                self._job_pids[job_uuid] = job_pid
+            node.status = status
+            node.job_uuid = job_uuid
+
+        if killed:
+            logger.info("killing started job {}".format(job_uuid))
+            self._kill_job_process(job_pid)
 
     def _setup_job_dir(self, job):
         """
@@ -246,17 +439,61 @@ class WorkerServer:
         output_dir = os.path.join(job_data_dir, "output")
         zipdir(output_dir, output_zip_name)
 
-    def _run_subprocess(self, command, job, job_data_log):
-        """ run command in a subproc and return the popen_proc """
-        command_args = command.split()
+    def _command_args(self, job):
+        """ model command of the job with its input and output dir """
+        command_args = self.model_commands[job.model].split()
         input_dir = os.path.join(self.data_dir, job.uuid, "input")
         output_dir = os.path.join(self.data_dir, job.uuid, "output")
         command_args.append(os.path.realpath(input_dir))
         command_args.append(os.path.realpath(output_dir))
-        command_str = subprocess.list2cmdline(command_args)
-        logger.info("running command {}".format(command_str))
+        logger.info("running command {}".format(
+            subprocess.list2cmdline(command_args)))
+        return command_args
+
+    def _run_subprocess(self, job, job_data_log):
+        """ run the job's command in a subproc and return the popen_proc """
         return subprocess.Popen(
-                        command_args,
+                        self._command_args(job),
                         shell=False,
                         stdout=job_data_log,
                         stderr=job_data_log)
+
+
+class WorkerSlot(object):
+    """
+    Implements 'CommandHandler interface' for one of the slots of a
+    WorkerServer, so that each slot processes queue commands (and reports
+    its status) independently of the other slots
+    """
+
+    def __init__(self, worker, slot):
+        self.worker = worker
+        self.slot = slot
+        self.dispatch = {
+            'PROCESS_JOB': self.process_job
+        }
+
+    @property
+    def node(self):
+        return self.worker._slot_nodes[self.slot]
+
+    def reclaim_commands(self, command_dicts):
+        self.worker.reclaim_commands(command_dicts)
+
+    def process_job(self, command_dict):
+        self.worker.process_job(command_dict, slot=self.slot)
+
+    def set_node_status(self, status):
+        self.worker.set_node_status(status, slot=self.slot)
+
+
+def auto_slots(slot_memory):
+    """
+    Number of slots a worker can run given the cpus and available memory
+    of this machine
+
+    Args:
+        slot_memory (int):  MB of memory each slot is expected to need
+    """
+    memory_slots = psutil.virtual_memory().available // (slot_memory * 2**20)
+    return int(max(1, min(psutil.cpu_count(), memory_slots)))
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of command decoding
+
+Compares json_loads_datetime (which attempts to load every string as a
+datetime) with schema based decode_command for each modelrunner command
+
+Does not need redis
+"""
+
+import argparse
+import timeit
+import uuid
+from datetime import datetime
+
+from modelrunner.utils import json_dumps_datetime, json_loads_datetime
+from modelrunner.redis_utils import decode_command, register_command
+
+parser = argparse.ArgumentParser(description="Benchmark command decoding")
+parser.add_argument("--number", type=int, default=100000,
+                    help="number of decodes per measurement")
+args = parser.parse_args()
+
+# a command with a datetime to show the cost of declared datetimes
+register_command('BENCHMARK_DATETIME', datetime_attrs=('created',))
+
+job_uuid = str(uuid.uuid4())
+commands = [
+    {'command': 'PROCESS_JOB', 'job_uuid': job_uuid},
+    {'command': 'COMPLETE_JOB', 'job_uuid': job_uuid},
+    {'command': 'KILL_JOB', 'job_uuid': job_uuid},
+    {'command': 'UPDATE_STATUS'},
+    {'command': 'BENCHMARK_DATETIME', 'job_uuid': job_uuid,
+     'created': datetime.utcnow()}
+]
+
+print("{:<20} {:>14} {:>14} {:>8}".format(
+    "command", "before (us)", "after (us)", "speedup"))
+for command_dict in commands:
+    dump = json_dumps_datetime(command_dict)
+    assert json_loads_datetime(dump) == decode_command(dump)
+
+    before = min(timeit.repeat(
+        lambda: json_loads_datetime(dump), number=args.number, repeat=3))
+    after = min(timeit.repeat(
+        lambda: decode_command(dump), number=args.number, repeat=3))
+    print("{:<20} {:>14.2f} {:>14.2f} {:>7.1f}x".format(
+        command_dict['command'],
+        before * 1e6 / args.number,
+        after * 1e6 / args.number,
+        before / after))
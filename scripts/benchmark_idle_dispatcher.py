@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of idle Dispatchers
+
+Counts the redis commands an idle node (a dispatcher waiting on empty
+queues) issues per minute and measures how long it takes to stop
+
+Needs redis (the commands of all clients are counted, so use an otherwise
+idle redis)
+
+Leased dispatchers (--lease_timeout > 0) over lists poll their queues once
+per second (see ListTransport.idle_timeout), so they issue a script and a
+blocking move per second (plus lease renewals) and take up to a second to
+stop
+"""
+
+import argparse
+import time
+import uuid
+from threading import Thread
+
+from modelrunner.dispatcher import Dispatcher
+from modelrunner.settings import initialize, redis_connection
+
+parser = argparse.ArgumentParser(description="Benchmark idle dispatchers")
+parser.add_argument("--redis_url", default="redis://localhost:6379",
+                    help="redis to benchmark against")
+parser.add_argument("--transport", default="lists",
+                    help="transport of commands (lists or streams)")
+parser.add_argument("--seconds", type=float, default=10,
+                    help="seconds to stay idle for")
+parser.add_argument("--lease_timeout", type=float, default=0,
+                    help="lease_timeout of the dispatcher")
+parser.add_argument("--queues", type=int, default=3,
+                    help="number of queues to wait on")
+args = parser.parse_args()
+
+initialize(args.redis_url, transport=args.transport)
+redis_conn = redis_connection()
+
+
+class IdleCommandHandler(object):
+    dispatch = {}
+
+    def set_node_status(self, status):
+        pass
+
+
+def command_count():
+    """ number of commands redis processed (excluding INFO) """
+    stats = redis_conn.info("commandstats")
+    return sum(stat['calls'] for name, stat in stats.items()
+               if name != "cmdstat_info")
+
+
+name = "benchmark_{}".format(uuid.uuid4())
+queue_names = ["modelrunner:benchmark:{}:{}".format(name, i)
+               for i in range(args.queues)]
+dispatcher = Dispatcher(
+    redis_conn,
+    IdleCommandHandler(),
+    queue_names,
+    [],
+    processing_name="modelrunner:benchmark:{}:processing".format(name),
+    lease_timeout=args.lease_timeout,
+    name=name)
+
+queue_thread = Thread(target=dispatcher.wait_for_queue_commands)
+queue_thread.start()
+# let it settle into waiting
+time.sleep(1)
+
+before = command_count()
+time.sleep(args.seconds)
+commands = command_count() - before
+
+start = time.time()
+dispatcher.stop_processing_queue({'command': 'STOP_PROCESSING_QUEUE'})
+queue_thread.join()
+stop_time = time.time() - start
+
+redis_conn.delete(*queue_names)
+print("{:<30} {:>10.1f}".format(
+    "commands per idle minute", commands * 60.0 / args.seconds))
+print("{:<30} {:>10.3f}".format("seconds to stop", stop_time))
@@ -20,7 +20,12 @@ parse_command_line()
 parse_config_file(config.options.config_file)
 
 # initialize the global application settings
-initialize(config.options.redis_url)
+initialize(
+    config.options.redis_url,
+    codec=config.options.codec,
+    transport=config.options.transport,
+    stream_maxlen=config.options.stream_maxlen,
+    stream_count=config.options.stream_count)
 
 primary_server = PrimaryServer(
                     config.options.primary_url,
@@ -16,7 +16,10 @@ parse_command_line()
 parse_config_file(config.options.config_file)
 
 # initialize the global application settings
-modelrunner.settings.initialize(config.options.redis_url)
+modelrunner.settings.initialize(
+    config.options.redis_url,
+    codec=config.options.codec)
 
-for uuid in [l.rstrip() for l in sys.stdin.readlines()]:
-    del modelrunner.Job[uuid]
+with modelrunner.Job.batch() as batch:
+    for uuid in [l.rstrip() for l in sys.stdin.readlines()]:
+        del batch[uuid]
@@ -1,7 +1,11 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 """
-Script to list job data from Redis DB
+Script to list job data from Redis DB as csv
+
+e.g. to list the failed jobs of a model:
+
+    job_list.py --status=FAILED --job_model=test
 """
 
 import csv
@@ -10,33 +14,63 @@ from modelrunner import config
 import modelrunner
 import modelrunner.settings
 
-from tornado.options import parse_command_line, parse_config_file
-from functools import reduce
+from tornado.options import define, parse_command_line, parse_config_file
 
 # Prevents this script from failing when output is piped
 # to another process
 from signal import signal, SIGPIPE, SIG_DFL
 signal(SIGPIPE, SIG_DFL)
 
+define("status", default=None, help="only list jobs with this status")
+define("job_model", default=None, help="only list jobs of this model")
+
 # so we can load config via cmd line args
 parse_command_line()
 parse_config_file(config.options.config_file)
 
 # initialize the global application settings
-modelrunner.settings.initialize(config.options.redis_url)
+modelrunner.settings.initialize(
+    config.options.redis_url,
+    codec=config.options.codec)
+
+# number of jobs read from redis at a time
+BATCH_SIZE = 1000
 
-jobs = modelrunner.Job.values()
-if(len(jobs) > 0):
-    # order descending
-    jobs.sort(key=lambda job: job.created, reverse=True)
-    job_dicts = [job.__dict__ for job in jobs]
-    # convert date formats
-    for job_dict in job_dicts:
-       job_dict['created'] = job_dict['created'].strftime("%Y-%m-%dT%H:%M:%S.%f") 
 
-    key_sets = [set(job_dict.keys()) for job_dict in job_dicts]
-    all_keys = reduce(set.union, key_sets)
+def iter_jobs(batch_size=BATCH_SIZE, **criteria):
+    """
+    Yield all jobs (matching criteria, see Job.find), most recently
+    created first
 
-    dict_writer = csv.DictWriter(sys.stdout, list(all_keys))
-    dict_writer.writer.writerow(list(all_keys))
-    dict_writer.writerows(job_dicts)
+    Only the keys are read up front (so that jobs created meanwhile do
+    not shift the batches), jobs are read batch_size at a time so that
+    memory use does not grow with the size of the jobs
+    """
+    keys = modelrunner.Job.page_keys(**criteria)
+    for i in range(0, len(keys), batch_size):
+        for job in modelrunner.Job.get_many(keys[i:i + batch_size]):
+            # skip jobs deleted since the keys were read
+            if job is not None:
+                yield job
+
+
+# only the matching jobs are read (via the job indexes)
+criteria = {}
+if config.options.status is not None:
+    criteria['status'] = config.options.status
+if config.options.job_model is not None:
+    criteria['model'] = config.options.job_model
+jobs = iter_jobs(**criteria)
+
+# all jobs share the attributes of a default Job
+all_keys = list(modelrunner.Job().__dict__.keys())
+dict_writer = None
+for job in jobs:
+    if dict_writer is None:
+        dict_writer = csv.DictWriter(sys.stdout, all_keys)
+        dict_writer.writer.writerow(all_keys)
+
+    job_dict = job.__dict__
+    # convert date formats
+    job_dict['created'] = job_dict['created'].strftime("%Y-%m-%dT%H:%M:%S.%f")
+    dict_writer.writerow(job_dict)
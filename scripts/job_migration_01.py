@@ -13,6 +13,7 @@ from modelrunner.settings import (
     initialize,
     redis_connection
 )
+from modelrunner.redisent import STORAGE_BLOB
 
 from tornado.options import (
     parse_command_line,
@@ -37,7 +38,9 @@ parse_command_line()
 parse_config_file(config.options.config_file)
 
 # initialize the global application settings
-initialize(config.options.redis_url)
+initialize(
+    config.options.redis_url,
+    codec=config.options.codec)
 
 
 # <block> Code to map pickled classes to new namespace
@@ -68,9 +71,11 @@ def loads(str):
 # </block> Code to map pickled classes to new namespace
 
 
-pickled_objs = redis_connection.hgetall("modelrunner:jobs")
-jobs = [loads(pobj[1]) for pobj in pickled_objs.items()]
+pickled_objs = redis_connection().hscan_iter("modelrunner:jobs")
+jobs = (loads(pobj) for uuid, pobj in pickled_objs)
 
-# write them back as correct instance types
-for job in jobs:
-    Job[job.uuid] = job
+# write them back as correct instance types in place of the pickled ones,
+# i.e. in the single hash that job_migration_02 then splits per job
+with Job.storage_view(STORAGE_BLOB).batch() as batch:
+    for job in jobs:
+        batch[job.uuid] = job
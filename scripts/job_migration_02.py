@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Script to migrate jobs stored as json strings in one hash to
+one hash per job (see Job._storage)
+"""
+
+from modelrunner import (
+    config,
+    Job
+)
+
+from modelrunner.settings import initialize
+from modelrunner.redisent import STORAGE_BLOB
+
+from tornado.options import (
+    parse_command_line,
+    parse_config_file
+)
+
+# so we can load config via cmd line args
+parse_command_line()
+parse_config_file(config.options.config_file)
+
+# initialize the global application settings
+initialize(
+    config.options.redis_url,
+    codec=config.options.codec)
+
+Job.migrate_storage(STORAGE_BLOB)
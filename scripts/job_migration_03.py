@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Script to migrate jobs and nodes from one codec to another
+(e.g. from json to msgpack)
+
+The target codec is the configured codec, the source codec is passed via
+--from_codec
+
+Stop all modelrunner processes before running this
+"""
+
+from modelrunner import (
+    config,
+    Job,
+    Node
+)
+
+from modelrunner.settings import initialize
+from modelrunner.redisent import get_codec
+
+from tornado.options import (
+    define,
+    parse_command_line,
+    parse_config_file
+)
+
+define(
+    "from_codec",
+    default="json",
+    help="codec jobs are currently stored with")
+
+# so we can load config via cmd line args
+parse_command_line()
+parse_config_file(config.options.config_file)
+
+# initialize the global application settings
+initialize(
+    config.options.redis_url,
+    codec=config.options.codec)
+
+from_codec = get_codec(config.options.from_codec)
+Job.migrate_codec(from_codec)
+Node.migrate_codec(from_codec)
@@ -48,21 +48,30 @@ parse_command_line()
 parse_config_file(config.options.config_file)
 
 # initialize the global application settings
-initialize(config.options.redis_url)
+initialize(
+    config.options.redis_url,
+    codec=config.options.codec)
 
-jobs = Job.values()
+jobs = Job.iter_values()
 
 # get the log file for all jobs
-for job in jobs:
-
-    log_on_primary = test_url(job.log_url())
-    job.on_primary = False
-    log_on_worker = test_url(job.log_url())
-
-    if not log_on_primary and log_on_worker:
-        logger.info("job {} log not on primary".format(job.uuid))
-        # then job.on_primary should be False and we need to retrieve it
-        Job[job.uuid] = job
-        # push message to primary to get data for job
-        primary_queue = primary_queue_name(job.primary_url)
-        redis_connection.rpush(primary_queue, job.uuid)
+migrated_jobs = []
+with Job.batch() as batch:
+    for job in jobs:
+
+        log_on_primary = test_url(job.log_url())
+        job.on_primary = False
+        log_on_worker = test_url(job.log_url())
+
+        if not log_on_primary and log_on_worker:
+            logger.info("job {} log not on primary".format(job.uuid))
+            # then job.on_primary should be False and we need to retrieve it
+            batch[job.uuid] = job
+            migrated_jobs.append(job)
+
+# push message to primary to get data for job (once the jobs are written)
+pipe = redis_connection().pipeline()
+for job in migrated_jobs:
+    primary_queue = primary_queue_name(job.primary_url)
+    pipe.rpush(primary_queue, job.uuid)
+pipe.execute()
@@ -9,6 +9,7 @@ See config.py or pass --help to command for command line args
 """
 
 import sys
+import time
 import logging
 from threading import Thread
 from tornado.options import parse_command_line, parse_config_file
@@ -18,6 +19,7 @@ from modelrunner import (
     config,
     PrimaryServer,
     Dispatcher,
+    Job,
     __version__
 )
 
@@ -26,8 +28,10 @@ from modelrunner.settings import (
     redis_connection,
     node_channel_name,
     all_nodes_channel_name,
-    primary_queue_name
+    primary_queue_name,
+    processing_queue_name
 )
+from modelrunner.result_cache import ResultCache
 
 # setup log
 logger = logging.getLogger('modelrunner')
@@ -41,22 +45,86 @@ parse_command_line()
 parse_config_file(config.options.config_file)
 
 # initialize the global application settings
-initialize(config.options.redis_url)
+initialize(
+    config.options.redis_url,
+    codec=config.options.codec,
+    transport=config.options.transport,
+    stream_maxlen=config.options.stream_maxlen,
+    stream_count=config.options.stream_count)
+
+# jobs are not found until migrated to per job hashes
+Job.check_storage()
 
 # get the command_ keys
 command_dict = config.options.group_dict("model_command")
 
+# index completed jobs so that matching jobs reuse their results
+result_cache = None
+if config.options.result_cache_size > 0:
+    result_cache = ResultCache(
+        model_commands=command_dict,
+        max_entries=config.options.result_cache_size)
+
 primary_handler = PrimaryServer(
                     config.options.primary_url,
-                    config.options.data_dir)
+                    config.options.data_dir,
+                    worker_fetch_limit=config.options.worker_fetch_limit,
+                    result_cache=result_cache)
 channels = [node_channel_name(primary_handler.node.name),
             all_nodes_channel_name()]
+if config.options.asyncio:
+    if config.options.lease_timeout > 0 or\
+            config.options.transport != "lists":
+        logger.error(
+            "asyncio requires the lists transport and no lease_timeout")
+        sys.exit(1)
+
+    # run queue and channel loops on one event loop
+    import asyncio
+    from modelrunner.async_dispatcher import AsyncDispatcher
+    from modelrunner.settings import async_redis_connection
+
+    async def run_primary():
+        primary = AsyncDispatcher(
+                    async_redis_connection(),
+                    primary_handler,
+                    primary_queue_name(primary_handler.node.name),
+                    channels,
+                    slots=config.options.primary_slots,
+                    name=primary_handler.node.name)
+        await primary.run()
+
+    asyncio.run(run_primary())
+    sys.exit(0)
+
 primary = Dispatcher(
             redis_connection(),
             primary_handler,
             primary_queue_name(primary_handler.node.name),
-            channels)
+            channels,
+            processing_name=processing_queue_name(primary_handler.node.name),
+            lease_timeout=config.options.lease_timeout,
+            slots=config.options.primary_slots,
+            name=primary_handler.node.name)
+
+
+def requeue_expired_jobs():
+    """
+    periodically requeue the jobs of workers that stopped renewing their
+    lease (e.g. crashed)
+    """
+    while True:
+        time.sleep(config.options.lease_timeout / 2.0)
+        try:
+            primary_handler.requeue_expired_jobs()
+        except Exception as e:
+            logger.error("failed to requeue expired jobs: {}".format(e))
+
 
 # continuously wait for jobs to complete and for status inquiries
 Thread(target=primary.wait_for_queue_commands).start()
 Thread(target=primary.wait_for_channel_commands).start()
+if config.options.lease_timeout > 0:
+    reaper = Thread(target=requeue_expired_jobs)
+    reaper.daemon = True
+    reaper.start()
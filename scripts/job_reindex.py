@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Script to rebuild the job index used for paging through jobs
+
+Needed once for jobs stored by earlier versions of modelrunner
+"""
+
+import modelrunner
+from modelrunner import config
+
+# setup config options
+from tornado.options import parse_command_line, parse_config_file
+
+# so we can load config via cmd line args
+parse_command_line()
+parse_config_file(config.options.config_file)
+
+# initialize the global application settings
+modelrunner.settings.initialize(
+    config.options.redis_url,
+    codec=config.options.codec)
+
+modelrunner.Job.reindex()
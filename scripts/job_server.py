@@ -13,6 +13,9 @@ import logging
 
 import modelrunner
 from modelrunner.settings import initialize
+from modelrunner.admission import AdmissionControl
+from modelrunner.scheduler import RuntimeScheduler
+from modelrunner.result_cache import ResultCache
 from modelrunner import config
 from modelrunner import server
 from tornado.options import parse_command_line, parse_config_file
@@ -36,32 +39,91 @@ parse_command_line()
 parse_config_file(config.options.config_file)
 
 # initialize the global application settings
-initialize(config.options.redis_url)
+initialize(
+    config.options.redis_url,
+    codec=config.options.codec,
+    transport=config.options.transport,
+    stream_maxlen=config.options.stream_maxlen,
+    stream_count=config.options.stream_count)
+
+# jobs are not found until migrated to per job hashes
+modelrunner.Job.check_storage()
+
+# serve frequently polled jobs from memory
+if config.options.job_cache_size > 0:
+    modelrunner.Job.enable_cache(
+        size=config.options.job_cache_size,
+        ttl=config.options.job_cache_ttl)
 
 # get the command keys
 command_dict = config.options.group_dict("model_command")
 models = command_dict.keys()
 
+# run jobs estimated to be short first
+scheduler = None
+if config.options.short_job_seconds > 0:
+    scheduler = RuntimeScheduler(
+        short_job_seconds=config.options.short_job_seconds,
+        max_short_wait=config.options.max_short_wait)
+
+# complete jobs matching completed ones with their results
+result_cache = None
+if config.options.result_cache_size > 0:
+    result_cache = ResultCache(
+        model_commands=command_dict,
+        max_entries=config.options.result_cache_size)
+
 primary_server = modelrunner.PrimaryServer(config.options.primary_url,
-                                           config.options.data_dir)
+                                           config.options.data_dir,
+                                           scheduler=scheduler,
+                                           result_cache=result_cache)
 
 app_settings = {
     "static_path": config.options.static_path,
 }
 
+# reject jobs beyond the queue and disk limits
+admission = AdmissionControl(
+    config.options.data_dir,
+    max_queue_depth=config.options.max_queue_depth,
+    max_pending_mb=config.options.max_pending_mb,
+    min_free_mb=config.options.min_free_disk_mb,
+    model_limits=config.options.model_limits)
+
+job_handler_args = dict(primary_server=primary_server,
+                        page_size=config.options.page_size,
+                        admission=admission)
+
+# share one job events subscription among all event streams
+job_events = server.JobEventListener()
+job_events.start()
+
 job_id_regex = "([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})"
 application = tornado.web.Application([
         (r"/", server.MainHandler),
         (r"/jobs/submit", server.SubmitJobForm, dict(models=models)),
-        (r"/jobs", server.JobHandler, dict(primary_server=primary_server)),
+        (r"/jobs", server.JobHandler, job_handler_args),
+        (r"/jobs/batch", server.JobBatchHandler,
+            dict(primary_server=primary_server, admission=admission)),
         (r"/jobs/{}".format(job_id_regex),
-            server.JobHandler, dict(primary_server=primary_server)),
+            server.JobHandler, job_handler_args),
+        (r"/jobs/events", server.JobEventsHandler,
+            dict(job_events=job_events)),
+        (r"/cache", server.ResultCacheHandler,
+            dict(result_cache=result_cache)),
+        (r"/jobs/{}/events".format(job_id_regex),
+            server.JobEventsHandler, dict(job_events=job_events)),
+        (r"/jobs/{}/wait".format(job_id_regex),
+            server.JobWaitHandler, dict(job_events=job_events)),
         (r"/jobs/{}/kill".format(job_id_regex),
             server.JobKillHandler, dict(primary_server=primary_server)),
-        (r"/status", server.StatusHandler, dict(primary_server=primary_server)),
+        (r"/status", server.StatusHandler,
+            dict(primary_server=primary_server,
+                 refresh_interval=config.options.status_refresh_interval)),
         (r"/admin/(.*)",
          server.AdminHandler,
-         dict(admin_key=config.options.admin_key))
+         dict(admin_key=config.options.admin_key,
+              page_size=config.options.page_size))
         ],
         template_path=config.options.template_path,
         debug=config.options.debug,
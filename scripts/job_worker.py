@@ -17,15 +17,15 @@ from modelrunner import (
     config,
     WorkerServer,
     Dispatcher,
+    Job,
     __version__
 )
+from modelrunner.worker_server import auto_slots
 
 from modelrunner.settings import (
     initialize,
     redis_connection,
-    job_queue_name,
-    node_channel_name,
-    all_nodes_channel_name
+    processing_queue_name
 )
 
 from tornado.options import parse_command_line, parse_config_file
@@ -42,22 +42,77 @@ parse_command_line()
 parse_config_file(config.options.config_file)
 
 # initialize the global application settings
-initialize(config.options.redis_url)
+initialize(
+    config.options.redis_url,
+    codec=config.options.codec,
+    transport=config.options.transport,
+    stream_maxlen=config.options.stream_maxlen,
+    stream_count=config.options.stream_count)
+
+# jobs are not found until migrated to per job hashes
+Job.check_storage()
 
 # get the command_ keys
 command_dict = config.options.group_dict("model_command")
 
+slots = config.options.slots
+if slots == 0:
+    slots = auto_slots(config.options.slot_memory)
+    logger.info("running {} jobs at once".format(slots))
+
+# wait on the queues of all models (and priorities) at once
+models = config.options.models or [config.options.model]
+
+if config.options.asyncio:
+    if config.options.lease_timeout > 0 or\
+            config.options.transport != "lists":
+        logger.error(
+            "asyncio requires the lists transport and no lease_timeout")
+        sys.exit(1)
+
+    # run queue and channel loops and jobs on one event loop
+    import asyncio
+    from modelrunner.async_dispatcher import AsyncDispatcher
+    from modelrunner.async_worker_server import AsyncWorkerServer
+    from modelrunner.settings import async_redis_connection
+
+    worker_handler = AsyncWorkerServer(
+                        config.options.worker_url,
+                        config.options.data_dir,
+                        models,
+                        command_dict,
+                        slots=slots)
+
+    async def run_worker():
+        worker = AsyncDispatcher(
+                    async_redis_connection(),
+                    worker_handler,
+                    [Job.queue_names(model) for model in models],
+                    worker_handler.channel_names,
+                    slots=slots,
+                    queue_weights=config.options.model_weights or None,
+                    name=worker_handler.node.name)
+        await worker.run()
+
+    asyncio.run(run_worker())
+    sys.exit(0)
+
 worker_handler = WorkerServer(
                     config.options.worker_url,
                     config.options.data_dir,
-                    config.options.model,
-                    command_dict)
-channels = [node_channel_name(worker_handler.node.name),
-            all_nodes_channel_name()]
+                    models,
+                    command_dict,
+                    slots=slots)
 worker = Dispatcher(redis_connection(),
                     worker_handler,
-                    job_queue_name(config.options.model),
-                    channels)
+                    [Job.queue_names(model) for model in models],
+                    worker_handler.channel_names,
+                    processing_name=processing_queue_name(
+                        worker_handler.node.name),
+                    lease_timeout=config.options.lease_timeout,
+                    slots=slots,
+                    queue_weights=config.options.model_weights or None,
+                    name=worker_handler.node.name)
 
 # start listening for commands on queue and channels in bg
 Thread(target=worker.wait_for_queue_commands).start()
@@ -14,16 +14,19 @@ parser = argparse.ArgumentParser(description="Write CSV of job data to Redis")
 parser.add_argument("--redis_url",
                     default="redis://@localhost:6379",
                     help="URL to connect to Redis")
+parser.add_argument("--codec",
+                    default="json",
+                    help="codec jobs are stored with (json or msgpack)")
 parser.add_argument("csv_file",
                     help="csv of jobs with header corresponding to Job fields")
 args = parser.parse_args()
 
 # initialize the global application settings
-modelrunner.settings.initialize(args.redis_url)
+modelrunner.settings.initialize(args.redis_url, codec=args.codec)
 
-with open(args.csv_file) as csvfile:
+with open(args.csv_file) as csvfile, Job.batch() as batch:
     reader = csv.DictReader(csvfile)
     for job_dict in reader:
         job = Job(**job_dict)
-        Job[job_dict['uuid']] = job
+        batch[job_dict['uuid']] = job
 
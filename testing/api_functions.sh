@@ -23,13 +23,14 @@ function mr_create_job {
     local job_name=$1
     local job_model=$2
     local job_file=$3
+    local job_priority=${4:-normal}
     # temp file for response
     local tmpfile=$(mktemp -p $MR_TMP_DIR)
     if [[ $job_file =~ ^http[s]?:// ]]
     then
-        curl -s -F "job_name=$job_name" -F "model=$job_model" -F "zip_url=$job_file" $MR_SERVER/jobs > $tmpfile
+        curl -s -F "job_name=$job_name" -F "model=$job_model" -F "priority=$job_priority" -F "zip_url=$job_file" $MR_SERVER/jobs > $tmpfile
     else
-        curl -s -F "job_name=$job_name" -F "model=$job_model" -F "zip_file=$job_file" $MR_SERVER/jobs > $tmpfile
+        curl -s -F "job_name=$job_name" -F "model=$job_model" -F "priority=$job_priority" -F "zip_file=$job_file" $MR_SERVER/jobs > $tmpfile
     fi
     # check if call was OK
     cat $tmpfile | mr_get_val_from_json message | grep OK > /dev/null
@@ -58,25 +59,17 @@ function mr_get_jobs {
 }
 
 function mr_wait_for_status {
-    # wait for job to change status
+    # wait (up to max_secs seconds) for job to change status
     local job_id=$1
     local new_status=$2
-    local max_tries=$3
-    local job_status=$(mr_job_status $job_id)
-    local tries=0
-    while [ "$job_status" != "$new_status" -a $tries -lt $max_tries ]
-    do
-        sleep 1 # wait a second to test again
-        job_status=$(mr_job_status $job_id)
-        echo "job $job_id current status $job_status"
-        tries=$(($tries + 1)) 
-        echo "tries $tries"
-    done
-    if [ $tries -ge $max_tries ]
+    local max_secs=$3
+    local tmpfile=$(mktemp -p $MR_TMP_DIR)
+    curl -s "$MR_SERVER/jobs/$job_id/wait?timeout=$max_secs&until=$new_status" > $tmpfile
+    local job_status=$(cat $tmpfile | mr_get_val_from_json status)
+    echo "job $job_id current status $job_status"
+    if [ "$job_status" != "$new_status" ]
     then
         echo "job $job_id stuck in $job_status state.  Expected it to go to $new_status"
         exit 1
     fi
 }
-
-
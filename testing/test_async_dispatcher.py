@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Test the asyncio dispatcher (see modelrunner.async_dispatcher)
+"""
+import asyncio
+import time
+from modelrunner.settings import (
+    initialize,
+    redis_connection,
+    async_redis_connection
+)
+from modelrunner.redis_utils import enqueue_command
+from modelrunner.utils import json_dumps_datetime
+from modelrunner.async_dispatcher import AsyncDispatcher
+from modelrunner.node import Node
+
+# initialize
+initialize()
+
+
+class AsyncCommandHandler(object):
+    """
+    Implement 'CommandHandler interface' with a coroutine processing jobs
+    and a plain function killing them
+    """
+
+    def __init__(self, sleep_time=1):
+        self.sleep_time = sleep_time
+        self.running = set()
+        self.processed = []
+        self.killed = []
+        self.statuses = {}
+        self.dispatch = {
+            'PROCESS_JOB': self.process_job,
+            'KILL_JOB': self.kill_job
+        }
+
+    def slot(self, slot):
+        return AsyncCommandHandlerSlot(self, slot)
+
+    async def process_job(self, command_dict):
+        self.running.add(command_dict['job_uuid'])
+        await asyncio.sleep(self.sleep_time)
+        self.running.discard(command_dict['job_uuid'])
+        self.processed.append(command_dict['job_uuid'])
+
+    def kill_job(self, command_dict):
+        # killed while the job is running
+        if command_dict['job_uuid'] in self.running:
+            self.killed.append(command_dict['job_uuid'])
+
+    def set_node_status(self, status, slot=0):
+        self.statuses[slot] = status
+
+
+class AsyncCommandHandlerSlot(object):
+
+    def __init__(self, handler, slot):
+        self.handler = handler
+        self.slot = slot
+        self.dispatch = handler.dispatch
+
+    def set_node_status(self, status):
+        self.handler.set_node_status(status, slot=self.slot)
+
+
+def test_async_dispatcher():
+    """
+    queue commands are processed concurrently by slots and channel commands
+    are processed meanwhile
+    """
+    redis_conn = redis_connection()
+    redis_conn.flushdb()
+    handler = AsyncCommandHandler()
+
+    for i in range(2):
+        enqueue_command(
+            redis_conn, "async", {'command': 'PROCESS_JOB', 'job_uuid': i})
+
+    async def run():
+        dispatcher = AsyncDispatcher(
+            async_redis_connection(),
+            handler,
+            "async",
+            ["async"],
+            slots=2)
+        publisher = async_redis_connection()
+
+        async def control():
+            await asyncio.sleep(0.5)
+            for command_dict in [
+                    {'command': 'KILL_JOB', 'job_uuid': 0},
+                    {'command': 'STOP_PROCESSING_QUEUE'},
+                    {'command': 'STOP_PROCESSING_CHANNELS'}]:
+                await publisher.publish(
+                    "async", json_dumps_datetime(command_dict))
+
+        await asyncio.gather(dispatcher.run(), control())
+
+    start = time.time()
+    asyncio.run(run())
+
+    assert sorted(handler.processed) == [0, 1] and\
+        time.time() - start < 2 * handler.sleep_time,\
+        "queue commands should be processed concurrently"
+    assert handler.killed == [0],\
+        "channel commands should be processed while jobs run"
+    assert handler.statuses == {0: Node.STATUS_STOPPED,
+                                1: Node.STATUS_STOPPED},\
+        "slots should be stopped"
+
+    redis_conn.flushdb()
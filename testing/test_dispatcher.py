@@ -3,7 +3,7 @@ import time
 from threading import Thread
 from modelrunner.settings import redis_connection
 from modelrunner.redis_utils import enqueue_command, publish_command
-from modelrunner.dispatcher import Dispatcher
+from modelrunner.dispatcher import Dispatcher, WeightedQueueOrder
 from modelrunner.node import Node
 
 class PrimaryCommandHandler:
@@ -125,3 +125,148 @@ def test_primary_worker_scenario():
     publish_command(redis_connection(), "primary", stop_queue_command)
     publish_command(redis_connection(), "worker", stop_channel_command)
     publish_command(redis_connection(), "primary", stop_channel_command)
+
+
+def test_weighted_queue_order():
+    """
+    Queues are preferred in proportion to their weights and interleaved
+    """
+    order = WeightedQueueOrder(['a', 'b', 'c'], weights=[3, 1, 1])
+    served = []
+    for i in range(10):
+        index = order.order()[0]
+        order.served(index)
+        served.append(index)
+
+    assert [served.count(i) for i in range(3)] == [6, 2, 2],\
+        "queues should be served in proportion to weights"
+    assert served[:5] != [0, 0, 0, 1, 2],\
+        "heavier queue should be interleaved with the others"
+
+
+def test_queue_priorities():
+    """
+    Higher priority queues of any group are popped from first
+    """
+    dispatcher = Dispatcher(
+        redis_connection(),
+        WorkerCommandHandler(),
+        [['a:high', 'a'], ['b:high', 'b', 'b:low']],
+        [])
+    order = [dispatcher.queue_names[i] for i in
+             dispatcher._pop_order(WeightedQueueOrder(['a', 'b']))]
+    assert order == ['a:high', 'b:high', 'a', 'b', 'b:low'],\
+        "queues should be ordered by priority, then group"
+
+
+def test_stop_idle_queue():
+    """
+    An idle dispatcher sets its status once and stops promptly
+    """
+    class StatusCommandHandler(WorkerCommandHandler):
+        def set_node_status(self, status):
+            self.statuses.append(status)
+
+    handler = StatusCommandHandler()
+    handler.statuses = []
+    dispatcher = Dispatcher(
+        redis_connection(),
+        handler,
+        ["idle:high", "idle"],
+        [],
+        name="idle_test")
+
+    queue_thread = Thread(target=dispatcher.wait_for_queue_commands)
+    queue_thread.start()
+    time.sleep(2)
+    dispatcher.stop_processing_queue({'command': 'STOP_PROCESSING_QUEUE'})
+    queue_thread.join(1)
+
+    assert not queue_thread.is_alive(), "idle dispatcher should stop"
+    assert handler.statuses == [Node.STATUS_WAITING, Node.STATUS_STOPPED],\
+        "status should only be set on transitions"
+    assert not redis_connection().exists(dispatcher.stop_queue_name),\
+        "stop queue should be removed"
+
+
+def test_leased_idle_queue():
+    """
+    A dispatcher idly waiting on its queue via processing lists pops a
+    command as soon as it is queued
+    """
+    popped = []
+
+    class TimingCommandHandler(object):
+        dispatch = {
+            'PROCESS_JOB': lambda command_dict: popped.append(time.time())
+        }
+
+        def set_node_status(self, status):
+            pass
+
+    redis_conn = redis_connection()
+    dispatcher = Dispatcher(
+        redis_conn,
+        TimingCommandHandler(),
+        ["leased"],
+        [],
+        processing_name="leased:processing",
+        lease_timeout=5,
+        name="leased_test")
+
+    queue_thread = Thread(target=dispatcher.wait_for_queue_commands)
+    queue_thread.start()
+    time.sleep(1.3)
+    queued = time.time()
+    enqueue_command(redis_conn, "leased", {'command': 'PROCESS_JOB'})
+    time.sleep(0.5)
+    dispatcher.stop_processing_queue({'command': 'STOP_PROCESSING_QUEUE'})
+    queue_thread.join(2)
+
+    assert not queue_thread.is_alive(), "leased dispatcher should stop"
+    assert len(popped) == 1 and popped[0] - queued < 0.25,\
+        "command should be popped as soon as it is queued"
+    redis_conn.flushdb()
+
+
+def test_reclaimed_commands():
+    """
+    Commands left in the processing lists by a previous run are passed to
+    the handler's reclaim_commands before they are processed again
+    """
+    calls = []
+
+    class ReclaimCommandHandler(object):
+        dispatch = {
+            'PROCESS_JOB': lambda command_dict: calls.append(
+                ("process", command_dict))
+        }
+
+        def reclaim_commands(self, command_dicts):
+            calls.append(("reclaim", command_dicts))
+
+        def set_node_status(self, status):
+            pass
+
+    redis_conn = redis_connection()
+    dispatcher = Dispatcher(
+        redis_conn,
+        ReclaimCommandHandler(),
+        ["reclaimed"],
+        [],
+        processing_name="reclaimed:processing",
+        lease_timeout=5,
+        name="reclaimed_test")
+    command_dict = {'command': 'PROCESS_JOB', 'job_uuid': "left"}
+    enqueue_command(
+        redis_conn, dispatcher.slot_processing_names(0)[0], command_dict)
+
+    queue_thread = Thread(target=dispatcher.wait_for_queue_commands)
+    queue_thread.start()
+    time.sleep(1)
+    dispatcher.stop_processing_queue({'command': 'STOP_PROCESSING_QUEUE'})
+    queue_thread.join(2)
+
+    assert calls == [("reclaim", [command_dict]), ("process", command_dict)],\
+        "left commands should be reclaimed before they are processed"
+    redis_conn.flushdb()
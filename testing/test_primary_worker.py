@@ -4,8 +4,10 @@ Test the WorkerServer through various scenarios
 The PrimaryServer is not necessary for testing
 Though we need to server the input from some http server
 """
+import asyncio
 import os
 import shutil
+import threading
 import time
 from threading import Thread
 from modelrunner.settings import initialize,\
@@ -14,13 +16,25 @@ from modelrunner.settings import initialize,\
                                  node_channel_name,\
                                  primary_queue_name,\
                                  all_nodes_channel_name,\
-                                 worker_name
-
+                                 processing_queue_name,\
+                                 processing_registry_name,\
+                                 worker_name,\
+                                 command_transport,\
+                                 async_redis_connection,\
+                                 pending_input_name,\
+                                 dequeued_count_name
+
+import modelrunner.primary_server
+from modelrunner.utils import fetch_files_from_urls
 from modelrunner.redis_utils import enqueue_command,\
-                                    publish_command,\
-                                    get_all_commands
+                                    get_all_commands,\
+                                    lease_name
 
 from modelrunner import PrimaryServer, WorkerServer, Job, Node, Dispatcher
+from modelrunner.async_dispatcher import AsyncDispatcher
+from modelrunner.async_worker_server import AsyncWorkerServer
+from modelrunner.admission import AdmissionControl, AdmissionRejected
+from modelrunner.result_cache import ResultCache
 
 # initialize
 initialize()
@@ -61,12 +75,14 @@ def cleanup(config):
     redis_conn.flushdb()
 
 
-def setup_queued_job(config, job_name, input_file):
+def setup_queued_job(config, job_name, input_file,
+                     priority=Job.PRIORITY_NORMAL):
 
     # create a job to process
     job = Job(
             model=config["model"],
             name=job_name,
+            priority=priority,
             primary_url=config["primary_url"],
             primary_data_dir=config["primary_data_dir"])
 
@@ -120,9 +136,9 @@ def enqueue_worker_job(job):
     Submit job to queue for worker
     """
     redis_conn = redis_connection()
-    queue_name = job_queue_name(job.model)
+    queue_name = Job.queue_name(job.model, job.priority)
     command_dict = {'command': 'PROCESS_JOB', 'job_uuid': job.uuid}
-    enqueue_command(redis_conn, queue_name, command_dict)
+    command_transport().enqueue_command(redis_conn, queue_name, command_dict)
 
 
 def enqueue_complete_job(job):
@@ -132,35 +148,45 @@ def enqueue_complete_job(job):
     redis_conn = redis_connection()
     queue_name = primary_queue_name(job.primary_url)
     command_dict = {'command': 'COMPLETE_JOB', 'job_uuid': job.uuid}
-    enqueue_command(redis_conn, queue_name, command_dict)
+    command_transport().enqueue_command(redis_conn, queue_name, command_dict)
+
 
+def get_worker(config, lease_timeout=0, slots=1):
+    models = config["model"]
+    if not isinstance(models, list):
+        models = [models]
 
-def get_worker(config):
     worker_handler = WorkerServer(
                         config["worker_url"],
                         config["worker_data_dir"],
-                        config["model"],
-                        config["command_dict"])
-    channels = [node_channel_name(worker_handler.node.name),
-                all_nodes_channel_name()]
+                        models,
+                        config["command_dict"],
+                        slots=slots)
     worker = Dispatcher(redis_connection(),
                         worker_handler,
-                        job_queue_name(config["model"]),
-                        channels)
+                        [Job.queue_names(model) for model in models],
+                        worker_handler.channel_names,
+                        processing_name=processing_queue_name(
+                            worker_handler.node.name),
+                        lease_timeout=lease_timeout,
+                        slots=slots)
     return worker
 
 
-def get_primary(config):
+def get_primary(config, slots=1, result_cache=None, worker_fetch_limit=2):
     primary_handler = PrimaryServer(
                         config["primary_url"],
-                        config["primary_data_dir"])
+                        config["primary_data_dir"],
+                        worker_fetch_limit=worker_fetch_limit,
+                        result_cache=result_cache)
     channels = [node_channel_name(primary_handler.node.name),
                 all_nodes_channel_name()]
     primary = Dispatcher(
                 redis_connection(),
                 primary_handler,
                 primary_queue_name(primary_handler.node.name),
-                channels)
+                channels,
+                slots=slots)
     return primary
 
 
@@ -172,7 +198,7 @@ def publish(channel_name, command_dict, wait_time=0):
     if wait_time > 0:
         time.sleep(wait_time)
 
-    publish_command(redis_conn, channel_name, command_dict)
+    command_transport().publish_command(redis_conn, channel_name, command_dict)
 
 
 def make_publish_function(channel_name, command_dict, wait_time=0):
@@ -213,7 +239,7 @@ def test_run_good_bad():
 
     # stop waiting
     stop_queue_command = {'command': 'STOP_PROCESSING_QUEUE'}
-    enqueue_command(
+    command_transport().enqueue_command(
         redis_connection(),
         job_queue_name(model_name),
         stop_queue_command)
@@ -311,7 +337,7 @@ def test_primary_enqueue_kill():
     assert os.path.exists(path_to_input)
 
     def get_queued_commands():
-        return get_all_commands(
+        return command_transport().get_all_commands(
                 redis_connection(),
                 job_queue_name(model_name))
 
@@ -322,18 +348,107 @@ def test_primary_enqueue_kill():
     primary.command_handler.kill_job(job)
     assert Job[job.uuid].status == Job.STATUS_KILLED
 
+    # its command is left queued, but ignored by workers
     commands = get_queued_commands()
-    assert len(commands) == 0
+    assert len(commands) == 1 and commands[0]['job_uuid'] == job.uuid
+
+    worker = get_worker(config)
+    worker.command_handler.process_job(commands[0])
+    assert Job[job.uuid].status == Job.STATUS_KILLED,\
+        "killed job should not be run"
+    assert not os.path.exists(
+        os.path.join(config["worker_data_dir"], job.uuid)),\
+        "killed job should not be run"
 
     cleanup(config)
 
 
-def test_primary_complete():
-    """ test compete job """
+def test_kill_starting_job(monkeypatch):
+    """ test a job killed before its command is started is not run """
+    model_name = "test"
+    config = make_config(model_name)
+
+    worker = get_worker(config)
+    job = setup_queued_job(config, "killed_starting_test", "sleep_8.zip")
+    worker_handler = worker.command_handler
+    kill_command = {"command": "KILL_JOB", "job_uuid": job.uuid}
+
+    # kill the job after it is RUNNING but before it has a pid
+    prep_input = worker_handler._prep_input
+
+    def prep_input_then_kill(job):
+        prep_input(job)
+        worker_handler.kill_job(kill_command)
+
+    monkeypatch.setattr(worker_handler, "_prep_input", prep_input_then_kill)
+
+    start = time.time()
+    worker_handler.process_job({"command": "PROCESS_JOB",
+                                "job_uuid": job.uuid})
+    assert Job[job.uuid].status == Job.STATUS_KILLED and\
+        time.time() - start < 8,\
+        "job killed while starting should be killed once started"
+    assert len(worker_handler._starting_jobs) == 0 and\
+        len(worker_handler._pending_kills) == 0,\
+        "started job should not be tracked as starting"
+
+    cleanup(config)
+
+
+def test_primary_enqueue_many():
+    """ test enqueueing jobs in bulk """
     model_name = "test"
     config = make_config(model_name)
 
     primary = get_primary(config)
+
+    jobs = [Job(model_name, name="batch_test_{}".format(i))
+            for i in range(3)]
+    jobs[2].priority = Job.PRIORITY_HIGH
+    with open(os.path.join(config["primary_data_dir"], "bad.zip"), 'rb') as f:
+        primary.command_handler.enqueue_many(jobs, job_data_blob=f.read())
+
+    for job in jobs:
+        assert Job[job.uuid].status == Job.STATUS_QUEUED
+        assert os.path.exists(os.path.join(
+            config["primary_data_dir"], job.uuid, "input.zip"))
+
+    def get_queued_uuids(priority):
+        return [command['job_uuid'] for command in
+                command_transport().get_all_commands(
+                    redis_connection(), Job.queue_name(model_name, priority))]
+
+    assert get_queued_uuids(Job.PRIORITY_NORMAL) ==\
+        [jobs[0].uuid, jobs[1].uuid]
+    assert get_queued_uuids(Job.PRIORITY_HIGH) == [jobs[2].uuid]
+
+    cleanup(config)
+
+
+def test_primary_complete(monkeypatch):
+    """ test compete job """
+    model_name = "test"
+    config = make_config(model_name)
+
+    # record how many fetches (from the one worker) overlap
+    fetching = []
+    peak_fetching = [0]
+    lock = threading.Lock()
+
+    def slow_fetch(urls, destination_dir):
+        with lock:
+            fetching.append(urls)
+            peak_fetching[0] = max(peak_fetching[0], len(fetching))
+        time.sleep(0.5)
+        fetch_files_from_urls(urls, destination_dir)
+        with lock:
+            fetching.remove(urls)
+
+    monkeypatch.setattr(
+        modelrunner.primary_server, "fetch_files_from_urls", slow_fetch)
+
+    # complete jobs concurrently, fetching at most 2 at once
+    primary = get_primary(config, slots=3, worker_fetch_limit=2)
     name = config["primary_url"]
     primary_channel = node_channel_name(name)
 
@@ -343,19 +458,21 @@ def test_primary_complete():
     tc = Thread(target=primary.wait_for_channel_commands)
     tc.start()
 
-    # add job and make sure it gets processed
-    job = setup_processed_job(config, "processed")
-    enqueue_complete_job(job)
+    # add jobs and make sure they get processed
+    jobs = [setup_processed_job(config, "processed") for i in range(3)]
+    for job in jobs:
+        enqueue_complete_job(job)
 
-    # wait for it
-    time.sleep(1)
+    # wait for them
+    time.sleep(2)
 
-    assert Job[job.uuid].status == Job.STATUS_COMPLETE
-    path_to_output = os.path.join(
-                        config["primary_data_dir"],
-                        job.uuid,
-                        "output.zip")
-    assert os.path.exists(path_to_output)
+    assert peak_fetching[0] == 2,\
+        "completions should overlap up to worker_fetch_limit fetches"
+    for job in jobs:
+        assert Job[job.uuid].status == Job.STATUS_COMPLETE
+        for file_name in ["job_log.txt", "output.zip"]:
+            assert os.path.exists(os.path.join(
+                config["primary_data_dir"], job.uuid, file_name))
 
     # stop both queue and channel threads
     stop_queue_command = {'command': 'STOP_PROCESSING_QUEUE'}
@@ -367,3 +484,345 @@ def test_primary_complete():
     tc.join()
 
     cleanup(config)
+
+
+def test_reliable_queue():
+    """ test processing via a leased processing list and requeueing """
+    model_name = "test"
+    config = make_config(model_name)
+    redis_conn = redis_connection()
+
+    worker = get_worker(config, lease_timeout=1)
+    # the processing list of the (normal priority) job queue
+    processing_name = worker.slot_processing_names(0)[
+        worker.queue_names.index(job_queue_name(model_name))]
+    job = setup_queued_job(config, "processed_test", "sleep_8.zip")
+    enqueue_worker_job(job)
+
+    tq = Thread(target=worker.wait_for_queue_commands)
+    tq.start()
+
+    # longer than the lease so that it must be renewed
+    time.sleep(10)
+
+    assert Job[job.uuid].status == Job.STATUS_PROCESSED
+    assert redis_conn.llen(processing_name) == 0 and\
+        redis_conn.exists(lease_name(processing_name))
+
+    stop_queue_command = {'command': 'STOP_PROCESSING_QUEUE'}
+    enqueue_command(redis_conn, job_queue_name(model_name), stop_queue_command)
+    tq.join()
+
+    # simulate a worker that crashed while running a job
+    crashed_job = setup_queued_job(config, "crashed_test", "sleep_8.zip")
+    Job.update(crashed_job.uuid, status=Job.STATUS_RUNNING, on_primary=False)
+    command_dict = {'command': 'PROCESS_JOB', 'job_uuid': crashed_job.uuid}
+    enqueue_command(redis_conn, processing_name, command_dict)
+    redis_conn.hset(
+        processing_registry_name(),
+        processing_name,
+        job_queue_name(model_name))
+
+    primary = get_primary(config)
+    assert primary.command_handler.requeue_expired_jobs() ==\
+        [crashed_job.uuid]
+    assert Job[crashed_job.uuid].status == Job.STATUS_QUEUED
+    commands = get_all_commands(redis_conn, job_queue_name(model_name))
+    assert commands == [command_dict] and\
+        redis_conn.llen(processing_name) == 0
+
+    cleanup(config)
+
+
+def test_slots():
+    """ test running jobs concurrently in slots """
+    model_name = "test"
+    config = make_config(model_name)
+
+    name = worker_name(config["worker_url"], config["model"])
+    worker_channel = node_channel_name(name)
+
+    worker = get_worker(config, lease_timeout=1, slots=2)
+    jobs = [setup_queued_job(config, "slot_test", "sleep_8.zip")
+            for i in range(2)]
+    for job in jobs:
+        enqueue_worker_job(job)
+
+    tq = Thread(target=worker.wait_for_queue_commands)
+    tq.start()
+    tc = Thread(target=worker.wait_for_channel_commands)
+    tc.start()
+
+    # give them time to start
+    time.sleep(2)
+
+    assert [Job[job.uuid].status for job in jobs] ==\
+        [Job.STATUS_RUNNING, Job.STATUS_RUNNING]
+
+    publish(worker_channel, {"command": "UPDATE_STATUS"}, wait_time=0)
+    time.sleep(1)
+    nodes = [Node["{}/{}".format(name, slot)] for slot in range(2)]
+    assert set(node.job_uuid for node in nodes) ==\
+        set(job.uuid for job in jobs)
+
+    # kill the second job only
+    publish(worker_channel, {"command": "KILL_JOB", "job_uuid": jobs[1].uuid})
+
+    time.sleep(8)
+
+    assert Job[jobs[0].uuid].status == Job.STATUS_PROCESSED
+    assert Job[jobs[1].uuid].status == Job.STATUS_KILLED
+
+    publish(worker_channel, {"command": "STOP_PROCESSING_QUEUE"})
+    publish(worker_channel, {"command": "STOP_PROCESSING_CHANNELS"})
+    tq.join()
+    tc.join()
+
+    cleanup(config)
+
+
+def test_multiple_models():
+    """ test a worker waiting on the queues of several models """
+    config = make_config("test")
+    config_2 = make_config("test_2")
+
+    name = worker_name(config["worker_url"], "test,test_2")
+    worker_channel = node_channel_name(name)
+
+    worker = get_worker(make_config(["test", "test_2"]))
+    bad_job = setup_queued_job(config, "failed_test", "bad.zip")
+    sleep8_job = setup_queued_job(config_2, "processed_test", "sleep_8.zip")
+    enqueue_worker_job(sleep8_job)
+    enqueue_worker_job(bad_job)
+
+    tq = Thread(target=worker.wait_for_queue_commands)
+    tq.start()
+    tc = Thread(target=worker.wait_for_channel_commands)
+    tc.start()
+
+    time.sleep(10)
+
+    assert Job[bad_job.uuid].status == Job.STATUS_FAILED
+    assert Job[sleep8_job.uuid].status == Job.STATUS_PROCESSED
+
+    publish(worker_channel, {"command": "UPDATE_STATUS"})
+    time.sleep(1)
+    assert Node[name].model == "test,test_2"
+
+    publish(worker_channel, {"command": "STOP_PROCESSING_QUEUE"})
+    publish(worker_channel, {"command": "STOP_PROCESSING_CHANNELS"})
+    tq.join()
+    tc.join()
+
+    cleanup(config)
+
+
+def test_priorities():
+    """ test that higher priority jobs are processed first """
+    model_name = "test"
+    config = make_config(model_name)
+
+    name = worker_name(config["worker_url"], config["model"])
+    worker_channel = node_channel_name(name)
+
+    worker = get_worker(config)
+    low_job = setup_queued_job(
+        config, "low_test", "bad.zip", priority=Job.PRIORITY_LOW)
+    normal_job = setup_queued_job(config, "normal_test", "sleep_8.zip")
+    high_job = setup_queued_job(
+        config, "high_test", "bad.zip", priority=Job.PRIORITY_HIGH)
+    for job in [low_job, normal_job, high_job]:
+        enqueue_worker_job(job)
+
+    tq = Thread(target=worker.wait_for_queue_commands)
+    tq.start()
+    tc = Thread(target=worker.wait_for_channel_commands)
+    tc.start()
+
+    time.sleep(2)
+
+    # high priority job ran before the (still running) normal job
+    # and the low priority job waits for it
+    assert Job[high_job.uuid].status == Job.STATUS_FAILED
+    assert Job[normal_job.uuid].status == Job.STATUS_RUNNING
+    assert Job[low_job.uuid].status == Job.STATUS_CREATED
+
+    publish(worker_channel, {"command": "KILL_JOB",
+                             "job_uuid": normal_job.uuid})
+    time.sleep(2)
+    assert Job[low_job.uuid].status == Job.STATUS_FAILED
+
+    publish(worker_channel, {"command": "STOP_PROCESSING_QUEUE"})
+    publish(worker_channel, {"command": "STOP_PROCESSING_CHANNELS"})
+    tq.join()
+    tc.join()
+
+    cleanup(config)
+
+
+def test_async_worker():
+    """
+    jobs are run (and killed) on the event loop of an AsyncDispatcher
+    """
+    model_name = "test"
+    config = make_config(model_name)
+
+    name = worker_name(config["worker_url"], config["model"])
+    worker_channel = node_channel_name(name)
+
+    worker_handler = AsyncWorkerServer(
+                        config["worker_url"],
+                        config["worker_data_dir"],
+                        model_name,
+                        config["command_dict"],
+                        slots=2)
+    killed_job = setup_queued_job(config, "killed_test", "sleep_8.zip")
+    bad_job = setup_queued_job(config, "failed_test", "bad.zip")
+    enqueue_worker_job(killed_job)
+    enqueue_worker_job(bad_job)
+
+    async def run():
+        worker = AsyncDispatcher(
+                    async_redis_connection(),
+                    worker_handler,
+                    Job.queue_names(model_name),
+                    worker_handler.channel_names,
+                    slots=2)
+
+        async def control():
+            # kill the running job, then stop
+            await asyncio.sleep(2)
+            for command in ["KILL_JOB",
+                            "STOP_PROCESSING_QUEUE",
+                            "STOP_PROCESSING_CHANNELS"]:
+                publish(worker_channel,
+                        {"command": command, "job_uuid": killed_job.uuid})
+
+        await asyncio.gather(worker.run(), control())
+
+    asyncio.run(run())
+
+    assert Job[killed_job.uuid].status == Job.STATUS_KILLED
+    assert Job[bad_job.uuid].status == Job.STATUS_FAILED
+    assert all(node.status == Node.STATUS_STOPPED
+               for node in worker_handler._slot_nodes)
+
+    cleanup(config)
+
+
+def test_admission():
+    """
+    jobs beyond the queue limits of their model are rejected with a
+    Retry-After estimated from how fast the queues drain
+    """
+    model_name = "test"
+    config = make_config(model_name)
+    redis_conn = redis_connection()
+
+    primary = get_primary(config)
+    jobs = [Job(model_name, name="admission_test_{}".format(i))
+            for i in range(2)]
+    input_file = os.path.join(config["primary_data_dir"], "bad.zip")
+    with open(input_file, 'rb') as f:
+        primary.command_handler.enqueue_many(jobs, job_data_blob=f.read())
+    input_size = os.path.getsize(input_file)
+
+    assert int(redis_conn.hget(pending_input_name(), model_name)) ==\
+        2 * input_size, "input of queued jobs should be pending"
+
+    admission = AdmissionControl(
+        config["primary_data_dir"],
+        model_limits={model_name: {"max_queue_depth": 2}})
+    try:
+        admission.check(model_name)
+        assert False, "job beyond max_queue_depth should be rejected"
+    except AdmissionRejected as e:
+        assert e.status_code == 429 and\
+            e.retry_after == admission.default_retry_after,\
+            "retry after default while the drain rate is unknown"
+
+    # run one of the jobs (its command is left queued)
+    worker = get_worker(config)
+    worker.command_handler.process_job(
+        {'command': 'PROCESS_JOB', 'job_uuid': jobs[0].uuid})
+    assert int(redis_conn.hget(pending_input_name(), model_name)) ==\
+        input_size, "input of started jobs should not be pending"
+    assert int(redis_conn.hget(dequeued_count_name(), model_name)) == 1
+
+    # its command left in the queue is not counted
+    admission.check(model_name)
+
+    time.sleep(1)
+    try:
+        admission.check(model_name, jobs=2)
+        assert False, "jobs beyond max_queue_depth should be rejected"
+    except AdmissionRejected as e:
+        assert 1 <= e.retry_after < admission.default_retry_after,\
+            "retry after should follow the drain rate"
+
+    # nor are killed jobs
+    primary.command_handler.kill_job(Job[jobs[1].uuid])
+    admission.check(model_name, jobs=2)
+    assert int(redis_conn.hget(pending_input_name(), model_name)) == 0
+
+    cleanup(config)
+
+
+def test_result_cache():
+    """
+    jobs matching a completed job are completed with its results
+    """
+    model_name = "test"
+    config = make_config(model_name)
+
+    result_cache = ResultCache(config["command_dict"], max_entries=1)
+    primary = get_primary(config, result_cache=result_cache)
+    with open(os.path.join(config["primary_data_dir"], "bad.zip"), 'rb') as f:
+        job_data_blob = f.read()
+
+    job = Job(model_name, name="cached_test")
+    primary.command_handler.enqueue(job, job_data_blob=job_data_blob)
+    assert Job[job.uuid].status == Job.STATUS_QUEUED and\
+        Job[job.uuid].cache_key is not None
+
+    # complete it as if a worker processed it
+    job_data_dir = os.path.join(config["worker_data_dir"], job.uuid)
+    os.mkdir(job_data_dir)
+    for file_name in ["output.zip", "job_log.txt"]:
+        shutil.copy(os.path.join(config["worker_data_dir"], file_name),
+                    os.path.join(job_data_dir, file_name))
+    Job.update(job.uuid,
+               status=Job.STATUS_PROCESSED,
+               worker_url=config["worker_url"],
+               worker_data_dir=config["worker_data_dir"],
+               on_primary=False)
+    primary.command_handler.complete_job(
+        {'command': 'COMPLETE_JOB', 'job_uuid': job.uuid})
+
+    cached_job = Job(model_name, name="cached_test")
+    primary.command_handler.enqueue(cached_job, job_data_blob=job_data_blob)
+    assert Job[cached_job.uuid].status == Job.STATUS_COMPLETE and\
+        Job[cached_job.uuid].cached_from == job.uuid,\
+        "matching job should be completed with the cached results"
+    assert os.path.exists(os.path.join(
+        config["primary_data_dir"], cached_job.uuid, "output.zip"))
+
+    uncached_job = Job(model_name, name="uncached_test")
+    primary.command_handler.enqueue(
+        uncached_job, job_data_blob=job_data_blob, use_cache=False)
+    assert Job[uncached_job.uuid].status == Job.STATUS_QUEUED,\
+        "jobs opting out of the cache should be queued"
+    assert [command['job_uuid'] for command in
+            command_transport().get_all_commands(
+                redis_connection(), job_queue_name(model_name))] ==\
+        [job.uuid, uncached_job.uuid], "cached jobs should not be queued"
+
+    # beyond max_entries
+    evicting_job = Job(model_name, cache_key="evicting")
+    result_cache.add(evicting_job)
+    assert result_cache.stats() ==\
+        {'hits': 1, 'misses': 1, 'evictions': 1, 'entries': 1}
+    assert result_cache.lookup(job.cache_key) is None,\
+        "least recently used jobs should be evicted"
+
+    cleanup(config)
@@ -1,9 +1,21 @@
 # -*- coding: utf-8 -*-
 
 from modelrunner import settings
-from modelrunner.redisent import RedisEntity
+from modelrunner.redisent import (
+    RedisEntity,
+    STORAGE_BLOB,
+    STORAGE_HASH,
+    JSONCodec,
+    MsgpackCodec
+)
+from modelrunner.redisent import entity
+from modelrunner.redisent.codec import msgpack
+from redis.exceptions import WatchError
 
 import datetime
+import json
+import time
+import unittest
 from six import string_types
 
 RedisEntity._prefix = "test"
@@ -61,3 +73,439 @@ def test_redisent():
         del User[user]
 
     assert len(User) == 0, "del test fails"
+
+
+class Event(User):
+
+    _order_by = "created"
+
+
+def test_redisent_page():
+
+    events = [Event(i, "event{}".format(i), "2000-01-0{}T00:00:00".format(i))
+              for i in range(1, 6)]
+
+    # store out of order to ensure the index orders them
+    for event in reversed(events):
+        Event[event.id] = event
+
+    assert Event.page(0, 2) == [events[4], events[3]],\
+        "descending page test fails"
+
+    assert Event.page(2, 2, descending=False) == [events[2], events[3]],\
+        "ascending page test fails"
+
+    assert Event.page(10, 2) == [], "empty page test fails"
+
+    # rebuilding the index should give the same order
+    Event.reindex()
+    assert Event.page() == list(reversed(events)), "reindex test fails"
+
+    for event in events:
+        del Event[event.id]
+
+    assert Event.page() == [], "del from index test fails"
+
+
+class Task(RedisEntity):
+
+    _order_by = "priority"
+    _indexes = ("status", "owner")
+
+    def __init__(self, id=None, status=None, owner=None, priority=0):
+        self.id = id
+        self.status = status
+        self.owner = owner
+        self.priority = priority
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, self.__class__) and
+            self.__dict__ == other.__dict__)
+
+
+class HashTask(Task):
+
+    _storage = STORAGE_HASH
+
+
+def test_redisent_indexes():
+    check_redisent_indexes(Task)
+    check_redisent_indexes(HashTask)
+
+
+def check_redisent_indexes(Task):
+
+    tasks = [Task("0", "NEW", "user0", 0),
+             Task("1", "NEW", "user1", 1),
+             Task("2", "DONE", "user0", 2)]
+
+    for task in tasks:
+        Task[task.id] = task
+
+    assert sorted(Task.find_keys(status="NEW")) == ["0", "1"],\
+        "find_keys test fails"
+
+    assert Task.find(status="NEW", owner="user0") == [tasks[0]],\
+        "find by multiple attributes test fails"
+
+    assert Task.count(owner="user0") == 2, "count test fails"
+
+    assert Task.page(status="NEW") == [tasks[1], tasks[0]],\
+        "page by attribute test fails"
+
+    # changing an indexed value moves the entity to the new index
+    tasks[1].status = "DONE"
+    Task[tasks[1].id] = tasks[1]
+    assert Task.find_keys(status="NEW") == ["0"],\
+        "index update test fails"
+
+    assert sorted(Task.find_keys(status="DONE")) == ["1", "2"],\
+        "index update test fails"
+
+    for task in tasks:
+        del Task[task.id]
+
+    assert Task.find(status="DONE") == [], "del from index test fails"
+    assert Task.count(owner="user0") == 0, "del from index test fails"
+
+
+def test_redisent_page_criteria(monkeypatch):
+
+    # check a few keys at a time to page across scan batches
+    monkeypatch.setattr(entity, "PAGE_SCAN_BATCH", 3)
+
+    # dense "NEW" tasks are paged by scanning the order index, the rare
+    # "DONE" ones by intersecting the indexes
+    tasks = [Task(str(i), "DONE" if i % 10 == 0 else "NEW", "user0", i)
+             for i in range(30)]
+    Task.set_many((task.id, task) for task in tasks)
+
+    try:
+        for status in ("NEW", "DONE"):
+            keys = [task.id for task in reversed(tasks)
+                    if task.status == status]
+            for offset, limit in [(0, 1), (0, 5), (4, 7), (20, 10), (40, 5)]:
+                assert Task.page_keys(offset, limit, status=status) ==\
+                    keys[offset:offset + limit],\
+                    "page by attribute test fails"
+                assert Task.page_keys(
+                    offset, limit, descending=False, status=status) ==\
+                    list(reversed(keys))[offset:offset + limit],\
+                    "ascending page by attribute test fails"
+
+        assert Task.page_keys(0, 5, status="MISSING") == [],\
+            "page by missing attribute test fails"
+
+    finally:
+        Task.delete_many(task.id for task in tasks)
+
+
+def test_redisent_bulk():
+    check_redisent_bulk(Task)
+    check_redisent_bulk(HashTask)
+
+
+def check_redisent_bulk(Task):
+
+    tasks = {str(i): Task(str(i), "NEW", "user{}".format(i % 2), i)
+             for i in range(10)}
+
+    Task.set_many(tasks, also=lambda pipe: pipe.rpush("test:queue", "0"))
+    assert Task.count(status="NEW") == 10, "set_many test fails"
+    assert Task._db.lpop("test:queue") == "0", "set_many also test fails"
+
+    keys = ["0", "missing", "9"]
+    assert Task.get_many(keys) == [tasks["0"], None, tasks["9"]],\
+        "get_many test fails"
+
+    Task.delete_many(["0", "1"])
+    assert len(Task) == 8 and Task.count(owner="user0") == 4,\
+        "delete_many test fails"
+
+    # batch only writes once full or on exit
+    with Task.batch(size=5) as batch:
+        for key in ["2", "3", "4"]:
+            tasks[key].status = "DONE"
+            batch[key] = tasks[key]
+
+        assert Task.count(status="DONE") == 0, "batch buffer test fails"
+
+        for key in ["5", "6"]:
+            del batch[key]
+
+        assert Task.count(status="DONE") == 3 and len(Task) == 6,\
+            "batch flush test fails"
+
+        del batch["7"]
+
+    assert len(Task) == 5, "batch exit test fails"
+
+    Task.delete_many(Task.keys())
+    assert len(Task) == 0, "delete_many test fails"
+
+
+def test_redisent_iter():
+    check_redisent_iter(Task)
+    check_redisent_iter(HashTask)
+
+
+def check_redisent_iter(Task):
+
+    tasks = {str(i): Task(str(i), "NEW", "user0", i) for i in range(25)}
+    Task.set_many(tasks)
+
+    # small batches to ensure multiple HSCAN calls
+    assert dict(Task.iter_items(batch=4)) == tasks, "iter_items test fails"
+
+    assert sorted(task.priority for task in Task.iter_values(batch=4)) ==\
+        list(range(25)), "iter_values test fails"
+
+    Task.delete_many(tasks.keys())
+
+
+def test_redisent_update():
+    check_redisent_update(Task)
+    check_redisent_update(HashTask)
+
+
+def check_redisent_update(Task):
+
+    task = Task("0", "NEW", "user0", 0)
+    Task[task.id] = task
+
+    Task.update(task.id, status="DONE", priority=5)
+    task.status = "DONE"
+    task.priority = 5
+    assert Task[task.id] == task, "update test fails"
+
+    assert Task.find_keys(status="DONE") == [task.id] and\
+        Task.count(status="NEW") == 0, "update index test fails"
+
+    assert Task.get_fields(task.id, "status", "owner") ==\
+        {"status": "DONE", "owner": "user0"}, "get_fields test fails"
+
+    try:
+        Task.update("missing", status="DONE")
+        assert False, "update of missing entity test fails"
+    except KeyError:
+        pass
+
+    assert not Task.update_if(task.id, {"status": ["NEW"]}, priority=1) and\
+        Task[task.id] == task, "update_if mismatch test fails"
+    assert Task.update_if(task.id, {"status": ["NEW", "DONE"]},
+                          status="KILLED") and\
+        Task.find_keys(status="KILLED") == [task.id],\
+        "update_if match test fails"
+    task.status = "KILLED"
+
+    del Task[task.id]
+    assert len(Task) == 0 and Task.count(status="KILLED") == 0,\
+        "del test fails"
+
+
+def test_redisent_json():
+    check_redisent_json(Task)
+    check_redisent_json(HashTask)
+
+
+def check_redisent_json(Task):
+
+    tasks = [Task(str(i), "NEW", "user0", i) for i in range(3)]
+    Task.set_many((task.id, task) for task in tasks)
+
+    assert json.loads(Task.get_json("0")) == vars(tasks[0]),\
+        "get_json test fails"
+
+    assert Task.get_json_many(["1", "missing"])[1] is None,\
+        "get_json_many missing test fails"
+
+    assert [json.loads(task_json) for task_json in Task.page_json(0, 2)] ==\
+        [vars(tasks[2]), vars(tasks[1])], "page_json test fails"
+
+    Task.delete_many(task.id for task in tasks)
+
+
+def test_redisent_watch():
+    check_redisent_watch(Task)
+    check_redisent_watch(HashTask)
+
+
+def check_redisent_watch(Task):
+
+    Task.set_many((str(i), Task(str(i), "NEW", "user0", i)) for i in range(2))
+
+    def transaction_conflicts(write):
+        """
+        whether write conflicts with a transaction on the entity for "0"
+        """
+        pipe = settings.redis_connection().pipeline()
+        pipe.watch(*Task._watch_names(["0"]))
+        write()
+        pipe.multi()
+        pipe.ping()
+        try:
+            pipe.execute()
+            return False
+        except WatchError:
+            return True
+        finally:
+            pipe.reset()
+
+    assert not transaction_conflicts(
+        lambda: Task.update("1", status="DONE")),\
+        "writes to other entities should not conflict"
+    assert transaction_conflicts(lambda: Task.update("0", status="DONE")),\
+        "update should conflict"
+    assert transaction_conflicts(
+        lambda: Task.set_many({"0": Task("0", "NEW", "user0", 0)})),\
+        "set_many should conflict"
+    assert transaction_conflicts(lambda: Task.delete_many(["0"])),\
+        "delete_many should conflict"
+
+    Task.delete_many(Task.keys())
+
+
+def test_redisent_storage():
+
+    class MigratedTask(HashTask):
+        _custom_hash_name = "test:migrated_tasks"
+
+    tasks = {str(i): MigratedTask(str(i), "NEW", "user0", i) for i in range(3)}
+    BlobTask = MigratedTask.storage_view(STORAGE_BLOB)
+    try:
+        BlobTask.set_many(tasks)
+        assert MigratedTask.stored_via(STORAGE_BLOB) and\
+            not MigratedTask.stored_via(STORAGE_HASH) and\
+            MigratedTask.get_many(list(tasks)) == [None] * 3,\
+            "legacy storage test fails"
+
+        MigratedTask.migrate_storage(STORAGE_BLOB)
+        assert not MigratedTask.stored_via(STORAGE_BLOB) and\
+            MigratedTask.stored_via(STORAGE_HASH) and\
+            dict(MigratedTask.iter_items()) == tasks and\
+            sorted(MigratedTask.find_keys(status="NEW")) == sorted(tasks),\
+            "storage migration test fails"
+
+    finally:
+        BlobTask.delete_many(list(tasks))
+        MigratedTask.delete_many(list(tasks))
+
+
+class VersionedTask(Task):
+
+    _versioned = True
+
+
+def test_redisent_version():
+
+    task = VersionedTask("0", "NEW", "user0", 0)
+    version = VersionedTask.version()
+    VersionedTask[task.id] = task
+    VersionedTask.update(task.id, status="DONE")
+    assert VersionedTask.version(task.id) == 2 and\
+        VersionedTask.version() == version + 2, "version test fails"
+
+    del VersionedTask[task.id]
+    assert VersionedTask.version(task.id) == 0 and\
+        VersionedTask.version() == version + 3, "del version test fails"
+
+
+class CachedTask(Task):
+
+    _publish_writes = True
+
+
+def test_redisent_cache():
+
+    task = CachedTask("0", "NEW", "user0", 0)
+    CachedTask[task.id] = task
+    CachedTask.enable_cache(size=2, ttl=60)
+
+    try:
+        assert CachedTask[task.id] == task, "cache miss test fails"
+        cached = CachedTask[task.id]
+        assert CachedTask._cache.hits == 1, "cache hit test fails"
+
+        # cached entities are copies
+        cached.status = "MODIFIED"
+        assert CachedTask[task.id].status == "NEW", "cache copy test fails"
+
+        # a write by another process is published and invalidates the entry
+        other_task = CachedTask("0", "DONE", "user0", 0)
+        settings.redis_connection().hset(
+            CachedTask.hash_name(),
+            task.id,
+            json.dumps(vars(other_task)))
+        settings.redis_connection().publish(
+            CachedTask.invalidation_channel_name(), json.dumps([task.id]))
+
+        time.sleep(0.5)
+        assert CachedTask[task.id] == other_task,\
+            "cache invalidation test fails"
+
+        # local writes invalidate too
+        CachedTask.update(task.id, status="NEW")
+        assert CachedTask[task.id] == task, "cache update test fails"
+
+        # json is what is stored whether or not the entity is cached
+        stored_json = json.dumps({"id": "4", "status": "NEW"})
+        settings.redis_connection().hset(
+            CachedTask.hash_name(), "4", stored_json)
+        assert CachedTask.get_json("4") == stored_json,\
+            "get_json cache miss test fails"
+        assert CachedTask["4"].priority == 0
+        hits = CachedTask._cache.hits
+        assert CachedTask.get_json("4") == stored_json and\
+            CachedTask._cache.hits == hits + 1,\
+            "get_json cache hit test fails"
+
+        # bounded size
+        for i in range(1, 4):
+            CachedTask[str(i)] = CachedTask(str(i), "NEW", "user0", i)
+        # (after the invalidations of the writes are delivered)
+        time.sleep(0.5)
+        for i in range(1, 4):
+            CachedTask[str(i)]
+        assert len(CachedTask._cache) == 2, "cache size test fails"
+
+    finally:
+        CachedTask.disable_cache()
+        CachedTask.delete_many(CachedTask.keys())
+
+
+def test_redisent_codec():
+
+    if msgpack is None:
+        raise unittest.SkipTest("msgpack not installed")
+
+    class PackedUser(User):
+        _codec = MsgpackCodec()
+
+    class PackedHashTask(HashTask):
+        _codec = MsgpackCodec()
+
+    user = PackedUser(0, "user0", datetime.datetime(2000, 1, 1, 12, 30))
+    PackedUser[user.id] = user
+    assert PackedUser[user.id] == user, "msgpack codec test fails"
+    assert dict(PackedUser.iter_items()) == {"0": user},\
+        "msgpack codec iter test fails"
+
+    task = PackedHashTask("0", "NEW", "user0", 0)
+    PackedHashTask[task.id] = task
+    PackedHashTask.update(task.id, status="DONE")
+    assert PackedHashTask.get_fields(task.id, "status") == {"status": "DONE"}\
+        and PackedHashTask.find_keys(status="DONE") == ["0"],\
+        "msgpack codec update test fails"
+
+    # migrate to json
+    class JSONUser(PackedUser):
+        _codec = JSONCodec()
+        _custom_hash_name = PackedUser.hash_name()
+
+    JSONUser.migrate_codec(MsgpackCodec())
+    assert JSONUser[user.id] == JSONUser(**vars(user)),\
+        "codec migration test fails"
+
+    del JSONUser[user.id]
+    del PackedHashTask[task.id]
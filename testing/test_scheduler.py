@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Test runtime aware scheduling (see modelrunner.scheduler)
+"""
+import datetime
+from modelrunner.settings import (
+    initialize,
+    redis_connection,
+    command_transport
+)
+from modelrunner.scheduler import (
+    record_runtime,
+    RuntimeEstimate,
+    RuntimeScheduler
+)
+from modelrunner import Job
+
+# initialize
+initialize()
+
+MB = 2**20
+
+
+def test_runtime_estimate():
+    redis_conn = redis_connection()
+    redis_conn.flushdb()
+
+    # 10 seconds per MB plus 5 seconds
+    for size in range(1, 11):
+        record_runtime(
+            redis_conn, Job("test", input_size=size * MB), 10 * size + 5)
+
+    estimate = RuntimeEstimate.get(redis_conn, "test")
+    assert round(estimate.seconds(20 * MB), 6) == 205,\
+        "run time should be regressed on input size"
+    assert RuntimeEstimate.get(redis_conn, "other").seconds(MB) == 0,\
+        "models without runtime stats should not be estimated"
+
+    redis_conn.flushdb()
+
+
+def test_runtime_scheduler():
+    redis_conn = redis_connection()
+    redis_conn.flushdb()
+
+    scheduler = RuntimeScheduler(short_job_seconds=60, max_short_wait=600)
+    short_job = Job("test", input_size=MB)
+    long_job = Job("test", input_size=100 * MB)
+    high_job = Job("test", input_size=100 * MB, priority=Job.PRIORITY_HIGH)
+    jobs = [short_job, long_job, high_job]
+
+    assert scheduler.queue_names(jobs) ==\
+        [Job.queue_name("test")] * 2 + [Job.queue_name("test", "high")],\
+        "jobs should be queued by priority until estimated"
+
+    for size in range(1, 21):
+        record_runtime(redis_conn, Job("test", input_size=size * MB), size)
+
+    assert scheduler.queue_names(jobs) ==\
+        [Job.queue_name("test", Job.LANE_SHORT),
+         Job.queue_name("test"),
+         Job.queue_name("test", "high")],\
+        "short jobs should be queued in the short lane"
+    assert round(short_job.expected_seconds, 6) == 1
+
+    def enqueue(status, seconds_ago):
+        job = Job("test", status=status,
+                  created=datetime.datetime.utcnow() -
+                  datetime.timedelta(seconds=seconds_ago))
+        Job[job.uuid] = job
+        command_transport().enqueue_command(
+            redis_conn,
+            Job.queue_name("test"),
+            {'command': 'PROCESS_JOB', 'job_uuid': job.uuid})
+        return job
+
+    # killed jobs left in the normal queue do not close the short lane
+    enqueue(Job.STATUS_KILLED, 601)
+    enqueue(Job.STATUS_QUEUED, 1)
+    assert scheduler.queue_names([short_job]) ==\
+        [Job.queue_name("test", Job.LANE_SHORT)],\
+        "killed jobs should not count as waiting"
+
+    # a job waiting too long in the normal queue closes the short lane
+    redis_conn.delete(Job.queue_name("test"))
+    enqueue(Job.STATUS_KILLED, 1)
+    enqueue(Job.STATUS_QUEUED, 601)
+    assert scheduler.queue_names([short_job]) == [Job.queue_name("test")],\
+        "jobs should not be run ahead of a job that waited too long"
+
+    redis_conn.flushdb()
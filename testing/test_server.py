@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+Test the web server handlers (see modelrunner.server)
+"""
+import json
+import os
+import time
+import tornado.gen
+import tornado.httpclient
+import tornado.web
+from tornado.testing import AsyncHTTPTestCase, gen_test
+from modelrunner.settings import initialize, redis_connection
+from modelrunner import server
+from modelrunner import PrimaryServer, Job, Node
+from modelrunner.redisent.entity import RedisEntityMeta
+
+# initialize
+initialize()
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+JOB_ID_REGEX = "([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})"
+
+
+class ServerTestCase(AsyncHTTPTestCase):
+    """
+    Serves the handlers of scripts/job_server.py that do not submit jobs
+    """
+
+    def get_app(self):
+        redis_connection().flushdb()
+        self.job_events = server.JobEventListener(io_loop=self.io_loop)
+        self.job_events.start()
+        primary_server = PrimaryServer(
+            "file://", os.path.join(BASE_DIR, "testing", "primary_data"))
+        return tornado.web.Application([
+            (r"/jobs", server.JobHandler,
+                dict(primary_server=primary_server, page_size=2)),
+            (r"/jobs/{}".format(JOB_ID_REGEX), server.JobHandler,
+                dict(primary_server=primary_server, page_size=2)),
+            (r"/status", server.StatusHandler,
+                dict(primary_server=primary_server, refresh_interval=60)),
+            (r"/jobs/events", server.JobEventsHandler,
+                dict(job_events=self.job_events)),
+            (r"/jobs/{}/events".format(JOB_ID_REGEX),
+                server.JobEventsHandler, dict(job_events=self.job_events)),
+            (r"/jobs/{}/wait".format(JOB_ID_REGEX),
+                server.JobWaitHandler, dict(job_events=self.job_events)),
+        ],
+            template_path=os.path.join(BASE_DIR, "templates"),
+            ui_modules={'JobOptions': server.JobOptionsModule})
+
+    def tearDown(self):
+        self.job_events.stop()
+        super(ServerTestCase, self).tearDown()
+        redis_connection().flushdb()
+
+    def queued_job(self):
+        job = Job("test", status=Job.STATUS_QUEUED)
+        Job[job.uuid] = job
+        return job
+
+    def test_job_wait(self):
+        job = self.queued_job()
+
+        start = time.time()
+        response = self.fetch("/jobs/{}/wait?timeout=0.5".format(job.uuid))
+        assert response.code == 200 and time.time() - start >= 0.5 and\
+            json.loads(response.body)['status'] == Job.STATUS_QUEUED,\
+            "wait should respond with the job after timeout"
+
+        # reached (once the event is received)
+        self.io_loop.call_later(
+            0.5, Job.set_status, job.uuid, Job.STATUS_RUNNING)
+        start = time.time()
+        response = self.fetch(
+            "/jobs/{}/wait?timeout=10&until=RUNNING".format(job.uuid))
+        assert response.code == 200 and time.time() - start < 5 and\
+            json.loads(response.body)['status'] == Job.STATUS_RUNNING,\
+            "wait should respond once the job has an until status"
+
+        # already reached
+        response = self.fetch(
+            "/jobs/{}/wait?timeout=10&until=QUEUED,RUNNING".format(job.uuid))
+        assert response.code == 200 and\
+            json.loads(response.body)['status'] == Job.STATUS_RUNNING,\
+            "wait should respond right away if the job has an until status"
+
+    def test_job_wait_errors(self):
+        job = self.queued_job()
+
+        for query in ("timeout=soon", "timeout=-1", "timeout=601",
+                      "until=,"):
+            response = self.fetch("/jobs/{}/wait?{}".format(job.uuid, query))
+            assert response.code == 400,\
+                "wait with {} should be a bad request".format(query)
+
+        response = self.fetch("/jobs/{}/wait".format(Job().uuid))
+        assert response.code == 404, "wait for missing job should fail"
+
+        # deleted while waiting
+        def delete():
+            del Job[job.uuid]
+            Job.publish_status(job.uuid, Job.STATUS_KILLED)
+
+        self.io_loop.call_later(0.5, delete)
+        response = self.fetch("/jobs/{}/wait?timeout=10".format(job.uuid))
+        assert response.code == 404, "wait for deleted job should fail"
+
+    @tornado.gen.coroutine
+    def stream_events(self, path, seconds):
+        """
+        Returns the events streamed from path within seconds (after which
+        the client disconnects)
+        """
+        chunks = []
+        try:
+            yield self.http_client.fetch(
+                self.get_url(path),
+                streaming_callback=chunks.append,
+                request_timeout=seconds)
+        except tornado.httpclient.HTTPError as e:
+            assert e.code == 599, "event stream should not end"
+        lines = b"".join(chunks).decode('utf-8').split("\n")
+        raise tornado.gen.Return(
+            [json.loads(line[len("data: "):]) for line in lines
+             if line.startswith("data: ")])
+
+    @gen_test(timeout=10)
+    def test_job_events(self):
+        job = self.queued_job()
+        other_job = self.queued_job()
+
+        def run_jobs():
+            Job.set_status(job.uuid, Job.STATUS_RUNNING)
+            Job.set_status(other_job.uuid, Job.STATUS_RUNNING)
+
+        self.io_loop.call_later(0.5, run_jobs)
+        job_events, all_events = yield [
+            self.stream_events("/jobs/{}/events".format(job.uuid), 2),
+            self.stream_events("/jobs/events", 2)]
+
+        assert [(event['job_uuid'], event['status'])
+                for event in job_events] ==\
+            [(job.uuid, Job.STATUS_QUEUED), (job.uuid, Job.STATUS_RUNNING)],\
+            "job events should start with the current status"
+        assert [(event['job_uuid'], event['status'])
+                for event in all_events] ==\
+            [(job.uuid, Job.STATUS_RUNNING),
+             (other_job.uuid, Job.STATUS_RUNNING)],\
+            "events of all jobs should be streamed"
+        assert 'command' not in job_events[1] and 'updated' in job_events[1]
+
+        # listeners are removed once the clients disconnect
+        yield tornado.gen.sleep(0.1)
+        assert self.job_events._listeners == {},\
+            "listeners should be removed on disconnect"
+
+        response = yield self.http_client.fetch(
+            self.get_url("/jobs/{}/events".format(Job().uuid)),
+            raise_error=False)
+        assert response.code == 404 and self.job_events._listeners == {},\
+            "events of missing job should fail"
+
+    def fetch_json(self, path, etag=None):
+        headers = {'Accept': 'application/json'}
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        return self.fetch(path, headers=headers)
+
+    def test_jobs_etag(self):
+        jobs = [self.queued_job() for i in range(3)]
+
+        response = self.fetch_json("/jobs")
+        etag = response.headers['Etag']
+        assert response.code == 200 and\
+            len(json.loads(response.body)['data']) == 2
+        assert self.fetch_json("/jobs", etag).code == 304,\
+            "unchanged jobs should not be sent again"
+
+        # pages are tagged separately
+        response = self.fetch_json("/jobs?offset=2", etag)
+        page_etag = response.headers['Etag']
+        assert response.code == 200 and page_etag != etag and\
+            [job_dict['uuid'] for job_dict in
+             json.loads(response.body)['data']] == [jobs[0].uuid],\
+            "another page should not match the Etag of the first"
+        assert self.fetch_json("/jobs?offset=2", page_etag).code == 304,\
+            "unchanged page should not be sent again"
+        assert self.fetch_json("/jobs?status=QUEUED", etag).code == 200,\
+            "filtered jobs should not match the Etag of all jobs"
+
+        Job.set_status(jobs[0].uuid, Job.STATUS_RUNNING)
+        for path, path_etag in (("/jobs", etag),
+                                ("/jobs?offset=2", page_etag)):
+            response = self.fetch_json(path, path_etag)
+            assert response.code == 200 and\
+                response.headers['Etag'] != path_etag,\
+                "written jobs should be sent with a new Etag"
+
+        # html and json are tagged separately
+        response = self.fetch("/jobs?offset=2",
+                              headers={'If-None-Match': page_etag})
+        assert response.code == 200 and\
+            response.headers['Etag'] != page_etag,\
+            "html should not match the Etag of json"
+
+    def test_status_etag(self):
+        response = self.fetch_json("/status")
+        etag = response.headers['Etag']
+        assert response.code == 200, "status test fails"
+        assert self.fetch_json("/status", etag).code == 304,\
+            "unchanged status should not be sent again"
+
+        Node["worker"] = Node("worker", "file://", node_type=Node.TYPE_WORKER)
+        response = self.fetch_json("/status", etag)
+        assert response.code == 200 and response.headers['Etag'] != etag and\
+            [node_dict['name'] for node_dict in
+             json.loads(response.body)['data']] == ["worker"],\
+            "written nodes should be sent with a new Etag"
+
+    def test_cached_job(self):
+        job = self.queued_job()
+        fetched = []
+
+        def fetch(keys):
+            fetched.extend(keys)
+            return RedisEntityMeta._fetch(Job, keys)
+
+        Job.enable_cache()
+        Job._fetch = fetch
+        try:
+            response = self.fetch("/jobs/{}".format(job.uuid))
+            assert response.code == 200 and fetched == [job.uuid] and\
+                json.loads(response.body)['status'] == Job.STATUS_QUEUED,\
+                "uncached job should be read from redis"
+
+            response = self.fetch("/jobs/{}".format(job.uuid))
+            assert response.code == 200 and fetched == [job.uuid] and\
+                json.loads(response.body)['status'] == Job.STATUS_QUEUED,\
+                "cached job should be served from the cache"
+
+            Job.set_status(job.uuid, Job.STATUS_RUNNING)
+            response = self.fetch("/jobs/{}".format(job.uuid))
+            assert fetched == [job.uuid] * 2 and\
+                json.loads(response.body)['status'] == Job.STATUS_RUNNING,\
+                "written job should be read from redis again"
+        finally:
+            del Job._fetch
+            Job.disable_cache()
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Test the transports of commands (see modelrunner.transport)
+"""
+import time
+from threading import Thread
+from modelrunner.settings import initialize, redis_connection
+from modelrunner.transport import ListTransport, StreamTransport
+
+# initialize
+initialize()
+
+QUEUES = ["test:queues:high", "test:queues:normal"]
+PROCESSING = ["test:processing:high", "test:processing:normal"]
+
+
+def command(i):
+    return {'command': 'PROCESS_JOB', 'job_uuid': str(i)}
+
+
+def test_list_transport():
+    check_transport(ListTransport())
+
+
+def test_stream_transport():
+    check_transport(StreamTransport())
+
+
+def check_transport(transport):
+    redis_conn = redis_connection()
+    redis_conn.flushdb()
+
+    for i in range(2):
+        transport.enqueue_command(redis_conn, QUEUES[1], command(i))
+    transport.enqueue_command(redis_conn, QUEUES[0], command(3))
+    assert transport.get_all_commands(redis_conn, QUEUES[1]) ==\
+        [command(0), command(1)], "enqueue test fails"
+    assert transport.queue_length(redis_conn, QUEUES[1]) == 2,\
+        "queue_length test fails"
+    assert transport.peek_commands(redis_conn, QUEUES[1]) == [command(0)],\
+        "peek_commands test fails"
+    assert transport.peek_commands(redis_conn, QUEUES[1], count=3) ==\
+        [command(0), command(1)], "peek_commands test fails"
+
+    # earlier queues first
+    assert transport.pop_command_any(redis_conn, QUEUES, timeout=1) ==\
+        (0, command(3)), "pop_command_any test fails"
+    assert transport.pop_command_any(redis_conn, QUEUES, timeout=1) ==\
+        (1, command(0)), "pop_command_any test fails"
+
+    index, command_dict, token = transport.pop_command_reliable_any(
+        redis_conn, QUEUES, PROCESSING, timeout=1)
+    assert (index, command_dict) == (1, command(1)),\
+        "pop_command_reliable_any test fails"
+    assert transport.pop_command_any(redis_conn, QUEUES, timeout=1) is None,\
+        "pop_command_any timeout test fails"
+    assert transport.queue_length(redis_conn, QUEUES[1]) == 0,\
+        "popped commands should not be counted by queue_length"
+    assert transport.peek_commands(redis_conn, QUEUES[1]) == [],\
+        "popped commands should not be peeked"
+
+    # unacked commands are pending until acked
+    assert transport.pending_commands(
+        redis_conn, QUEUES[1], PROCESSING[1]) == [(command(1), token)],\
+        "pending_commands test fails"
+    transport.ack_command(redis_conn, QUEUES[1], PROCESSING[1], token)
+    assert transport.pending_commands(
+        redis_conn, QUEUES[1], PROCESSING[1]) == [],\
+        "ack_command test fails"
+
+    # blocking (at least) on the preferred queue
+    def enqueue_later():
+        time.sleep(0.5)
+        transport.enqueue_command(redis_conn, QUEUES[0], command(4))
+
+    Thread(target=enqueue_later).start()
+    popped = transport.pop_command_reliable_any(
+        redis_conn, QUEUES, PROCESSING, timeout=2)
+    assert popped[:2] == (0, command(4)),\
+        "blocking pop_command_reliable_any test fails"
+    assert transport.pending_commands(
+        redis_conn, QUEUES[0], PROCESSING[0])[0][0] == command(4),\
+        "blocking pop_command_reliable_any pending test fails"
+
+    redis_conn.flushdb()
+
+
+def test_stream_transport_batch():
+    """ commands read at once are returned in order by later pops """
+    transport = StreamTransport(count=10)
+    redis_conn = redis_connection()
+    redis_conn.flushdb()
+
+    for i in range(3):
+        transport.enqueue_command(redis_conn, QUEUES[1], command(i))
+
+    popped = [transport.pop_command_reliable_any(
+              redis_conn, QUEUES, PROCESSING, timeout=1)[1]
+              for i in range(3)]
+    assert popped == [command(i) for i in range(3)], "batch test fails"
+    assert transport.get_all_commands(redis_conn, QUEUES[1]) == [],\
+        "batch test fails"
+
+    # commands of earlier queues are popped before buffered ones
+    for i in range(2):
+        transport.enqueue_command(redis_conn, QUEUES[1], command(i))
+    transport.pop_command_reliable_any(
+        redis_conn, QUEUES, PROCESSING, timeout=1)
+    transport.enqueue_command(redis_conn, QUEUES[0], command(2))
+    popped = [transport.pop_command_reliable_any(
+              redis_conn, QUEUES, PROCESSING, timeout=1)[:2]
+              for i in range(2)]
+    assert popped == [(0, command(2)), (1, command(1))],\
+        "buffered commands should not run ahead of earlier queues"
+
+    redis_conn.flushdb()
+
+
+def test_stream_transport_pop_read_at_once():
+    """
+    commands of several queues queued while blocking are not lost and
+    keep their order
+    """
+    transport = StreamTransport(count=10)
+    redis_conn = redis_connection()
+    redis_conn.flushdb()
+
+    def enqueue_later():
+        time.sleep(0.5)
+        pipe = redis_conn.pipeline()
+        transport.enqueue_command(pipe, QUEUES[0], {'command': 'STOP'})
+        transport.enqueue_command(pipe, QUEUES[1], command(0))
+        pipe.execute()
+
+    Thread(target=enqueue_later).start()
+    assert transport.pop_command_any(redis_conn, QUEUES, timeout=2) ==\
+        (0, {'command': 'STOP'}), "blocking pop_command_any test fails"
+    transport.enqueue_command(redis_conn, QUEUES[1], command(1))
+    assert transport.get_all_commands(redis_conn, QUEUES[1]) ==\
+        [command(0), command(1)], "other commands should be left in order"
+    assert [StreamTransport().pop_command_any(
+            redis_conn, QUEUES, timeout=1) for i in range(2)] ==\
+        [(1, command(0)), (1, command(1))],\
+        "other commands should be popped by others in order"
+
+    # consumers are removed once released
+    transport.release_consumer(redis_conn, QUEUES)
+    assert all(group['consumers'] == 0
+               for group in redis_conn.xinfo_groups(QUEUES[0])),\
+        "release_consumer test fails"
+
+    redis_conn.flushdb()
+
+
+def test_stream_transport_claim():
+    """ commands of expired consumers are claimed by others """
+    transport = StreamTransport()
+    redis_conn = redis_connection()
+    redis_conn.flushdb()
+
+    transport.enqueue_command(redis_conn, QUEUES[1], command(0))
+    transport.pop_command_reliable_any(
+        redis_conn, QUEUES[1:], ["crashed"], timeout=1)
+
+    time.sleep(0.2)
+    # a transport per consumer since claims are checked per thread
+    claimed = []
+    popped = StreamTransport().pop_command_reliable_any(
+        redis_conn, QUEUES[1:], PROCESSING[1:], timeout=1, lease_timeout=0.1,
+        on_claimed=claimed.extend)
+    assert popped[:2] == (0, command(0)), "claim test fails"
+    assert claimed == [command(0)], "on_claimed test fails"
+    assert transport.pending_commands(redis_conn, QUEUES[1], "crashed") ==\
+        [], "claim test fails"
+
+    redis_conn.flushdb()
+
+
+def test_stream_transport_listen():
+    """ commands published while not listening are received """
+    transport = StreamTransport(maxlen=100)
+    redis_conn = redis_connection()
+    redis_conn.flushdb()
+
+    transport.publish_command(redis_conn, "test:channel", command(0))
+    listener = transport.listen(redis_conn, ["test:channel"])
+    transport.publish_command(redis_conn, "test:channel", command(1))
+    transport.publish_command(redis_conn, "test:channel", command(2))
+    assert next(listener) == command(1), "listen test fails"
+    transport.publish_command(redis_conn, "test:channel", command(3))
+    assert [next(listener), next(listener)] == [command(2), command(3)],\
+        "listen test fails"
+
+    redis_conn.flushdb()
@@ -1,5 +1,9 @@
 # -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
 from modelrunner import utils
+from modelrunner.redis_utils import decode_command, register_command
 from datetime import datetime
 
 
@@ -8,3 +12,59 @@ def test_json_datetime():
     dump = utils.json_dumps_datetime(d)
     loaded = utils.json_loads_datetime(dump)
     assert d == loaded
+
+
+def test_decode_command():
+    register_command('TEST_DATETIME', datetime_attrs=('created',))
+    d = {'command': 'TEST_DATETIME', 'job_uuid': '2016-01-01T00:00:00',
+         'created': datetime.now()}
+    loaded = decode_command(utils.json_dumps_datetime(d))
+    assert loaded['created'] == d['created'],\
+        "declared datetime should be loaded as datetime"
+    assert loaded['job_uuid'] == d['job_uuid'],\
+        "undeclared attributes should be loaded as is"
+
+    d = {'command': 'KILL_JOB', 'job_uuid': 'abc'}
+    assert decode_command(utils.json_dumps_datetime(d)) == d
+
+
+def test_fetch_files_from_urls():
+    source_dir = tempfile.mkdtemp()
+    dest_dir = tempfile.mkdtemp()
+    try:
+        names = ["a.txt", "b.txt"]
+        for name in names:
+            with open(os.path.join(source_dir, name), 'w') as f:
+                f.write(name)
+
+        utils.fetch_files_from_urls(
+            ["file://" + os.path.join(source_dir, name) for name in names],
+            dest_dir)
+        assert sorted(os.listdir(dest_dir)) == names,\
+            "all files should be fetched"
+
+        try:
+            utils.fetch_files_from_urls(
+                ["file://" + os.path.join(source_dir, "missing.txt")],
+                dest_dir)
+            assert False, "failed fetch should raise"
+        except IOError:
+            pass
+    finally:
+        shutil.rmtree(source_dir)
+        shutil.rmtree(dest_dir)
+
+
+def test_url_content_length():
+    source_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(source_dir, "a.txt")
+        with open(path, 'w') as f:
+            f.write("abc")
+
+        assert utils.url_content_length("file://" + path) == 3
+        assert utils.url_content_length(
+            "file://" + os.path.join(source_dir, "missing.txt")) == 0,\
+            "unknown sizes should be 0"
+    finally:
+        shutil.rmtree(source_dir)